@@ -1,7 +1,104 @@
+import signal
+import sys
 from mqtt.mqtt_broker import MQTTBroker
 
 if __name__ == "__main__":
-    broker = MQTTBroker(host="192.168.0.175", port=MQTTBroker.PORT)
+    record_file    = None
+    message_expiry = {}
+    conflate       = []
+    client_rate    = None
+    topic_rates    = {}
+    high_water     = None
+    spool_dir      = None
+    certfile       = None
+    keyfile        = None
+    sn_port        = None
+    sn_topics      = {}
+    profile        = False
+    profile_dir    = "profiles"
+    profile_rate   = 100
+    profile_window = 30
+
+    def parse_rate(rate):
+        # "msgs,bytes" per second, empty for unlimited, e.g. "100," or ",65536"
+        return tuple(float(r) if r else None for r in rate.split(","))
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] in ("-r", "--record"):
+            # Write every inbound frame to a capture log (see mqtt.mqtt_capture)
+            record_file = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] in ("-e", "--expiry"):
+            # Default Message Expiry Interval for a topic pattern, e.g. -e sensors/#=3600
+            pattern, seconds = sys.argv[i+1].rsplit("=", 1)
+            message_expiry[pattern] = int(seconds)
+            i += 2
+        elif sys.argv[i] in ("-c", "--conflate"):
+            # Only deliver the newest undelivered QoS 0 message for topics matching the pattern
+            conflate.append(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--rate":
+            # Limit every client to msgs/s,bytes/s
+            client_rate = parse_rate(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--topic-rate":
+            # Limit all publishers on a topic pattern together, e.g. --topic-rate "+/stick/#=50,"
+            pattern, rate = sys.argv[i+1].rsplit("=", 1)
+            topic_rates[pattern] = parse_rate(rate)
+            i += 2
+        elif sys.argv[i] == "--high-water":
+            # Pause publishers while more packets than this are queued for all clients
+            high_water = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--spool":
+            # Spill queues of offline sessions to this directory
+            spool_dir = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == "--cert":
+            # Listen with TLS (on MQTTBroker.PORT_SSL) using this certificate (chain)
+            certfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == "--key":
+            keyfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == "--sn":
+            # MQTT-SN gateway on this UDP port (usually 1884)
+            sn_port = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--sn-topic":
+            # Predefined MQTT-SN topic id, e.g. --sn-topic 1=sensors/temp
+            topic_id, topic = sys.argv[i+1].split("=", 1)
+            sn_topics[int(topic_id)] = topic
+            i += 2
+        elif sys.argv[i] == "--profile":
+            # Profile from the start, writing to this directory (SIGUSR1 toggles profiling at runtime)
+            profile, profile_dir = True, sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == "--profile-rate":
+            # Stack samples per second
+            profile_rate = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--profile-window":
+            # Seconds to profile for
+            profile_window = float(sys.argv[i+1])
+            i += 2
+        else:
+            i += 1
+
+    broker = MQTTBroker(host="192.168.0.175", port=MQTTBroker.PORT, record_file=record_file,
+                        message_expiry=message_expiry, conflate_topics=conflate,
+                        client_rate=client_rate, topic_rates=topic_rates, queue_high_water=high_water,
+                        spool_dir=spool_dir,
+                        use_ssl=certfile is not None, certfile=certfile, keyfile=keyfile,
+                        sn_port=sn_port, sn_topics=sn_topics,
+                        profile=profile, profile_dir=profile_dir, profile_rate=profile_rate,
+                        profile_window=profile_window)
+
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> starts (or stops) a profiling window on the live broker
+        signal.signal(signal.SIGUSR1, lambda signum, frame: broker.toggle_profiling())
+
     # broker = MQTTBroker(host="10.42.0.1", port=MQTTBroker.PORT)
     # broker = MQTTBroker(host=MQTTBroker.HOST, port=MQTTBroker.PORT)
-    broker.start()
\ No newline at end of file
+    broker.start()
@@ -1,3 +1,4 @@
+import os
 import socket
 import time
 from mqtt.bits import Bits
@@ -6,8 +7,16 @@ from mqtt.mqtt_threading import Threading
 from mqtt.mqtt_exceptions import *
 from mqtt.mqtt_packet_types import *
 from mqtt.mqtt_packet import *
+from mqtt.mqtt_properties import TopicAliases
 from mqtt.mqtt_socket import *
 from mqtt.mqtt_subscription import TopicSubscription
+from mqtt.topic_matcher import TopicMatcher
+from mqtt.mqtt_capture import TrafficRecorder
+from mqtt.mqtt_expiry import ExpiryQueue
+from mqtt.mqtt_ratelimit import RateLimit, Backpressure
+from mqtt.mqtt_spool import SessionSpool
+from mqtt.mqtt_tls import TLSAcceptor
+from mqtt.mqtt_profiler import BrokerProfiler
 
 try:
     import select
@@ -31,17 +40,27 @@ class ConnectedClient:
     LIFETIME_MOD = 1.5
     ID_COUNTER = 0
 
+    # MQTT 5 limits of the broker side, sent in CONNACK
+    RECEIVE_MAXIMUM     = 32  # Max QoS 1/2 PUBLISH in flight from the client
+    TOPIC_ALIAS_MAXIMUM = 16  # Max topic aliases the client may use
+    MAXIMUM_PACKET_SIZE = 0   # Max packet size the client may send, 0 means no limit
+
+    SPOOL_CHUNK = 256  # Packets read back from the spool at once
+
     def __init__(self, sock, addr):
         super().__init__()
         self.sock = sock
         self.addr, self.port = addr
 
-        self.poller = select.poll()
-        self.poller.register(self.sock, select.POLLOUT | select.POLLIN)
+        self.poller = None
+        if self.sock:
+            self.poller = select.poll()
+            self.poller.register(self.sock, select.POLLOUT | select.POLLIN)
 
         self.is_active = True
         self.queued_packets_lock  = Threading.new_lock()
         self.queued_packets       = []  # [ MQTTPacket() ]
+        self.conflated_packets    = {}  # { topic: queued QoS 0 PUBLISH } for conflated subscriptions
         self.awaited_packets_lock = Threading.new_lock()
         self.awaited_packets      = []  # [ (ptype, sent_apcket)... ]
 
@@ -60,6 +79,28 @@ class ConnectedClient:
         self.username      = b""
         self.password      = b""
 
+        # Protocol (MQTT 5) limits of the client side
+        self.protocol_level   = ProtocolLevel.MQTT_3_1_1
+        self.receive_maximum  = 0xFFFF  # Max QoS 1/2 PUBLISH in flight to the client
+        self.max_packet_size  = 0       # Max packet size the client accepts, 0 means no limit
+        self.topic_aliases    = TopicAliases()
+        self.inbound_inflight = 0
+
+        # Traffic capture
+        self.conn_id  = ConnectedClient.ID_COUNTER
+        self.recorder = None
+
+        # Flow control
+        self.rate_limit      = None  # RateLimit() for all packets read from this client
+        self.throttled_until = 0     # Set by topic rate limits
+        self.is_publisher    = False
+
+        # Offline queue spill to disk, spool_dir is set by the broker to enable it
+        self.spool_dir       = None
+        self.spool_threshold = 0     # Queued packets kept in memory while offline
+        self.spool           = None  # SessionSpool(), created on first spill
+        self.expiry          = None  # Broker's ExpiryQueue, for packets read back from the spool
+
         self.start_timestamp = time.time()
         ConnectedClient.ID_COUNTER += 1
 
@@ -123,10 +164,17 @@ class ConnectedClient:
     ###########################################################################
     # Socket connection related
 
-    def reconnect(self, sock, addr):
+    def reconnect(self, sock, addr, conn_id=None):
         self.sock = sock
         self.addr, self.port = addr
 
+        if conn_id is not None:
+            self.conn_id = conn_id
+
+        # [MQTT-3.3.2-7] Topic aliases only live as long as the network connection
+        self.topic_aliases    = TopicAliases(self.topic_aliases.inbound_max, self.topic_aliases.outbound_max)
+        self.inbound_inflight = 0
+
         if self.keep_alive_s > 0:
             self.sock.settimeout(self.keep_alive_s)
 
@@ -151,6 +199,8 @@ class ConnectedClient:
             self.username      = conn.username
             self.password      = conn.password
 
+            self.set_protocol_params(conn)
+
             if len(conn.packet_id) > 0:
                 self._log("renamed to '{0}'".format(Bits.bytes_to_str(conn.packet_id)))
                 self.id = conn.packet_id
@@ -172,6 +222,29 @@ class ConnectedClient:
         else:
             self._log("No conn params?")
 
+    def set_protocol_params(self, conn):
+        """Negotiate MQTT 5 Receive Maximum, Maximum Packet Size and Topic Alias Maximum."""
+        self.protocol_level  = conn.protocol_level
+        self.receive_maximum = conn.properties.get(PropertyType.RECEIVE_MAXIMUM, 0xFFFF)
+        self.max_packet_size = conn.properties.get(PropertyType.MAXIMUM_PACKET_SIZE, 0)
+
+        if self.receive_maximum == 0 or PropertyType.MAXIMUM_PACKET_SIZE in conn.properties and self.max_packet_size == 0:
+            # Receive Maximum and Maximum Packet Size of 0 are a Protocol Error
+            raise MQTTDisconnectError("{0} [MQTTPacket] Receive Maximum or Maximum Packet Size of 0!".format(self))
+
+        if conn.protocol_level == ProtocolLevel.MQTT_5:
+            self.topic_aliases = TopicAliases(self.TOPIC_ALIAS_MAXIMUM,
+                                              conn.properties.get(PropertyType.TOPIC_ALIAS_MAXIMUM, 0))
+        else:
+            self.topic_aliases = TopicAliases()
+
+    def merge_protocol_params_from_other(self, other):
+        """A restored session takes over the protocol level and limits of the new connection."""
+        self.protocol_level  = other.protocol_level
+        self.receive_maximum = other.receive_maximum
+        self.max_packet_size = other.max_packet_size
+        self.topic_aliases   = other.topic_aliases
+
     def merge_params_from_other(self, other):
         if isinstance(other, ConnectedClient):
             self.connect_flags = other.connect_flags
@@ -190,24 +263,114 @@ class ConnectedClient:
 
     def has_queued_packets(self):
         with self.queued_packets_lock:
-            return len(self.queued_packets) > 0
+            return len(self.queued_packets) > 0 or (self.spool is not None and len(self.spool) > 0)
 
-    def queue_packet(self, packet, for_sub=None, first=False):
+    def queue_packet(self, packet, for_sub=None, first=False, conflate=False):
+        """
+        Queue a packet to send, returns the packet that is queued.
+        With conflate, a QoS 0 PUBLISH replaces the undelivered one for the same topic
+        (in place, so it keeps its position), and that one is returned instead.
+        """
         with self.queued_packets_lock:
             if for_sub:
                 # TODO Add packet to for_sub to comply with QoS
                 # (i.e. don't queue packet more than once if dissalowed)
                 if isinstance(packet.pflag, ControlPacketType.PublishFlags):
                     packet.pflag.qos = for_sub.qos
+
+            conflate = conflate and packet.ptype == ControlPacketType.PUBLISH and packet.pflag.qos == WillQoS.QoS_0
+
+            if conflate:
+                queued = self.conflated_packets.get(packet.topic)
+
+                if queued:
+                    # Newest value wins, the replaced one is never sent (nor expires, unless pushed again)
+                    ExpiryQueue.cancel(queued)
+                    queued.payload         = packet.payload
+                    queued.properties      = packet.properties
+                    queued.expiry_deadline = packet.expiry_deadline
+                    self.release_id(packet.packet_id)
+                    return queued
+
+                self.conflated_packets[packet.topic] = packet
+
+            # Conflated packets stay in memory (one per topic), so a newer value can still replace them
+            if not first and not conflate and self._should_spill(packet):
+                self._spill(packet)
+                return None
+
             if first:
                 self.queued_packets.insert(0, packet)
             else:
                 self.queued_packets.append(packet)
+            return packet
+
+    def _should_spill(self, packet):
+        """
+        Spill an offline session's PUBLISH packets once its memory queue is full.
+        Once spilling, keep spilling until the spool is drained, to keep the order.
+        Conflated QoS 0 packets are never spilled (see queue_packet()).
+        """
+        if not self.spool_dir or packet.ptype != ControlPacketType.PUBLISH:
+            return False
+        elif self.spool is not None and len(self.spool) > 0:
+            return True
+        return not self.is_active and len(self.queued_packets) >= self.spool_threshold
+
+    def _spill(self, packet):
+        if self.spool is None:
+            # Client ids can contain anything, use them hex encoded as directory name
+            self.spool = SessionSpool(os.path.join(self.spool_dir, Bits.str_to_bytes(self.id).hex() or str(self.conn_id)))
+
+        self.spool.append(packet)
+        ExpiryQueue.cancel(packet)
+
+        # Not in flight, it gets a new id when read back
+        self.release_id(packet.packet_id)
+
+    def _refill_from_spool(self):
+        """Move the next chunk from the spool to the (empty) memory queue (queued_packets_lock must be held)."""
+        if self.spool is None or len(self.spool) == 0:
+            return False
+
+        for packet in self.spool.read(self.SPOOL_CHUNK):
+            if ExpiryQueue.is_expired(packet):
+                continue
+
+            packet.packet_id = self.next_id()
+            self.queued_packets.append(packet)
+
+            if packet.expiry_deadline is not None and self.expiry:
+                self.expiry.push(packet, packet.expiry_deadline, self.expire_packet)
+
+        self._log("Read {0} packets back from spool ({1} left)".format(len(self.queued_packets), len(self.spool)))
+        return True
+
+    def discard_session(self):
+        """Session state is gone for good, remove what was spilled to disk."""
+        if self.spool is not None:
+            self.spool.destroy()
+            self.spool = None
+
+    def _pop_queued(self, index):
+        """Remove a queued packet (queued_packets_lock must be held)."""
+        pack = self.queued_packets.pop(index)
+        ExpiryQueue.cancel(pack)
+
+        if pack.ptype == ControlPacketType.PUBLISH and self.conflated_packets.get(pack.topic) is pack:
+            del self.conflated_packets[pack.topic]
+        return pack
 
     def has_awaited_packets(self):
         with self.awaited_packets_lock:
             return len(self.awaited_packets) > 0
 
+    def outbound_inflight(self):
+        """Number of sent QoS 1/2 PUBLISH packets that are not completely acknowledged yet."""
+        with self.awaited_packets_lock:
+            return sum(1 for ptype, _ in self.awaited_packets
+                       if ptype in (ControlPacketType.PUBACK, ControlPacketType.PUBREC, ControlPacketType.PUBCOMP))
+
     def await_packet(self, packet, first=False):
         with self.awaited_packets_lock:
             if first:
@@ -249,6 +412,14 @@ class ConnectedClient:
             #     self._get_response(ControlPacketType.PUBCOMP, sent_packet)
 
     def handle_publish_recv(self, recv_packet):
+        if recv_packet.pflag.qos in (WillQoS.QoS_1, WillQoS.QoS_2):
+            self.inbound_inflight += 1
+
+            if self.protocol_level == ProtocolLevel.MQTT_5 and self.inbound_inflight > self.RECEIVE_MAXIMUM:
+                # [MQTT-3.3.4-7] Client sent more QoS > 0 PUBLISH packets than allowed
+                raise MQTTDisconnectError("{0} exceeded Receive Maximum ({1})!".format(self, self.RECEIVE_MAXIMUM),
+                                          code=ReasonCode.RECEIVE_MAXIMUM_EXCEEDED)
+
         if recv_packet.pflag.qos == WillQoS.QoS_0:
             # Do nothing
             pass
@@ -303,14 +474,41 @@ class ConnectedClient:
     def send_queued(self):
         if self.is_active:
             with self.queued_packets_lock:
-                if not self.queued_packets:
+                if not self.queued_packets and not self._refill_from_spool():
+                    return True
+                elif not self.queued_packets:
+                    # Everything read back was expired
+                    return True
+
+                index = self._next_sendable_index()
+                if index < 0:
+                    # Only QoS 1/2 PUBLISH packets left, but Receive Maximum reached
                     return True
 
-                self._log("Sending first of {0} queued packages...".format(len(self.queued_packets)))
+                self._log("Sending {0} of {1} queued packages...".format(index + 1, len(self.queued_packets)))
 
-                pack = self.queued_packets[0]
+                pack = self.queued_packets[index]
 
-                if not self.send_packet(pack):
+                if pack.ptype == ControlPacketType.PUBLISH and not pack.pflag.dup and ExpiryQueue.is_expired(pack):
+                    # Expired before the sweeper got to it, never started delivery so just drop it
+                    self._log("Discarding {0}, message expired".format(pack))
+                    self.release_id(pack.packet_id)
+                    self._pop_queued(index)
+                    return True
+
+                data = self._encode_packet(pack)
+                size = sum(map(len, data)) if isinstance(data, tuple) else len(data)
+
+                if self.max_packet_size and size > self.max_packet_size:
+                    # [MQTT-3.1.2-25] Never send packets larger than the client accepts, discard instead
+                    self._log("Discarding {0}, exceeds Maximum Packet Size ({1} > {2})"
+                                .format(pack, size, self.max_packet_size))
+                    if pack.ptype == ControlPacketType.PUBLISH:
+                        self.release_id(pack.packet_id)
+                    self._pop_queued(index)
+                    return True
+
+                if not self.send_packet(pack, data):
                     self._log("Unable to sent {0}, requeueing...".format(pack))
                     return False
                 else:
@@ -333,12 +531,72 @@ class ConnectedClient:
                         # After sending PUBCOMP, exchange done, release id.
                         self.release_id(pack.packet_id)
 
+                    if pack.ptype in (ControlPacketType.PUBACK, ControlPacketType.PUBCOMP):
+                        # Incoming QoS 1/2 exchange done
+                        self.inbound_inflight = max(0, self.inbound_inflight - 1)
+
                     # TODO Await other responses that don't need to be handled?
-                    self.queued_packets.pop(0)
+                    self._pop_queued(index)
                     return True
 
         return True
 
+    def _next_sendable_index(self):
+        """
+        Index of the first queued packet that may be sent now: QoS 1/2 PUBLISH
+        packets have to wait while the client's Receive Maximum is reached.
+        """
+        if self.outbound_inflight() < self.receive_maximum:
+            return 0
+
+        for i, pack in enumerate(self.queued_packets):
+            if pack.ptype != ControlPacketType.PUBLISH or pack.pflag.qos == WillQoS.QoS_0:
+                return i
+        return -1
+
+    def _encode_packet(self, pack):
+        """
+        Encode for this connection: protocol level dependant, with Topic Alias if possible.
+        PUBLISH packets are encoded as (headers, payload) to send without copying the payload.
+        """
+        if pack.ptype != ControlPacketType.PUBLISH:
+            return pack.to_bin()
+        elif self.protocol_level != ProtocolLevel.MQTT_5:
+            return pack.to_bin_parts(protocol_level=self.protocol_level)
+
+        properties = dict(pack.properties)
+        properties.pop(PropertyType.TOPIC_ALIAS, None)
+
+        if pack.expiry_deadline is not None:
+            # [MQTT-3.3.2-6] Forward the remaining lifetime, not the original one
+            properties[PropertyType.MESSAGE_EXPIRY_INTERVAL] = ExpiryQueue.remaining(pack)
+
+        topic = pack.topic
+        alias, is_known = self.topic_aliases.lookup(topic)
+
+        if alias:
+            properties[PropertyType.TOPIC_ALIAS] = alias
+            if is_known:
+                # [MQTT-3.3.2-12] Alias already set, send empty topic
+                topic = b""
+
+        return pack.to_bin_parts(protocol_level=self.protocol_level, topic=topic, properties=properties)
+
+    def expire_packet(self, packet):
+        """Evict an expired packet that is still waiting in the queue, returns whether it was."""
+        with self.queued_packets_lock:
+            for i, pack in enumerate(self.queued_packets):
+                if pack is packet:
+                    if pack.pflag.dup:
+                        # Delivery already started before, has to be completed
+                        return False
+
+                    self._pop_queued(i)
+                    self.release_id(pack.packet_id)
+                    self._log("Expired {0}".format(pack))
+                    return True
+        return False
+
     def show_queued(self):
         with self.queued_packets_lock:
             self._log("Queued ({0}){1}".format(
@@ -403,6 +661,9 @@ class ConnectedClient:
     # Socket related
 
     def has_data(self):
+        if getattr(self.sock, "pending", None) and self.sock.pending():
+            # TLS: already decrypted, but the socket itself may not be readable anymore
+            return True
         if self.poller:
             res = self.poller.poll(1000)
             if res and res[0][1] & select.POLLIN:
@@ -418,24 +679,31 @@ class ConnectedClient:
 
         if data:
             self.reset_lifetime()
+
+            if self.recorder:
+                self.recorder.record(self.conn_id, data)
             # self._log("Received: {0}".format(data))
         else:
             self._log("Empty response?")
 
         return data
 
-    def send_packet(self, pack):
+    def send_packet(self, pack, data=None):
         if not self.is_active:
             self.queue_packet(pack)
             return False
             # raise MQTTDisconnectError("{0} got disconnected.".format(self))
 
-        data  = pack.to_bin()
+        data  = data or self._encode_packet(pack)
         retry = Retrier(lambda: socket_send(self.sock, data, self.poller),
                         fail_callback=self._error,
                         tries=5, delay_ms=450)
 
         if retry.attempt():
+            if pack.ptype == ControlPacketType.PUBLISH and self.protocol_level == ProtocolLevel.MQTT_5:
+                # The client now knows the alias used for this topic
+                self.topic_aliases.commit(pack.topic, self.topic_aliases.lookup(pack.topic)[0])
+
             self._log("Sent {0}".format(pack))
             return True
         return False
@@ -445,7 +713,7 @@ class ConnectedClient:
         if not raw:
             return False, raw
         else:
-            response = MQTTPacket.from_bytes(raw, expected_type=ptype)
+            response = MQTTPacket.from_bytes(raw, expected_type=ptype, protocol_level=self.protocol_level)
             return response.ptype == ptype, response
 
     def CONNACK(self, code=ReturnCode.ACCEPTED, was_restored=False):
@@ -455,8 +723,20 @@ class ConnectedClient:
           and code == ReturnCode.ACCEPTED:
             session_present = 1
 
+        properties = None
+
+        if self.protocol_level == ProtocolLevel.MQTT_5:
+            code = ReasonCode.from_return_code(code)
+            properties = {
+                PropertyType.RECEIVE_MAXIMUM     : self.RECEIVE_MAXIMUM,
+                PropertyType.TOPIC_ALIAS_MAXIMUM : self.TOPIC_ALIAS_MAXIMUM,
+            }
+            if self.MAXIMUM_PACKET_SIZE:
+                properties[PropertyType.MAXIMUM_PACKET_SIZE] = self.MAXIMUM_PACKET_SIZE
+
         response = MQTTPacket.create_connack(session_present=session_present,
-                                             status_code=code)
+                                             status_code=code,
+                                             properties=properties)
         self.send_packet(response)
 
     def requested_disconnect(self):
@@ -507,14 +787,20 @@ class ConnectedClient:
 class MQTTBroker:
     HOST     = "10.42.0.252"
     PORT     = 1883
-    PORT_SSL = 1883
-
-    def __init__(self, host=HOST, port=PORT, use_ssl=False, enable_colours=True):
+    PORT_SSL = 8883
+
+    def __init__(self, host=HOST, port=PORT, use_ssl=False, enable_colours=True, record_file=None,
+                 message_expiry=None, conflate_topics=None,
+                 client_rate=None, topic_rates=None, queue_high_water=None, queue_low_water=None,
+                 spool_dir=None, spool_threshold=1000,
+                 certfile=None, keyfile=None, handshake_workers=4,
+                 sn_port=None, sn_topics=None,
+                 profile=False, profile_dir="profiles", profile_rate=100, profile_window=30):
         Colours.FORMAT_ESCAPE_SEQ_SUPPORTED = enable_colours
 
         super().__init__()
         self.host = host
-        self.port = self.PORT_SSL if use_ssl else port
+        self.port = self.PORT_SSL if use_ssl and port == self.PORT else port
 
         self.client_lock = Threading.new_lock()
         self.clients = {}
@@ -522,12 +808,56 @@ class MQTTBroker:
         self.retained_lock = Threading.new_lock()
         self.retained_packets = {}  # { topic: [packets] }
 
+        # Undelivered and retained messages expire after their MQTT 5 Message Expiry Interval,
+        # or after the default of the first matching topic pattern: { pattern: seconds }
+        self.message_expiry = message_expiry or {}
+        self.expiry = ExpiryQueue()
+        self.is_running = False
+
+        # QoS 0 messages on these topic patterns are conflated for every subscriber:
+        # an undelivered message is replaced by a newer one on the same topic
+        self.conflate_topics = list(conflate_topics or [])
+
+        # Rate limits as (messages/s, bytes/s), either may be None:
+        # client_rate applies to each client, topic_rates = { pattern: (msgs, bytes) } to all PUBLISH on a pattern
+        self.client_rate = client_rate
+        self.topic_rates = { pattern: RateLimit(*limits) for pattern, limits in (topic_rates or {}).items() }
+
+        # Stop reading from publishers while too many packets are queued for all clients together
+        self.backpressure = Backpressure(queue_high_water, queue_low_water) if queue_high_water else None
+
+        # Spill queued packets of offline sessions to disk after spool_threshold packets
+        self.spool_dir       = spool_dir
+        self.spool_threshold = spool_threshold
+
+        # TLS handshakes are done by a pool of workers, not the accept loop
+        if use_ssl and not certfile:
+            raise ValueError("[MQTTBroker] A certificate file is required for TLS!")
+        self.tls = TLSAcceptor(certfile, keyfile, handshake_workers) if use_ssl else None
+
+        # Write every inbound frame to a capture log, if requested
+        self.recorder = TrafficRecorder(record_file) if record_file else None
+
+        # MQTT-SN clients on UDP, routed like any other client: sn_topics = { predefined topic id: topic }
+        if sn_port:
+            # Imported here, the gateway module itself depends on ConnectedClient
+            from mqtt.mqttsn_gateway import MQTTSNGateway
+            self.sn_gateway = MQTTSNGateway(self, host, sn_port, sn_topics)
+        else:
+            self.sn_gateway = None
+
+        # Sampling profiler, idle until start_profiling() (or profile=True to start with the broker)
+        self.profile  = profile
+        self.profiler = BrokerProfiler(profile_dir, profile_rate, profile_window, on_done=self._profiling_done)
+
         self.server_sock = None
         self._init_socket()
 
     def __del__(self):
         if self.server_sock:
             self.server_sock.close()
+        if self.recorder:
+            self.recorder.close()
 
     def _log(self, msg):
         if DEBUG:
@@ -550,12 +880,49 @@ class MQTTBroker:
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_sock.bind((self.host, self.port))
         self.server_sock.listen(5)
-        self._info("Created at {0}:{1}".format(self.host if self.host else "127.0.0.1",
-                                               self.port))
+        self._info("Created at {0}:{1}{2}".format(self.host if self.host else "127.0.0.1",
+                                                  self.port, " (TLS)" if self.tls else ""))
 
     ###########################################################################
     # Sub/Pub related
 
+    def _set_expiry(self, topic, packet):
+        """Give an incoming PUBLISH its deadline, from its Message Expiry Interval or the topic defaults."""
+        if packet.expiry_deadline is not None:
+            return packet.expiry_deadline
+
+        interval = packet.properties.get(PropertyType.MESSAGE_EXPIRY_INTERVAL)
+
+        if interval is None:
+            topic_str = Bits.bytes_to_str(topic)
+            for pattern, seconds in self.message_expiry.items():
+                if TopicMatcher(pattern).matches(topic_str):
+                    interval = seconds
+                    break
+
+        if interval is not None:
+            packet.expiry_deadline = time.time() + interval
+        return packet.expiry_deadline
+
+    def _expire_retained(self, packet):
+        with self.retained_lock:
+            if self.retained_packets.get(packet.topic) is packet:
+                self._info(style("Retained packet for topic '{0}' expired!".format(Bits.bytes_to_str(packet.topic)),
+                                 Colours.BG.YELLOW, Colours.FG.BLACK))
+                del self.retained_packets[packet.topic]
+                return True
+        return False
+
+    def _expire_messages(self):
+        """Evict expired messages from the heap, sleeping until the next deadline (1s at most)."""
+        while self.is_running:
+            count = self.expiry.evict()
+            if count:
+                self._info("Evicted {0} expired message(s)".format(count))
+
+            deadline = self.expiry.next_deadline()
+            time.sleep(1 if deadline is None else min(1, max(0.01, deadline - time.time())))
+
     def queue_published_retained(self, topic, packet):
         # [MQTT-3.1.2-7] Retained messages are kept in broker, not at client level
         # So they are kept when a client that sent them disconnects.
@@ -571,8 +938,22 @@ class MQTTBroker:
                                  Colours.BG.YELLOW, Colours.FG.BLACK))
                 self.retained_packets[topic] = packet
 
+                deadline = self._set_expiry(topic, packet)
+                if deadline is not None:
+                    self.expiry.push(packet, deadline, self._expire_retained)
+
+    def _is_conflated(self, topic):
+        topic_str = Bits.bytes_to_str(topic)
+        return any(TopicMatcher(pattern).matches(topic_str) for pattern in self.conflate_topics)
+
     def _publish_to_clients(self, topic, packet, not_to_source=None):
         qos_stop_sending = {}
+        deadline = self._set_expiry(topic, packet)
+        conflate = self._is_conflated(topic)
+
+        # Every matching subscription leaves the same topic name after filtering its wildcards,
+        # so every queued copy can share it (and the payload and properties) with the original
+        deliver_topic = None
 
         with self.client_lock:
             for client in self.clients.values():
@@ -592,13 +973,47 @@ class MQTTBroker:
                     # QoS 0 may also be stored.
 
                     # Flags: [MQTT-3.3.1-9], [MQTT-4.3.1-1], [MQTT-4.3.2-1]
+                    if deliver_topic is None:
+                        deliver_topic = Bits.str_to_bytes(TopicSubscription.filter_wildcards(sub.topic, topic))
+
                     republish = MQTTPacket.create_publish(
                         ControlPacketType.PublishFlags(DUP=0, QoS=sub.qos, RETAIN=0),
                         client.next_id(),
-                        Bits.str_to_bytes(TopicSubscription.filter_wildcards(sub.topic, topic)),
-                        packet.payload)
+                        deliver_topic,
+                        packet.payload,
+                        packet.properties)
+
+                    republish.expiry_deadline = deadline
+                    queued = client.queue_packet(republish, for_sub=sub, conflate=conflate or sub.conflate)
 
-                    client.queue_packet(republish, for_sub=sub)
+                    if queued and deadline is not None:
+                        # Not when spilled to disk, then it is checked when read back
+                        self.expiry.push(queued, deadline, client.expire_packet)
+
+    def _queue_retained_for(self, client):
+        """Check if any retained packet matches the (new) subscriptions of a client and send it."""
+        with self.retained_lock:
+            if self.retained_packets:
+                client._log("Checking for retained packet matches...")
+                for topic, ret_pack in self.retained_packets.items():
+                    for sub in client.is_subscribed_to(topic):
+                        self._info(style("RETAINED", Colours.BG.YELLOW, Colours.FG.BLACK) \
+                                 + " match: {0}".format(ret_pack))
+
+                        # Every client gets its own copy (own packet id and expiry entry)
+                        # [MQTT-3.3.1-8] Retain flag set when sent because of a new subscription
+                        republish = MQTTPacket.create_publish(
+                            ControlPacketType.PublishFlags(DUP=0, QoS=sub.qos, RETAIN=1),
+                            client.next_id(),
+                            ret_pack.topic,
+                            ret_pack.payload,
+                            ret_pack.properties)
+
+                        republish.expiry_deadline = ret_pack.expiry_deadline
+                        queued = client.queue_packet(republish, for_sub=sub)
+
+                        if queued and ret_pack.expiry_deadline is not None:
+                            self.expiry.push(queued, ret_pack.expiry_deadline, client.expire_packet)
 
     ###########################################################################
     # Client related
@@ -610,6 +1025,12 @@ class MQTTBroker:
     def _create_client(self, sock, addr):
         with self.client_lock:
             self.clients[addr] = ConnectedClient(sock, addr)
+            self.clients[addr].recorder = self.recorder
+            if self.client_rate:
+                self.clients[addr].rate_limit = RateLimit(*self.client_rate)
+            self.clients[addr].spool_dir       = self.spool_dir
+            self.clients[addr].spool_threshold = self.spool_threshold
+            self.clients[addr].expiry          = self.expiry
             return self.clients[addr]
 
     def _swap_client_with_existing(self, client):
@@ -637,11 +1058,13 @@ class MQTTBroker:
             with self.client_lock:
                 if client.connect_flags.clean == 1:
                     # [MQTT-3.1.2-6] Session restored, but new one wants to start clean, so destroy old context.
+                    existing_cl.discard_session()
                     del self.clients[existing_cl.address()]
                     existing_cl = client
                 else:
                     # Use old context and destroy new one
-                    existing_cl.reconnect(client.sock, address)
+                    existing_cl.reconnect(client.sock, address, conn_id=client.conn_id)
+                    existing_cl.merge_protocol_params_from_other(client)
 
                     # TODO overwrite with new params?
                     # existing_cl.merge_params_from_other(client)
@@ -679,11 +1102,15 @@ class MQTTBroker:
             # [MQTT-3.1.2-10] Delete will msg
             self.clients[addr].requested_disconnect()
 
+        if self.recorder:
+            self.recorder.flush()
+
         with self.client_lock:
             self.clients[addr].disconnect()
 
             # [MQTT-3.1.2-6] If clean == 1, delete context of client
             if not self.clients[addr].keep_context():
+                self.clients[addr].discard_session()
                 del self.clients[addr]
 
     def _destroy_all_clients(self):
@@ -694,6 +1121,7 @@ class MQTTBroker:
             self._info("Destroying {0} clients...".format(len(self.clients)))
             for addr in list(self.clients.keys()):
                 self.clients[addr].disconnect()
+                self.clients[addr].discard_session()
                 del self.clients[addr]
 
     def _connect_client(self, client):
@@ -746,9 +1174,18 @@ class MQTTBroker:
         if not raw:
             raise MQTTDisconnectError("No packet received!")
 
+        if client.MAXIMUM_PACKET_SIZE and len(raw) > client.MAXIMUM_PACKET_SIZE:
+            # [MQTT-3.2.2-15] Packet exceeds the Maximum Packet Size sent in CONNACK
+            raise MQTTDisconnectError("Packet exceeds Maximum Packet Size ({0} > {1})!"
+                                        .format(len(raw), client.MAXIMUM_PACKET_SIZE),
+                                      code=ReasonCode.PACKET_TOO_LARGE)
+
+        if client.rate_limit:
+            client.rate_limit.consume(len(raw))
+
         err = None
         try:
-            packet = MQTTPacket.from_bytes(raw)
+            packet = MQTTPacket.from_bytes(raw, protocol_level=client.protocol_level)
         except MQTTPacketException as e:
             if "unimplemented" in str(e).lower():
                 err = e
@@ -768,6 +1205,13 @@ class MQTTBroker:
             if packet.pflag.qos not in WillQoS.CHECK_VALID:
                 raise MQTTDisconnectError("Invalid PUBLISH QoS ({0})!".format(packet.pflag.qos))
 
+            # MQTT 5 Topic Alias: replace by (or register) the full topic, don't forward the alias
+            packet.topic = client.topic_aliases.resolve(packet.topic,
+                                                        packet.properties.pop(PropertyType.TOPIC_ALIAS, 0))
+
+            client.is_publisher = True
+            self._consume_topic_rate(client, packet.topic, len(raw))
+
             self._info("PUBLISH to topic '{0}': {1}".format(
                     Bits.bytes_to_str(packet.topic),
                     "'{0}'".format(Bits.bytes_to_str(packet.payload)) if packet.payload else "(no payload)" ))
@@ -788,40 +1232,40 @@ class MQTTBroker:
 
             # [MQTT-3.8.4-1] Send SUBACK, with combined return codes and granted QoS (same order as SUBSCRIBE topics)
             # TODO? [MQTT-3.8.4-5] Change max granted QoS? Or give error?
-            client.send_packet(MQTTPacket.create_suback(packet.packet_id, packet.topics))
+            client.send_packet(MQTTPacket.create_suback(packet.packet_id, packet.topics, client.protocol_level))
+
+            if (b"conflate", b"1") in packet.properties.get(PropertyType.USER_PROPERTY, []):
+                # MQTT 5 clients can ask for conflation of (QoS 0) messages on these subscriptions
+                for sub in packet.topics.values():
+                    sub.conflate = True
 
             client._log("is SUBSCRIBING to: {0}".format(", ".join(str(t) for t in packet.topics.values())))
 
             for topic, sub in packet.topics.items():
+                if not sub.is_valid():
+                    # Refused in the SUBACK
+                    continue
                 # [MQTT-3.8.4-3] If any topic is already subscribed to, replace with this new subscription (updated QoS)
                 client.subscribe_to(sub)
 
             client.show_subscriptions()
-
-            # Check if any retained packet matches new sub and send it
-            with self.retained_lock:
-                if self.retained_packets:
-                    client._log("Checking for retained packet matches...")
-                    for topic, ret_pack in self.retained_packets.items():
-                        for sub in client.is_subscribed_to(topic):
-                            self._info(style("RETAINED", Colours.BG.YELLOW, Colours.FG.BLACK) \
-                                     + " match: {0}".format(ret_pack))
-                            if ret_pack.ptype == ControlPacketType.PUBLISH:
-                                # [MQTT-3.3.1-8]
-                                ret_pack.pflag.retain = 1
-                            client.queue_packet(ret_pack, for_sub=sub)
+            self._queue_retained_for(client)
 
         elif packet.ptype == ControlPacketType.UNSUBSCRIBE:
             # UNSUBSCRIBE #####################################################
 
-            # [MQTT-3.10.4-4], [MQTT-3.10.4-5]
-            client.send_packet(MQTTPacket.create_unsuback(packet.packet_id))
-
             client._log("is UNSUBSCRIBING from: {0}".format(", ".join(packet.topics)))
 
+            reason_codes = []
+
             for topic in packet.topics:
                 # [MQTT-3.10.4-1] Remove subscription topics from client that match exactly
-                client.unsubscribe_from(topic)
+                reason_codes.append(ReasonCode.SUCCESS if client.unsubscribe_from(topic) else \
+                                    ReasonCode.NO_SUBSCRIPTION_EXISTED)
+
+            # [MQTT-3.10.4-4], [MQTT-3.10.4-5]
+            client.send_packet(MQTTPacket.create_unsuback(packet.packet_id,
+                                                          reason_codes if client.protocol_level == ProtocolLevel.MQTT_5 else None))
 
             client.show_subscriptions()
 
@@ -842,6 +1286,37 @@ class MQTTBroker:
         else:
             self._log("{0} No handler for {1} packet.".format(client, packet.name()))
 
+    def _count_queued(self):
+        with self.client_lock:
+            return sum(len(client.queued_packets) for client in self.clients.values())
+
+    def _consume_topic_rate(self, client, topic, size):
+        """Charge a PUBLISH to the matching topic limits, the publisher waits until they are out of debt."""
+        if not self.topic_rates:
+            return
+
+        topic_str = Bits.bytes_to_str(topic)
+
+        for pattern, limit in self.topic_rates.items():
+            if TopicMatcher(pattern).matches(topic_str):
+                limit.consume(size)
+                client.throttled_until = max(client.throttled_until, time.time() + limit.wait_time())
+
+    def _may_read(self, client):
+        """
+        Whether the next packet of a client may be read now. If not, it stays in the
+        socket buffer, so TCP flow control slows down the sender instead of the
+        broker buffering its messages.
+        """
+        if client.rate_limit and client.rate_limit.wait_time() > 0:
+            return False
+        elif client.throttled_until > time.time():
+            return False
+        elif self.backpressure and client.is_publisher and not client.has_awaited_packets():
+            # Never block acknowledgements, those are needed to drain the queues
+            return not self.backpressure.update(self._count_queued)
+        return True
+
     def _idle_client(self, client):
         if client.has_queued_packets():
             retry = Retrier(client.send_queued, fail_callback=self._error, tries=5, delay_ms=1000)
@@ -868,8 +1343,12 @@ class MQTTBroker:
             while client.is_active:
                 # Receive packet from client and idle
                 if client.has_data():
-                    # Incoming packet
-                    self._handle_incoming(client)
+                    if self._may_read(client):
+                        # Incoming packet
+                        self.profiler.run(self._handle_incoming, client)
+                    else:
+                        # Throttled, the client is still alive though
+                        client.reset_lifetime()
                 self._idle_client(client)
         except MQTTPacketException as e:
             self._info(style("Packet error", Colours.FG.RED) \
@@ -884,17 +1363,64 @@ class MQTTBroker:
         finally:
             self._destroy_client(sock_addr_tuple)
 
+    def _serve_tls(self, tls_sock, address):
+        self._log("TLS handshake with {0}:{1} done ({2})".format(*address,
+                  "resumed" if tls_sock.session_reused else "full"))
+        Threading.new_thread(self._serve_request, (tls_sock, address))
+
+    def _tls_failed(self, address, e):
+        self._info(style("TLS handshake failed", Colours.FG.RED) + " with {0}:{1}: {2}".format(*address, e))
+
+    def start_profiling(self, duration_s=None):
+        """Profile the running broker for duration_s (default profile_window) seconds."""
+        if self.profiler.start(duration_s):
+            self._info("Profiling for {0}s...".format(duration_s or self.profiler.duration_s))
+
+    def stop_profiling(self):
+        self.profiler.stop()
+
+    def toggle_profiling(self):
+        if self.profiler.is_active:
+            self.stop_profiling()
+        else:
+            self.start_profiling()
+
+    def _profiling_done(self, profiler):
+        self._info("Profile written to {0}: {1}".format(", ".join(profiler.files), profiler.summary()))
+
     def start(self):
         self._info("Starting to listen...")
 
+        self.is_running = True
+        Threading.new_thread(self._expire_messages, ())
+
+        if self.profile:
+            self.start_profiling()
+
+        if self.sn_gateway:
+            self.sn_gateway.start()
+
         while True:
             try:
                 (client_socket, address) = self.server_sock.accept()
                 self._info("Accept client at {0}:{1}...".format(*address))
-                Threading.new_thread(self._serve_request, (client_socket, address))
+
+                if self.tls:
+                    self.tls.submit(client_socket, address, self._serve_tls, self._tls_failed)
+                else:
+                    Threading.new_thread(self._serve_request, (client_socket, address))
             except KeyboardInterrupt:
                 print("")
+                if self.sn_gateway:
+                    self.sn_gateway.stop()
+                self.stop_profiling()
                 self._destroy_all_clients()
+                if self.recorder:
+                    self.recorder.close()
+                    self._info("Capture written to '{0}' ({1} frames).".format(self.recorder.path, self.recorder.frames))
+                if self.tls:
+                    self.tls.shutdown()
+                    self._info(str(self.tls.metrics))
                 self._info("Server stopped.")
                 break
             except Exception as e:
@@ -902,6 +1428,8 @@ class MQTTBroker:
                 if HAS_TRACE: self._log(style(traceback.format_exc(), Colours.FG.BRIGHT_MAGENTA))
                 break
 
+        self.is_running = False
+
 
 ##########################################################################################
 
@@ -0,0 +1,267 @@
+import socket
+import struct
+import sys
+import time
+
+from mqtt.colours import *
+from mqtt.mqtt_threading import Threading
+from mqtt.mqtt_exceptions import *
+from mqtt.mqtt_packet_types import *
+from mqtt.mqtt_packet import MQTTPacket
+
+try:
+    import select
+except:
+    import uselect as select
+
+
+##########################################################################################
+#### Capture
+
+class CaptureFormat:
+    """
+    Binary capture log layout:
+        MAGIC
+        [ RECORD(timestamp, connection id) + raw MQTT frame ]...
+
+    The raw frame is self-delimiting through its fixed header
+    (remaining length), so no extra length field is stored.
+    """
+    MAGIC  = b"MQTTCAP\x01"
+    RECORD = struct.Struct(">dI")  # timestamp (s), connection id
+
+
+class TrafficRecorder:
+    """Append every inbound frame, with its timestamp and connection id, to a capture log."""
+    FLUSH_EVERY = 256  # frames
+
+    def __init__(self, path):
+        super().__init__()
+        self.path   = path
+        self.lock   = Threading.new_lock()
+        self.frames = 0
+
+        self.fp = open(self.path, "wb")
+        self.fp.write(CaptureFormat.MAGIC)
+
+    def __del__(self):
+        self.close()
+
+    def record(self, conn_id, frame, timestamp=None):
+        header = CaptureFormat.RECORD.pack(timestamp or time.time(), conn_id)
+
+        with self.lock:
+            if self.fp:
+                self.fp.write(header)
+                self.fp.write(frame)
+                self.frames += 1
+
+                if self.frames % self.FLUSH_EVERY == 0:
+                    self.fp.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.fp:
+                self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+
+
+class CaptureReader:
+    """Iterate over (timestamp, conn_id, frame) records of a capture log."""
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as fp:
+            if fp.read(len(CaptureFormat.MAGIC)) != CaptureFormat.MAGIC:
+                raise MQTTPacketException("[CaptureReader] '{0}' is not a capture log!".format(self.path))
+
+            while True:
+                header = fp.read(CaptureFormat.RECORD.size)
+                if not header:
+                    break
+                elif len(header) != CaptureFormat.RECORD.size:
+                    raise MQTTPacketException("[CaptureReader] Truncated record header!")
+
+                timestamp, conn_id = CaptureFormat.RECORD.unpack(header)
+                frame = MQTTPacket.read_frame(fp)
+
+                if not frame:
+                    raise MQTTPacketException("[CaptureReader] Record without frame!")
+
+                yield timestamp, conn_id, frame
+
+    def summary(self):
+        frames, size, conns = 0, 0, set()
+        first_ts, last_ts = 0, 0
+        types = {}
+
+        for timestamp, conn_id, frame in self:
+            if not frames:
+                first_ts = timestamp
+            last_ts = timestamp
+
+            frames += 1
+            size   += len(frame)
+            conns.add(conn_id)
+
+            ptype, _ = MQTTPacket._parse_type(frame)
+            types[ptype] = types.get(ptype, 0) + 1
+
+        return frames, size, len(conns), last_ts - first_ts, types
+
+
+##########################################################################################
+#### Replay
+
+class TrafficReplayer:
+    """
+    Replay a capture log against a broker: open one connection per captured
+    connection id and re-send every frame, either at the original timing
+    (optionally scaled by `speed`) or as fast as possible.
+    """
+    def __init__(self, path, host="127.0.0.1", port=1883, realtime=True, speed=1.0):
+        super().__init__()
+        self.reader   = CaptureReader(path)
+        self.host     = host
+        self.port     = port
+        self.realtime = realtime
+        self.speed    = speed if speed > 0 else 1.0
+
+        self.conns = {}  # { conn_id: socket }
+
+        self.frames_sent = 0
+        self.bytes_sent  = 0
+        self.bytes_recv  = 0
+        self.conns_total = 0
+
+    def _log(self, msg):
+        print(style("[REPLAY]", Colours.FG.BRIGHT_WHITE) + " {0}".format(msg))
+
+    def _open(self, conn_id):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conns[conn_id] = sock
+        self.conns_total += 1
+        return sock
+
+    def _close(self, conn_id):
+        sock = self.conns.pop(conn_id, None)
+        if sock:
+            sock.close()
+
+    def _drain(self, timeout=0):
+        """Read (and discard) whatever the broker sent back, so its send buffers never fill up."""
+        deadline = time.time() + timeout
+
+        while self.conns:
+            ready, _, _ = select.select(list(self.conns.values()), [], [], max(0, deadline - time.time()))
+            if not ready:
+                break
+
+            for sock in ready:
+                try:
+                    data = sock.recv(65536)
+                except OSError:
+                    data = b""
+
+                if data:
+                    self.bytes_recv += len(data)
+                else:
+                    # Closed by broker
+                    for conn_id, s in list(self.conns.items()):
+                        if s is sock:
+                            self._close(conn_id)
+
+            if time.time() >= deadline:
+                break
+
+    def replay(self):
+        first_ts, start = None, time.time()
+
+        try:
+            for timestamp, conn_id, frame in self.reader:
+                if first_ts is None:
+                    first_ts = timestamp
+
+                if self.realtime:
+                    delay = (timestamp - first_ts) / self.speed - (time.time() - start)
+                    if delay > 0:
+                        self._drain(delay)
+
+                sock = self.conns.get(conn_id) or self._open(conn_id)
+
+                try:
+                    sock.sendall(frame)
+                except OSError as e:
+                    self._log(style("Send failed", Colours.FG.RED) + " on connection {0}: {1}".format(conn_id, e))
+                    self._close(conn_id)
+                    continue
+
+                self.frames_sent += 1
+                self.bytes_sent  += len(frame)
+
+                ptype, _ = MQTTPacket._parse_type(frame)
+                if ptype == ControlPacketType.DISCONNECT:
+                    self._close(conn_id)
+
+                self._drain()
+
+            # Give the broker a moment to flush its responses
+            self._drain(1)
+        finally:
+            for conn_id in list(self.conns.keys()):
+                self._close(conn_id)
+
+        return time.time() - start
+
+    def report(self, elapsed):
+        self._log("Replayed {0} frames ({1} bytes) over {2} connections in {3:.3f}s: {4:.1f} frames/s, received {5} bytes."
+                    .format(self.frames_sent, self.bytes_sent, self.conns_total, elapsed,
+                            self.frames_sent / elapsed if elapsed > 0 else 0, self.bytes_recv))
+
+
+##########################################################################################
+
+if __name__ == "__main__":
+    # Usage (from inside the broker directory):
+    #   python3 -m mqtt.mqtt_capture info <capture>
+    #   python3 -m mqtt.mqtt_capture replay <capture> [-h host] [-p port] [--fast] [--speed x]
+    if len(sys.argv) < 3 or sys.argv[1] not in ("info", "replay"):
+        print("Usage: python3 -m mqtt.mqtt_capture (info|replay) <capture> [-h host] [-p port] [--fast] [--speed x]")
+        sys.exit(1)
+
+    command, path = sys.argv[1], sys.argv[2]
+    host, port, realtime, speed = "127.0.0.1", 1883, True, 1.0
+
+    i = 3
+    while i < len(sys.argv):
+        if sys.argv[i] in ("-h", "--host"):
+            host = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] in ("-p", "--port"):
+            port = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == "--fast":
+            realtime = False
+            i += 1
+        elif sys.argv[i] == "--speed":
+            speed = float(sys.argv[i+1])
+            i += 2
+        else:
+            i += 1
+
+    if command == "info":
+        frames, size, conns, duration, types = CaptureReader(path).summary()
+        print("{0}: {1} frames, {2} bytes, {3} connections, {4:.3f}s".format(path, frames, size, conns, duration))
+        for ptype, count in sorted(types.items()):
+            print("    {0:<12} {1}".format(ControlPacketType.to_string(ptype), count))
+    else:
+        replayer = TrafficReplayer(path, host, port, realtime=realtime, speed=speed)
+        replayer.report(replayer.replay())
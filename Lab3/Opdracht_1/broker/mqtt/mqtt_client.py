@@ -1,11 +1,387 @@
+import asyncio
+import sys
+
+from mqtt.bits import Bits
+from mqtt.colours import *
+from mqtt.mqtt_exceptions import *
+from mqtt.mqtt_packet_types import *
+from mqtt.mqtt_packet import MQTTPacket
+from mqtt.mqtt_properties import Properties
+from mqtt.topic_matcher import TopicMatcher
+
 ##########################################################################################
 #### Client
 
+class MQTTMessage:
+    def __init__(self, topic, payload, qos=0, retain=0, properties=None):
+        super().__init__()
+        self.topic      = Bits.bytes_to_str(topic)
+        self.payload    = payload
+        self.qos        = qos
+        self.retain     = retain
+        self.properties = properties or {}
+
+    def __str__(self):
+        return style("<MESSAGE topic='{0}', QoS={1}{2}, msg={3}>".format(
+                        self.topic, self.qos, ", retained" if self.retain else "",
+                        self.payload if len(self.payload) < 100 else "({0} bytes)".format(len(self.payload))),
+                     Colours.FG.BLUE)
+
+
 class MQTTClient:
-    pass
+    """
+    asyncio MQTT client, using the broker's packet codec.
+
+        async with MQTTClient("client-id", host="127.0.0.1") as client:
+            client.add_handler("+/stick/#", on_stick)   # callback or coroutine function
+            await client.subscribe({"+/stick/#": 0, "status/#": 1})
+            await client.publish("status/me", b"online", qos=1)
+
+            async for message in client:                # messages without a handler
+                print(message)
+
+    - publish() returns once a QoS 0 message is queued, or once a QoS 1/2
+      message is acknowledged. Up to `max_inflight` QoS 1/2 messages are in
+      flight, so concurrent publishes (e.g. asyncio.gather) are pipelined.
+    - Packets written during one pass of the event loop are encoded into one
+      buffer (MQTTPacket.encode_batch) and written at once.
+    """
+    PORT = 1883
+
+    MAX_INFLIGHT = 32
+    HIGH_WATER   = 64 * 1024  # Wait for the socket to drain above this many buffered bytes
+
+    def __init__(self, client_id, host="127.0.0.1", port=PORT, keep_alive_s=60, clean=1,
+                 username=b"", password=b"", will_topic=b"", will_msg=b"", will_qos=0, will_retain=0,
+                 protocol_level=ProtocolLevel.MQTT_3_1_1, max_inflight=MAX_INFLIGHT, ssl=None):
+        super().__init__()
+        self.client_id      = Bits.str_to_bytes(client_id)
+        self.host           = host
+        self.port           = port
+        self.keep_alive_s   = keep_alive_s
+        self.clean          = clean
+        self.protocol_level = protocol_level
+        self.ssl            = ssl
+
+        self.credentials = (username, password)
+        self.will        = (will_topic, will_msg, will_qos, will_retain)
+
+        self.reader = None
+        self.writer = None
+        self.is_connected    = False
+        self.session_present = False
+
+        self.pid      = 0
+        self.inflight = {}     # { pid: [future, PUBLISH, awaited ack type] }
+        self.pending  = {}     # { pid: future } of SUBSCRIBE/UNSUBSCRIBE
+        self.rcv_qos2 = set()  # pids of received QoS 2 messages, until PUBREL
+        self.window   = asyncio.Semaphore(max_inflight)
+
+        self.handlers = []  # [ (topic filter, callback) ]
+        self.messages = asyncio.Queue()
+
+        self.write_queue     = []  # Packets to write in the next batch
+        self.flush_scheduled = False
+
+        self.connack    = None
+        self.tasks      = []
+        self.last_write = 0
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.messages.get()
+        if message is None:
+            # Disconnected
+            raise StopAsyncIteration
+        return message
+
+    ###########################################################################
+    # Connection
+
+    async def connect(self):
+        """Connect and wait for the CONNACK, returns whether the broker had a session."""
+        loop = asyncio.get_running_loop()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+        will_topic, will_msg, will_qos, will_retain = self.will
+        username, password = self.credentials
+
+        self.connack = loop.create_future()
+        self._send(MQTTPacket.create_connect(self.client_id, clean=self.clean, keep_alive_s=self.keep_alive_s,
+                                             will_topic=will_topic, will_msg=will_msg,
+                                             will_qos=will_qos, will_retain=will_retain,
+                                             username=username, password=password,
+                                             protocol_level=self.protocol_level))
+
+        self.tasks = [asyncio.ensure_future(self._read_loop())]
+        self.session_present = await self.connack
+        self.is_connected    = True
+
+        if self.keep_alive_s:
+            self.tasks.append(asyncio.ensure_future(self._keep_alive()))
+
+        return self.session_present
+
+    async def disconnect(self):
+        if not self.writer:
+            return
+
+        if self.is_connected:
+            self._send(MQTTPacket.create_disconnect())
+            self._flush()
+            await self.writer.drain()
+
+        self._close()
+
+    def _close(self, error=None):
+        if not self.writer:
+            return
+
+        self.is_connected = False
+
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.writer.close()
+        self.writer = None
+
+        # Wake everyone that waits for the broker
+        error = error or MQTTDisconnectError("[MQTTClient] Disconnected!")
+        for future in [self.connack] + [entry[0] for entry in self.inflight.values()] + list(self.pending.values()):
+            if future and not future.done():
+                future.set_exception(error)
+        self.inflight.clear()
+        self.pending.clear()
+
+        self.messages.put_nowait(None)
+
+    async def _keep_alive(self):
+        loop = asyncio.get_running_loop()
+        while self.is_connected:
+            # [MQTT-3.1.2-23] Some packet within the keep alive period
+            await asyncio.sleep(self.keep_alive_s / 2)
+            if loop.time() - self.last_write >= self.keep_alive_s / 2:
+                self._send(MQTTPacket.create_pingreq())
+
+    ###########################################################################
+    # Writing
+
+    def _send(self, packet):
+        """Queue a packet, everything queued in this pass of the event loop is written as one buffer."""
+        self.write_queue.append(packet)
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+
+        if self.write_queue and self.writer:
+            packets, self.write_queue = self.write_queue, []
+            self.writer.write(MQTTPacket.encode_batch(packets, protocol_level=self.protocol_level))
+            self.last_write = asyncio.get_running_loop().time()
+
+    async def _drain(self):
+        if self.writer and self.writer.transport.get_write_buffer_size() > self.HIGH_WATER:
+            await self.writer.drain()
+
+    def _next_pid(self):
+        # 1..65535, skipping ids still in use
+        while True:
+            self.pid = self.pid % 0xFFFF + 1
+            if self.pid not in self.inflight and self.pid not in self.pending:
+                return self.pid
+
+    async def publish(self, topic, payload, qos=0, retain=0, properties=None):
+        """QoS 0: returns once queued. QoS 1/2: returns once acknowledged (PUBACK/PUBCOMP)."""
+        if not self.is_connected:
+            raise MQTTDisconnectError("[MQTTClient] Not connected!")
+        elif qos not in WillQoS.CHECK_VALID:
+            raise MQTTPacketException("[MQTTClient] Invalid QoS {0}!".format(qos))
+
+        flags = ControlPacketType.PublishFlags(DUP=0, QoS=qos, RETAIN=retain)
+
+        if qos == WillQoS.QoS_0:
+            self._send(MQTTPacket.create_publish(flags, b"", Bits.str_to_bytes(topic),
+                                                 Bits.str_to_bytes(payload), properties))
+            await self._drain()
+            return
+
+        async with self.window:
+            pid    = self._next_pid()
+            future = asyncio.get_running_loop().create_future()
+            packet = MQTTPacket.create_publish(flags, Bits.pack(pid, 2), Bits.str_to_bytes(topic),
+                                               Bits.str_to_bytes(payload), properties)
+
+            self.inflight[pid] = [future, packet,
+                                  ControlPacketType.PUBACK if qos == WillQoS.QoS_1 else ControlPacketType.PUBREC]
+            self._send(packet)
+            await self._drain()
+            await future
+
+    async def subscribe(self, topics, qos=0):
+        """topics: a topic filter, or { topic filter: QoS }. Returns the SUBACK return codes."""
+        if isinstance(topics, (str, bytes)):
+            topics = { topics: qos }
+
+        pid    = self._next_pid()
+        future = self.pending[pid] = asyncio.get_running_loop().create_future()
+        self._send(MQTTPacket.create_subscribe(Bits.pack(pid, 2), topics, protocol_level=self.protocol_level))
+
+        codes = await future
+        if SUBACKReturnCode.FAILURE in codes:
+            raise MQTTTopicException("[MQTTClient] Subscription refused: {0}".format(
+                [topic for topic, code in zip(topics, codes) if code == SUBACKReturnCode.FAILURE]))
+        return codes
+
+    async def unsubscribe(self, topics):
+        if isinstance(topics, (str, bytes)):
+            topics = [topics]
+
+        pid    = self._next_pid()
+        future = self.pending[pid] = asyncio.get_running_loop().create_future()
+        self._send(MQTTPacket.create_unsubscribe(Bits.pack(pid, 2), topics, protocol_level=self.protocol_level))
+        await future
+
+    def add_handler(self, topic_filter, callback):
+        """
+        Call callback(message) for messages matching the filter, instead of
+        queueing them for `async for`. Coroutine functions run as a task.
+        """
+        self.handlers.append((Bits.bytes_to_str(topic_filter), callback))
+
+    ###########################################################################
+    # Reading
+
+    async def _read_packet(self):
+        header    = await self.reader.readexactly(1)
+        len_bytes = bytearray()
+
+        while True:
+            bb = await self.reader.readexactly(1)
+            len_bytes.extend(bb)
+            if (bb[0] & 128) == 0:
+                break
+
+        length, _ = MQTTPacket._get_length_from_bytes(len_bytes)
+        body      = await self.reader.readexactly(length) if length else b""
+
+        return MQTTPacket.from_bytes(header + bytes(len_bytes) + body, protocol_level=self.protocol_level)
+
+    async def _read_loop(self):
+        error = None
+
+        try:
+            while True:
+                self._handle(await self._read_packet())
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            error = MQTTDisconnectError("[MQTTClient] Connection closed by broker!")
+        except (MQTTPacketException, MQTTDisconnectError, OSError) as e:
+            error = e
+
+        self._close(error)
+
+    def _handle(self, packet):
+        ptype = packet.ptype
+
+        if ptype == ControlPacketType.CONNACK:
+            session_present, code = packet.payload[0] & 1, packet.payload[1]
+            if code != 0:
+                self.connack.set_exception(MQTTDisconnectError("[MQTTClient] Connection refused ({0})!".format(code),
+                                                               code=code))
+            else:
+                self.connack.set_result(bool(session_present))
+        elif ptype == ControlPacketType.PUBLISH:
+            self._handle_publish(packet)
+        elif ptype == ControlPacketType.PUBREL:
+            pid = Bits.unpack(packet.packet_id)
+            self.rcv_qos2.discard(pid)
+            self._send(MQTTPacket.create_pubcomp(packet.packet_id))
+        elif ptype in (ControlPacketType.PUBACK, ControlPacketType.PUBREC, ControlPacketType.PUBCOMP):
+            self._handle_ack(ptype, packet.packet_id)
+        elif ptype in (ControlPacketType.SUBACK, ControlPacketType.UNSUBACK):
+            future = self.pending.pop(Bits.unpack(packet.packet_id), None)
+            if future and not future.done():
+                # SUBACK return codes (after the properties in MQTT 5)
+                codes = packet.payload
+                if self.protocol_level == ProtocolLevel.MQTT_5 and codes:
+                    _, offset = Properties.parse(codes)
+                    codes = codes[offset:]
+                future.set_result(list(codes))
+
+    def _handle_ack(self, ptype, packet_id):
+        pid   = Bits.unpack(packet_id)
+        entry = self.inflight.get(pid)
+
+        if not entry or entry[2] != ptype:
+            return
+
+        if ptype == ControlPacketType.PUBREC:
+            # QoS 2, part 2
+            entry[2] = ControlPacketType.PUBCOMP
+            self._send(MQTTPacket.create_pubrel(packet_id))
+            return
+
+        del self.inflight[pid]
+        if not entry[0].done():
+            entry[0].set_result(None)
+
+    def _handle_publish(self, packet):
+        qos = packet.pflag.qos
+
+        if qos == WillQoS.QoS_1:
+            self._send(MQTTPacket.create_puback(packet.packet_id))
+        elif qos == WillQoS.QoS_2:
+            self._send(MQTTPacket.create_pubrec(packet.packet_id))
+
+            pid = Bits.unpack(packet.packet_id)
+            if pid in self.rcv_qos2:
+                # Resent before our PUBREC arrived, already delivered
+                return
+            self.rcv_qos2.add(pid)
+
+        self._dispatch(MQTTMessage(packet.topic, packet.payload, qos, packet.pflag.retain, packet.properties))
+
+    def _dispatch(self, message):
+        handled = False
+
+        for topic_filter, callback in self.handlers:
+            if TopicMatcher(topic_filter).matches(message.topic):
+                handled = True
+                if asyncio.iscoroutinefunction(callback):
+                    asyncio.ensure_future(callback(message))
+                else:
+                    callback(message)
+
+        if not handled:
+            self.messages.put_nowait(message)
 
 
 ##########################################################################################
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    # Print everything published on a topic filter: python3 -m mqtt.mqtt_client [host] [port] [filter]
+    async def main(host, port, topic_filter):
+        async with MQTTClient("mqtt_client.py", host=host, port=port) as client:
+            await client.subscribe(topic_filter)
+            async for message in client:
+                print(message)
+
+    try:
+        asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1",
+                         int(sys.argv[2]) if len(sys.argv) > 2 else MQTTClient.PORT,
+                         sys.argv[3] if len(sys.argv) > 3 else "#"))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,87 @@
+import heapq
+import time
+import weakref
+
+from mqtt.mqtt_threading import Threading
+
+class ExpiryQueue:
+    """
+    Min-heap of message deadlines, shared by all queues of the broker.
+
+    Every entry keeps a weak reference to its packet and the callback that
+    evicts it from wherever it is stored. Entries are never removed from the
+    middle of the heap: a packet that left its queue in the meantime
+    (delivered, discarded or spilled) is cancelled, and a conflated one that
+    got a newer value is pushed again, so its old entry no longer matches the
+    packet's `expiry_entry` and is skipped in O(1) when it reaches the top.
+    This keeps both push and pop at O(log n). Only a packet that really
+    expires while queued is looked up in its client queue, by the callback.
+
+    `expiry_deadline` itself is kept, a delivered packet that is resent still
+    forwards its remaining lifetime.
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock    = Threading.new_lock()
+        self.heap    = []  # [ (deadline, seq, weakref(packet), on_expire) ]
+        self.seq     = 0   # Tie breaker, packets themselves are not comparable
+        self.evicted = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def push(self, packet, deadline, on_expire):
+        """Schedule on_expire(packet) at deadline (time.time() based)."""
+        with self.lock:
+            self.seq += 1
+            packet.expiry_deadline = deadline
+            packet.expiry_entry    = self.seq
+            heapq.heappush(self.heap, (deadline, self.seq, weakref.ref(packet), on_expire))
+
+    def next_deadline(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now=None):
+        """Remove and return [ (packet, on_expire) ] for every live entry past its deadline."""
+        now = now or time.time()
+        expired = []
+
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, seq, ref, on_expire = heapq.heappop(self.heap)
+                packet = ref()
+
+                if packet is not None and packet.expiry_entry == seq:
+                    packet.expiry_entry = None
+                    expired.append((packet, on_expire))
+
+        return expired
+
+    def evict(self, now=None):
+        """Call the eviction callback of every expired packet, returns the number evicted."""
+        count = 0
+
+        for packet, on_expire in self.pop_expired(now):
+            if on_expire(packet):
+                count += 1
+
+        self.evicted += count
+        return count
+
+    @staticmethod
+    def cancel(packet):
+        """The packet left the queue it expires from, its heap entry is skipped."""
+        packet.expiry_entry = None
+
+    @staticmethod
+    def remaining(packet, now=None):
+        """Seconds (rounded up) until the packet expires, None if it never does."""
+        if packet.expiry_deadline is None:
+            return None
+        return max(0, int(packet.expiry_deadline - (now or time.time()) + 0.999))
+
+    @staticmethod
+    def is_expired(packet, now=None):
+        return packet.expiry_deadline is not None and packet.expiry_deadline <= (now or time.time())
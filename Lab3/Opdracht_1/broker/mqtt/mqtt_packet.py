@@ -1,14 +1,20 @@
+import struct
+
 from mqtt.bits import Bits
 from mqtt.colours import *
 from mqtt.mqtt_packet_types import *
 from mqtt.mqtt_exceptions import *
+from mqtt.mqtt_properties import Properties
 from mqtt.mqtt_subscription import TopicSubscription
 from mqtt.topic_matcher import TopicMatcher
 
+_U8  = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+
 class MQTTPacket:
     PROTOCOL_NAME = b"MQTT"
 
-    def __init__(self, raw=b""):
+    def __init__(self, raw=b"", protocol_level=ProtocolLevel.MQTT_3_1_1):
         super().__init__()
 
         self.ptype = 0
@@ -19,6 +25,11 @@ class MQTTPacket:
         self.packet_id = b""
         self.payload   = b""
 
+        self.protocol_level = protocol_level
+        self.properties     = {}  # { PropertyType: value } (MQTT 5 only)
+        self.expiry_deadline = None  # time.time() after which an undelivered copy is discarded
+        self.expiry_entry    = None  # Sequence number of its live ExpiryQueue entry
+
         if raw:
             self._parse(raw)
 
@@ -31,6 +42,8 @@ class MQTTPacket:
             attr.append("id={0}".format(self.packet_id))
         if self.length:
             attr.append("len={0}".format(self.length))
+        if self.properties:
+            attr.append("props={0}".format(self.properties))
         text = "<{0}{1}>" \
             .format(self.name(), " " + ", ".join(attr) if attr else "")
 
@@ -85,6 +98,36 @@ class MQTTPacket:
 
         return length, payload_offset
 
+    @staticmethod
+    def read_frame(stream):
+        """
+        Read one complete frame (fixed header + remaining length + rest)
+        from a file-like stream. Returns b"" at the end of the stream.
+        """
+        header = stream.read(1)
+        if not header:
+            return b""
+
+        len_bytes = bytearray()
+
+        while True:
+            bb = stream.read(1)
+            if not bb:
+                raise MQTTPacketException("[MQTTPacket::read_frame] Truncated frame header!")
+
+            len_bytes.extend(bb)
+
+            if (bb[0] & 128) == 0:
+                break
+
+        length, _ = MQTTPacket._get_length_from_bytes(len_bytes)
+        payload   = stream.read(length)
+
+        if len(payload) != length:
+            raise MQTTPacketException("[MQTTPacket::read_frame] Truncated frame payload!")
+
+        return header + bytes(len_bytes) + payload
+
     def _extract_next_field(self, length=0, length_bytes=2):
         """For parsing only"""
         if not length:
@@ -101,6 +144,14 @@ class MQTTPacket:
             return 0, None
 
 
+    def _is_v5(self):
+        return self.protocol_level == ProtocolLevel.MQTT_5
+
+    def _extract_properties(self):
+        """For parsing only: MQTT 5 property list at the start of the remaining payload."""
+        self.properties, offset = Properties.parse(self.payload)
+        self.payload = self.payload[offset:]
+
     def _includes_packet_identifier(self):
         # PUBLISH also contains id, but after topic, so not until payload itself
         return self.ptype in ControlPacketType.CHECK_HAS_PACKET_ID
@@ -125,20 +176,24 @@ class MQTTPacket:
             self.payload   = self.payload[2:]
 
     @staticmethod
-    def from_bytes(raw, expected_type=None):
+    def from_bytes(raw, expected_type=None, protocol_level=ProtocolLevel.MQTT_3_1_1):
         packet_type, packet_flags = MQTTPacket._parse_type(raw)
 
         packet_adaptor = {
             ControlPacketType.CONNECT     : Connect,
+            ControlPacketType.CONNACK     : MQTTPacket,
             ControlPacketType.PUBLISH     : Publish,
             ControlPacketType.SUBSCRIBE   : Subscribe,
+            ControlPacketType.SUBACK      : MQTTPacket,
             ControlPacketType.UNSUBSCRIBE : Unsubscribe,
+            ControlPacketType.UNSUBACK    : MQTTPacket,
             ControlPacketType.PUBACK      : MQTTPacket,
             ControlPacketType.PUBREC      : MQTTPacket,
             ControlPacketType.PUBREL      : MQTTPacket,
             ControlPacketType.PUBCOMP     : MQTTPacket,
 
             ControlPacketType.PINGREQ     : MQTTPacket,
+            ControlPacketType.PINGRESP    : MQTTPacket,
 
             ControlPacketType.DISCONNECT  : MQTTPacket,
         }
@@ -149,7 +204,7 @@ class MQTTPacket:
             raise MQTTPacketException("[MQTTPacket::from_bytes] Unimplemented packet received! ({0})"
                                         .format(ControlPacketType.to_string(packet_type)))
 
-        return packet_adaptor.get(packet_type, MQTTPacket)(raw)
+        return packet_adaptor.get(packet_type, MQTTPacket)(raw, protocol_level=protocol_level)
 
     @classmethod
     def create(cls, ptype, pflags, payload=bytes()):
@@ -186,12 +241,17 @@ class MQTTPacket:
         return packet
 
     @staticmethod
-    def create_connack(session_present, status_code):
-        return MQTTPacket.create(ControlPacketType.CONNACK, ControlPacketType.Flags.CONNACK,
-                                 bytes((Bits.bit(0, session_present), status_code)))
+    def create_connack(session_present, status_code, properties=None):
+        """If properties is not None, an MQTT 5 CONNACK is created."""
+        payload = bytes((Bits.bit(0, session_present), status_code))
+
+        if properties is not None:
+            payload += Properties.encode(properties)
+
+        return MQTTPacket.create(ControlPacketType.CONNACK, ControlPacketType.Flags.CONNACK, payload)
 
     @staticmethod
-    def create_publish(flags, packet_id, topic_name, payload):
+    def create_publish(flags, packet_id, topic_name, payload, properties=None):
         if not isinstance(flags, ControlPacketType.PublishFlags):
             raise MQTTPacketException("[MQTTPacket::create_publish] Invalid PublishFlags?")
 
@@ -201,8 +261,82 @@ class MQTTPacket:
         packet.packet_id = packet_id
         packet.topic     = topic_name
         packet.payload   = payload
+        packet.properties = properties or {}
         return packet
 
+    @staticmethod
+    def create_connect(client_id, clean=1, keep_alive_s=60, will_topic=b"", will_msg=b"", will_qos=0, will_retain=0,
+                       username=b"", password=b"", protocol_level=ProtocolLevel.MQTT_3_1_1, properties=None,
+                       will_properties=None):
+        will = 1 if will_topic else 0
+
+        packet = Connect(protocol_level=protocol_level)
+        packet.ptype           = ControlPacketType.CONNECT
+        packet.pflag           = ControlPacketType.Flags.CONNECT
+        packet.protocol_name   = MQTTPacket.PROTOCOL_NAME
+        packet.protocol_level  = protocol_level
+        packet.connect_flags   = Connect.ConnectFlags(reserved=0, clean=clean, will=will,
+                                                      will_qos=will_qos if will else 0,
+                                                      will_ret=will_retain if will else 0,
+                                                      passw=1 if password else 0,
+                                                      usr_name=1 if username else 0)
+        packet.keep_alive_s    = keep_alive_s
+        packet.packet_id       = Bits.str_to_bytes(client_id)  # Client id, like a parsed CONNECT
+        packet.will_topic      = Bits.str_to_bytes(will_topic)
+        packet.will_msg        = Bits.str_to_bytes(will_msg)
+        packet.username        = Bits.str_to_bytes(username)
+        packet.password        = Bits.str_to_bytes(password)
+        packet.properties      = properties or {}
+        packet.will_properties = will_properties or {}
+
+        if not packet.connect_flags.is_valid():
+            raise MQTTPacketException("[MQTTPacket::create_connect] Invalid connect flags {0}!".format(packet.connect_flags))
+        return packet
+
+    @staticmethod
+    def create_subscribe(packet_id, topics, protocol_level=ProtocolLevel.MQTT_3_1_1, properties=None):
+        """topics is a { topic filter: QoS } dict or a list of (topic filter, QoS), in order."""
+        packet = Subscribe(protocol_level=protocol_level)
+        packet.ptype      = ControlPacketType.SUBSCRIBE
+        packet.pflag      = ControlPacketType.Flags.SUBSCRIBE
+        packet.packet_id  = Bits.pad_bytes(packet_id, 2)
+        packet.properties = properties or {}
+
+        for order, (topic, qos) in enumerate(topics.items() if isinstance(topics, dict) else topics):
+            if qos not in WillQoS.CHECK_VALID:
+                raise MQTTPacketException("[MQTTPacket::create_subscribe] Invalid QoS {0} for '{1}'!".format(qos, topic))
+            sub = TopicSubscription(order, Bits.bytes_to_str(topic), qos)
+            packet.topics[sub.topic] = sub
+
+        if not packet.topics:
+            # [MQTT-3.8.3-3]
+            raise MQTTPacketException("[MQTTPacket::create_subscribe] At least one topic is required!")
+        return packet
+
+    @staticmethod
+    def create_unsubscribe(packet_id, topics, protocol_level=ProtocolLevel.MQTT_3_1_1, properties=None):
+        packet = Unsubscribe(protocol_level=protocol_level)
+        packet.ptype      = ControlPacketType.UNSUBSCRIBE
+        packet.pflag      = ControlPacketType.Flags.UNSUBSCRIBE
+        packet.packet_id  = Bits.pad_bytes(packet_id, 2)
+        packet.properties = properties or {}
+        packet.topics     = [Bits.bytes_to_str(topic) for topic in topics]
+
+        if not packet.topics:
+            # [MQTT-3.10.3-2]
+            raise MQTTPacketException("[MQTTPacket::create_unsubscribe] At least one topic is required!")
+        return packet
+
+    @staticmethod
+    def create_disconnect(reason_code=None, properties=None):
+        """If reason_code is not None, an MQTT 5 DISCONNECT is created."""
+        payload = b""
+
+        if reason_code is not None:
+            payload = bytes((reason_code,)) + Properties.encode(properties)
+
+        return MQTTPacket.create(ControlPacketType.DISCONNECT, ControlPacketType.Flags.DISCONNECT, payload)
+
     @staticmethod
     def create_puback(packet_id):
         packet_id = Bits.pad_bytes(packet_id, 2)
@@ -224,7 +358,7 @@ class MQTTPacket:
         return MQTTPacket.create(ControlPacketType.PUBCOMP, ControlPacketType.Flags.PUBCOMP, packet_id)
 
     @classmethod
-    def create_suback(cls, packet_id, topics_dict):
+    def create_suback(cls, packet_id, topics_dict, protocol_level=ProtocolLevel.MQTT_3_1_1):
         packet = cls()
         packet.ptype = ControlPacketType.SUBACK
         packet.pflag = ControlPacketType.Flags.SUBACK
@@ -235,6 +369,9 @@ class MQTTPacket:
         # [MQTT-3.8.4-2] Same Packet Identifier as the SUBSCRIBE Packet
         content.extend(Bits.pad_bytes(packet_id, 2))
 
+        if protocol_level == ProtocolLevel.MQTT_5:
+            content.extend(Properties.encode(None))
+
         for sub in sorted(topics_dict.values()):
             # Assume success
             content.append(sub.qos if sub.qos in SUBACKReturnCode.CHECK_VALID else SUBACKReturnCode.FAILURE)
@@ -245,9 +382,16 @@ class MQTTPacket:
         return packet
 
     @staticmethod
-    def create_unsuback(packet_id):
-        packet_id = Bits.pad_bytes(packet_id, 2)
-        return MQTTPacket.create(ControlPacketType.UNSUBACK, ControlPacketType.Flags.UNSUBACK, packet_id)
+    def create_unsuback(packet_id, reason_codes=None):
+        """If reason_codes is not None, an MQTT 5 UNSUBACK is created."""
+        payload = Bits.pad_bytes(packet_id, 2)
+
+        if reason_codes is not None:
+            payload += Properties.encode(None) + bytes(reason_codes)
+
+        packet = MQTTPacket.create(ControlPacketType.UNSUBACK, ControlPacketType.Flags.UNSUBACK, payload)
+        packet.packet_id = packet_id
+        return packet
 
     @staticmethod
     def create_pingreq():
@@ -257,16 +401,81 @@ class MQTTPacket:
     def create_pingresp():
         return MQTTPacket.create(ControlPacketType.PINGRESP, ControlPacketType.Flags.PINGRESP)
 
-    # TODO Other packets
+    ###########################################################################
+    # Encoding
+    #
+    # Every packet type lists its variable header and payload as fields,
+    # (length prefixed, bytes), so the size is known up front and packets are
+    # written into one preallocated buffer instead of concatenating bytes.
+
+    def _fields(self, protocol_level):
+        # Packets made with create() carry their variable header in the payload
+        return [(False, self.payload)]
+
+    def _first_byte(self):
+        return self.ptype | self.pflag
+
+    @staticmethod
+    def _fields_size(fields):
+        return sum(len(data) + 2 if prefixed else len(data) for prefixed, data in fields)
+
+    def _write(self, buf, offset, fields, length):
+        """Write the fixed header (with remaining length) and fields at offset, returns the offset after them."""
+        _U8.pack_into(buf, offset, self._first_byte())
+        offset += 1
+
+        len_bytes = self._create_length_bytes(length)
+        buf[offset:offset + len(len_bytes)] = len_bytes
+        offset += len(len_bytes)
+
+        for prefixed, data in fields:
+            if prefixed:
+                _U16.pack_into(buf, offset, len(data))
+                offset += 2
+            buf[offset:offset + len(data)] = data
+            offset += len(data)
+
+        return offset
+
+    def _encode(self, fields, length=None):
+        """Encode into a new buffer, length is the remaining length if fields is not the whole packet."""
+        size        = self._fields_size(fields)
+        self.length = size if length is None else length
+
+        buf = bytearray(1 + len(self._create_length_bytes(self.length)) + size)
+        self._write(buf, 0, fields, self.length)
+        return buf
+
+    def encoded_size(self, protocol_level=None):
+        length = self._fields_size(self._fields(protocol_level or self.protocol_level))
+        return 1 + len(self._create_length_bytes(length)) + length
+
+    def encode_into(self, buf, offset=0, protocol_level=None):
+        """Encode into a (large enough) bytearray or memoryview at offset, returns the offset after the packet."""
+        fields      = self._fields(protocol_level or self.protocol_level)
+        self.length = self._fields_size(fields)
+        return self._write(buf, offset, fields, self.length)
+
+    @staticmethod
+    def encode_batch(packets, protocol_level=None):
+        """Encode packets back to back into one contiguous bytearray, e.g. to send them at once."""
+        encoded, total = [], 0
+
+        for packet in packets:
+            fields = packet._fields(protocol_level or packet.protocol_level)
+            packet.length = MQTTPacket._fields_size(fields)
+            total += 1 + len(MQTTPacket._create_length_bytes(packet.length)) + packet.length
+            encoded.append((packet, fields))
+
+        buf, offset = bytearray(total), 0
+
+        for packet, fields in encoded:
+            offset = packet._write(buf, offset, fields, packet.length)
 
-    def to_bin(self):
-        data = bytearray()
-        data.append(self.ptype | self.pflag)
-        if self.length >= 0:
-            # If length is given, encode it, else assume its already in payload
-            data.extend(self._create_length_bytes(self.length))
-        data.extend(self.payload)
-        return bytes(data)
+        return buf
+
+    def to_bin(self, protocol_level=None):
+        return bytes(self._encode(self._fields(protocol_level or self.protocol_level)))
 
 
 
@@ -317,8 +526,8 @@ class Connect(MQTTPacket):
 
             return style("<{0}>".format(", ".join(flags)), Colours.FG.CYAN)
 
-    def __init__(self, raw=b''):
-        super().__init__(raw=raw)
+    def __init__(self, raw=b'', protocol_level=ProtocolLevel.MQTT_3_1_1):
+        super().__init__(raw=raw, protocol_level=protocol_level)
         # Connect header
         self.protocol_name_length = 0
         self.protocol_name        = b""
@@ -333,6 +542,8 @@ class Connect(MQTTPacket):
         self.username   = b""
         self.password   = b""
 
+        self.will_properties = {}
+
         if raw:
             self._parse_payload()
 
@@ -362,6 +573,10 @@ class Connect(MQTTPacket):
 
         self.payload = self.payload[4:]
 
+        # The CONNECT packet itself decides the protocol level of the connection
+        if self._is_v5():
+            self._extract_properties()
+
         # Client ID (1...23 length, or 0 length => assign unique)
         # if len == 0: assign unique and check if clean flag == 0
         #      if clean flag == 0: respond with CONNACK return code 0x02 (Identifier rejected) and close conn
@@ -369,6 +584,10 @@ class Connect(MQTTPacket):
 
         # Will topic
         if self.connect_flags.will:
+            if self._is_v5():
+                self.will_properties, offset = Properties.parse(self.payload)
+                self.payload = self.payload[offset:]
+
             _, self.will_topic = self._extract_next_field()
 
             # Will message
@@ -420,12 +639,36 @@ class Connect(MQTTPacket):
                 raise MQTTDisconnectError("[MQTTPacket::Connect] Username flag is 0, but password flag is set!")
 
     def is_valid_protocol_level(self):
-        """TODO If False, respond with CONNACK 0x01 : Unacceptable protocol level and disconnect."""
-        return self.protocol_level == 4
+        """If False, respond with CONNACK 0x01 : Unacceptable protocol level and disconnect."""
+        return self.protocol_level in ProtocolLevel.CHECK_VALID
+
+    def _fields(self, protocol_level):
+        # The CONNECT itself decides the protocol level
+        is_v5 = self.protocol_level == ProtocolLevel.MQTT_5
+        flags = self.connect_flags
+
+        fields = [(True,  self.protocol_name or MQTTPacket.PROTOCOL_NAME),
+                  (False, bytes((self.protocol_level,)) + flags.byte() + Bits.pack(self.keep_alive_s, 2))]
+
+        if is_v5:
+            fields.append((False, Properties.encode(self.properties)))
+
+        # Client id
+        fields.append((True, self.packet_id))
+
+        if flags.will:
+            if is_v5:
+                fields.append((False, Properties.encode(self.will_properties)))
+            fields.append((True, self.will_topic))
+            fields.append((True, self.will_msg))
 
-    def to_bin(self):
-        # TODO implement for MQTTClient
-        pass
+        if flags.usr_name:
+            fields.append((True, self.username))
+
+            if flags.passw:
+                fields.append((True, self.password))
+
+        return fields
 
     def __str__(self):
         attr = []
@@ -446,6 +689,8 @@ class Connect(MQTTPacket):
             attr.append("usr={0}".format(self.username))
         if self.password:
             attr.append("psw={0}".format(self.password))
+        if self.properties:
+            attr.append("props={0}".format(self.properties))
 
         text = style("<{0}".format(self.name()), Colours.FG.BLUE)
         if self.connect_flags:
@@ -460,8 +705,8 @@ class Connect(MQTTPacket):
         return text
 
 class Subscribe(MQTTPacket):
-    def __init__(self, raw=b''):
-        super().__init__(raw=raw)
+    def __init__(self, raw=b'', protocol_level=ProtocolLevel.MQTT_3_1_1):
+        super().__init__(raw=raw, protocol_level=protocol_level)
         self.topics = {}  # { topic: TopicSubscription(order, topic, qos) }
         if raw:
             self._parse_payload()
@@ -473,6 +718,9 @@ class Subscribe(MQTTPacket):
 
         # Already got packet_id, if there was one
 
+        if self._is_v5():
+            self._extract_properties()
+
         subscription_order = 0
 
         # Payload contains one or more topics followed by a QoS
@@ -491,6 +739,12 @@ class Subscribe(MQTTPacket):
             qos_len, qos = self._extract_next_field(1)
             qos = Bits.unpack(qos)
 
+            if self._is_v5():
+                # MQTT 5 Subscription Options: QoS in bits 0-1, bits 6-7 are reserved
+                if Bits.get(qos, 6, 2):
+                    raise MQTTDisconnectError("[MQTTPacket::Subscribe] Reserved subscription option bits set!")
+                qos = Bits.get(qos, 0, 2)
+
             if qos not in WillQoS.CHECK_VALID:
                 raise MQTTDisconnectError("[MQTTPacket::Subscribe] Malformed QoS!")
 
@@ -501,11 +755,24 @@ class Subscribe(MQTTPacket):
             # WARNING The order is important, SUBACK needs to send in same order
             sub = TopicSubscription(subscription_order, Bits.bytes_to_str(topic), qos)
             subscription_order += 1
+
+            if not sub.is_valid():
+                # Filter validated once here, an invalid one gets a SUBACK failure (0x80), the others are subscribed
+                sub.qos = SUBACKReturnCode.FAILURE
             self.topics[sub.topic] = sub
 
-    def to_bin(self):
-        # TODO implement for MQTTClient
-        pass
+    def _fields(self, protocol_level):
+        fields = [(False, Bits.pad_bytes(self.packet_id, 2))]
+
+        if protocol_level == ProtocolLevel.MQTT_5:
+            fields.append((False, Properties.encode(self.properties)))
+
+        # Same order as parsed (or created), SUBACK answers in that order
+        for sub in sorted(self.topics.values()):
+            fields.append((True,  Bits.str_to_bytes(sub.topic)))
+            fields.append((False, bytes((sub.qos,))))
+
+        return fields
 
     def __str__(self):
         attr = []
@@ -521,8 +788,8 @@ class Subscribe(MQTTPacket):
 
 
 class Unsubscribe(MQTTPacket):
-    def __init__(self, raw=b''):
-        super().__init__(raw=raw)
+    def __init__(self, raw=b'', protocol_level=ProtocolLevel.MQTT_3_1_1):
+        super().__init__(raw=raw, protocol_level=protocol_level)
         self.topics = []  # [ topics ]
         if raw:
             self._parse_payload()
@@ -538,6 +805,9 @@ class Unsubscribe(MQTTPacket):
         if (not self.packet_id or (self.packet_id and Bits.unpack(self.packet_id) == 0)):
             raise MQTTPacketException("[MQTTPacket::Unsubscribe] QoS level > 0, but no or zeroed Packet ID given!")
 
+        if self._is_v5():
+            self._extract_properties()
+
         # Payload contains one or more topics followed by a QoS
         while len(self.payload) > 0:
             # Get topic filter
@@ -552,9 +822,14 @@ class Unsubscribe(MQTTPacket):
 
             self.topics.append(Bits.bytes_to_str(topic))
 
-    def to_bin(self):
-        # TODO implement for MQTTClient
-        pass
+    def _fields(self, protocol_level):
+        fields = [(False, Bits.pad_bytes(self.packet_id, 2))]
+
+        if protocol_level == ProtocolLevel.MQTT_5:
+            fields.append((False, Properties.encode(self.properties)))
+
+        fields.extend((True, Bits.str_to_bytes(topic)) for topic in self.topics)
+        return fields
 
     def __str__(self):
         attr = []
@@ -569,8 +844,8 @@ class Unsubscribe(MQTTPacket):
                     Colours.FG.BLUE)
 
 class Publish(MQTTPacket):
-    def __init__(self, raw=b''):
-        super().__init__(raw=raw)
+    def __init__(self, raw=b'', protocol_level=ProtocolLevel.MQTT_3_1_1):
+        super().__init__(raw=raw, protocol_level=protocol_level)
         self.pflag = ControlPacketType.PublishFlags.from_byte(self.pflag)
         self.topic = b""
         if raw:
@@ -581,10 +856,16 @@ class Publish(MQTTPacket):
             raise MQTTDisconnectError("[MQTTPacket::Publish] Malformed packet (too short)!")
         topic_len, id_len = 0, 0
 
+        # Parse the header fields from a view, so the (possibly large) application
+        # message is only copied once, at the end, instead of once per field.
+        self.payload = memoryview(self.payload)
+
         topic_len, self.topic = self._extract_next_field()
+        self.topic = bytes(self.topic)
 
-        if topic_len < 1:
+        if topic_len < 1 and not self._is_v5():
             # [MQTT-4.7.3-1] Topic needs to be at least 1 byte long
+            # (MQTT 5 allows an empty topic if a Topic Alias is given, checked below)
             raise MQTTPacketException("[MQTTPacket::Publish] Topic must be at least 1 character long!")
 
         # [MQTT-3.3.2-2] Topic cannot contain wildcards
@@ -596,6 +877,7 @@ class Publish(MQTTPacket):
         if self.pflag.qos in (WillQoS.QoS_1, WillQoS.QoS_2):
             # TODO overrides client_id?
             id_len, self.packet_id = self._extract_next_field(length=2)
+            self.packet_id = bytes(self.packet_id)
 
             # [MQTT-2.3.1-1] If qos > 0 then packet_id (!= 0) is required
             if not self.packet_id or (self.packet_id and Bits.unpack(self.packet_id) == 0):
@@ -604,29 +886,54 @@ class Publish(MQTTPacket):
             # [MQTT-2.3.1-5]
             raise MQTTPacketException("[MQTTPacket::Publish] QoS level == 0, but Packed ID given! ({0})".format(self.packet_id))
 
+        if self._is_v5():
+            self._extract_properties()
+
+            if topic_len < 1 and not self.properties.get(PropertyType.TOPIC_ALIAS):
+                # [MQTT-3.3.2-8] Empty topic requires a Topic Alias
+                raise MQTTPacketException("[MQTTPacket::Publish] Topic must be at least 1 character long without Topic Alias!")
+
         if len(self.payload) == self.length - topic_len - id_len:
             print("[MQTTPacket::Publish] Expected size = {0}  vs  actual = {1}"
                     .format(self.length - topic_len - id_len, len(self.payload)))
 
-    def to_bin(self):
-        data = bytearray()
-        data.append(self.ptype | self.pflag.to_bin())
+        self.payload = bytes(self.payload)
 
-        msg = bytearray()
-        msg.extend(Bits.pack(len(self.topic), 2))
-        msg.extend(self.topic)
+    def _first_byte(self):
+        return self.ptype | self.pflag.to_bin()
 
-        if self.pflag.qos in (WillQoS.QoS_1, WillQoS.QoS_2):
-            msg.extend(Bits.pad_bytes(self.packet_id, 2))
-
-        if self.payload:
-            msg.extend(self.payload)
+    def _fields(self, protocol_level, topic=None, properties=None):
+        topic      = self.topic if topic is None else topic
+        properties = self.properties if properties is None else properties
 
-        self.length = len(msg)
-        data.extend(self._create_length_bytes(self.length))
-        data.extend(msg)
+        fields = [(True, topic)]
 
-        return bytes(data)
+        if self.pflag.qos in (WillQoS.QoS_1, WillQoS.QoS_2):
+            fields.append((False, Bits.pad_bytes(self.packet_id, 2)))
+
+        if protocol_level == ProtocolLevel.MQTT_5:
+            fields.append((False, Properties.encode(properties)))
+
+        # Application message, always last
+        fields.append((False, self.payload))
+        return fields
+
+    def to_bin(self, protocol_level=None, topic=None, properties=None):
+        """
+        The same packet can be sent to clients with different protocol levels,
+        so the level, topic and properties (e.g. Topic Alias) can be overridden.
+        """
+        return bytes(self._encode(self._fields(protocol_level or self.protocol_level, topic, properties)))
+
+    def to_bin_parts(self, protocol_level=None, topic=None, properties=None):
+        """
+        Like to_bin(), but returns (headers, payload) without joining them. The payload
+        is the packet's own (shared) bytes object, so it can be sent with scatter/gather
+        I/O without copying it for every subscriber.
+        """
+        fields = self._fields(protocol_level or self.protocol_level, topic, properties)
+        header = self._encode(fields[:-1], length=self._fields_size(fields))
+        return bytes(header), self.payload
 
     def __str__(self):
         attr = []
@@ -636,6 +943,8 @@ class Publish(MQTTPacket):
         if self.payload:
             attr.append("msg={0}".format(self.payload if len(self.payload) < 100 else \
                                            "({0} bytes)".format(len(self.payload))))
+        if self.properties:
+            attr.append("props={0}".format(self.properties))
 
         return style("<{0}".format(self.name()), Colours.FG.BLUE) \
              + str(self.pflag) \
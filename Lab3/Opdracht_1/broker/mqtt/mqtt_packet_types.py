@@ -161,3 +161,187 @@ class SUBACKReturnCode:
     FAILURE           = 0x80  # Failure
 
     CHECK_VALID = (SUCCESS_MAX_QoS_0, SUCCESS_MAX_QoS_1, SUCCESS_MAX_QoS_2)
+
+
+class ProtocolLevel:
+    MQTT_3_1_1 = 0x04
+    MQTT_5     = 0x05
+
+    CHECK_VALID = (MQTT_3_1_1, MQTT_5)
+
+
+class PropertyType:
+    """MQTT 5 property identifiers."""
+    PAYLOAD_FORMAT_INDICATOR  = 0x01  # Byte
+    MESSAGE_EXPIRY_INTERVAL   = 0x02  # Four Byte Integer
+    CONTENT_TYPE              = 0x03  # UTF-8 String
+    RESPONSE_TOPIC            = 0x08  # UTF-8 String
+    CORRELATION_DATA          = 0x09  # Binary Data
+    SUBSCRIPTION_IDENTIFIER   = 0x0B  # Variable Byte Integer
+    SESSION_EXPIRY_INTERVAL   = 0x11  # Four Byte Integer
+    ASSIGNED_CLIENT_ID        = 0x12  # UTF-8 String
+    SERVER_KEEP_ALIVE         = 0x13  # Two Byte Integer
+    AUTHENTICATION_METHOD     = 0x15  # UTF-8 String
+    AUTHENTICATION_DATA       = 0x16  # Binary Data
+    REQUEST_PROBLEM_INFO      = 0x17  # Byte
+    WILL_DELAY_INTERVAL       = 0x18  # Four Byte Integer
+    REQUEST_RESPONSE_INFO     = 0x19  # Byte
+    RESPONSE_INFORMATION      = 0x1A  # UTF-8 String
+    SERVER_REFERENCE          = 0x1C  # UTF-8 String
+    REASON_STRING             = 0x1F  # UTF-8 String
+    RECEIVE_MAXIMUM           = 0x21  # Two Byte Integer
+    TOPIC_ALIAS_MAXIMUM       = 0x22  # Two Byte Integer
+    TOPIC_ALIAS               = 0x23  # Two Byte Integer
+    MAXIMUM_QOS               = 0x24  # Byte
+    RETAIN_AVAILABLE          = 0x25  # Byte
+    USER_PROPERTY             = 0x26  # UTF-8 String Pair
+    MAXIMUM_PACKET_SIZE       = 0x27  # Four Byte Integer
+    WILDCARD_SUB_AVAILABLE    = 0x28  # Byte
+    SUBSCRIPTION_ID_AVAILABLE = 0x29  # Byte
+    SHARED_SUB_AVAILABLE      = 0x2A  # Byte
+
+    class Format:
+        BYTE        = 1
+        TWO_BYTES   = 2
+        FOUR_BYTES  = 4
+        VARINT      = 5
+        STRING      = 6
+        BINARY      = 7
+        STRING_PAIR = 8
+
+    FORMATS = {
+        PAYLOAD_FORMAT_INDICATOR  : Format.BYTE,
+        MESSAGE_EXPIRY_INTERVAL   : Format.FOUR_BYTES,
+        CONTENT_TYPE              : Format.STRING,
+        RESPONSE_TOPIC            : Format.STRING,
+        CORRELATION_DATA          : Format.BINARY,
+        SUBSCRIPTION_IDENTIFIER   : Format.VARINT,
+        SESSION_EXPIRY_INTERVAL   : Format.FOUR_BYTES,
+        ASSIGNED_CLIENT_ID        : Format.STRING,
+        SERVER_KEEP_ALIVE         : Format.TWO_BYTES,
+        AUTHENTICATION_METHOD     : Format.STRING,
+        AUTHENTICATION_DATA       : Format.BINARY,
+        REQUEST_PROBLEM_INFO      : Format.BYTE,
+        WILL_DELAY_INTERVAL       : Format.FOUR_BYTES,
+        REQUEST_RESPONSE_INFO     : Format.BYTE,
+        RESPONSE_INFORMATION      : Format.STRING,
+        SERVER_REFERENCE          : Format.STRING,
+        REASON_STRING             : Format.STRING,
+        RECEIVE_MAXIMUM           : Format.TWO_BYTES,
+        TOPIC_ALIAS_MAXIMUM       : Format.TWO_BYTES,
+        TOPIC_ALIAS               : Format.TWO_BYTES,
+        MAXIMUM_QOS               : Format.BYTE,
+        RETAIN_AVAILABLE          : Format.BYTE,
+        USER_PROPERTY             : Format.STRING_PAIR,
+        MAXIMUM_PACKET_SIZE       : Format.FOUR_BYTES,
+        WILDCARD_SUB_AVAILABLE    : Format.BYTE,
+        SUBSCRIPTION_ID_AVAILABLE : Format.BYTE,
+        SHARED_SUB_AVAILABLE      : Format.BYTE,
+    }
+
+    # Properties that may occur more than once, kept as a list of values
+    CHECK_REPEATABLE = (SUBSCRIPTION_IDENTIFIER, USER_PROPERTY)
+
+
+class ReasonCode:
+    """MQTT 5 reason codes (only those used by the broker)."""
+    SUCCESS                  = 0x00
+    NO_SUBSCRIPTION_EXISTED  = 0x11
+    UNSPECIFIED_ERROR        = 0x80
+    MALFORMED_PACKET         = 0x81
+    PROTOCOL_ERROR           = 0x82
+    UNSUPPORTED_PROT_VERSION = 0x84
+    ID_NOT_VALID             = 0x85
+    BAD_AUTH                 = 0x86
+    NOT_AUTHORISED           = 0x87
+    SERVER_UNAVAILABLE       = 0x88
+    PACKET_TOO_LARGE         = 0x95
+    RECEIVE_MAXIMUM_EXCEEDED = 0x93
+    TOPIC_ALIAS_INVALID      = 0x94
+
+    __FROM_RETURN_CODE = {
+        ReturnCode.ACCEPTED              : SUCCESS,
+        ReturnCode.UNACCEPTABLE_PROT_LVL : UNSUPPORTED_PROT_VERSION,
+        ReturnCode.ID_REJECTED           : ID_NOT_VALID,
+        ReturnCode.SERVICE_UNAVAILABLE   : SERVER_UNAVAILABLE,
+        ReturnCode.BAD_AUTH              : BAD_AUTH,
+        ReturnCode.NOT_AUTHORISED        : NOT_AUTHORISED,
+    }
+
+    @staticmethod
+    def from_return_code(code):
+        """Translate a 3.1.1 CONNACK return code into its MQTT 5 reason code."""
+        return ReasonCode.__FROM_RETURN_CODE.get(code, ReasonCode.UNSPECIFIED_ERROR)
+
+
+class SNMessageType:
+    """MQTT-SN v1.2 message types."""
+    ADVERTISE     = 0x00
+    SEARCHGW      = 0x01
+    GWINFO        = 0x02
+    CONNECT       = 0x04
+    CONNACK       = 0x05
+    WILLTOPICREQ  = 0x06
+    WILLTOPIC     = 0x07
+    WILLMSGREQ    = 0x08
+    WILLMSG       = 0x09
+    REGISTER      = 0x0A
+    REGACK        = 0x0B
+    PUBLISH       = 0x0C
+    PUBACK        = 0x0D
+    PUBCOMP       = 0x0E
+    PUBREC        = 0x0F
+    PUBREL        = 0x10
+    SUBSCRIBE     = 0x12
+    SUBACK        = 0x13
+    UNSUBSCRIBE   = 0x14
+    UNSUBACK      = 0x15
+    PINGREQ       = 0x16
+    PINGRESP      = 0x17
+    DISCONNECT    = 0x18
+
+    __STRINGS = {
+        ADVERTISE    : "ADVERTISE",
+        SEARCHGW     : "SEARCHGW",
+        GWINFO       : "GWINFO",
+        CONNECT      : "CONNECT",
+        CONNACK      : "CONNACK",
+        WILLTOPICREQ : "WILLTOPICREQ",
+        WILLTOPIC    : "WILLTOPIC",
+        WILLMSGREQ   : "WILLMSGREQ",
+        WILLMSG      : "WILLMSG",
+        REGISTER     : "REGISTER",
+        REGACK       : "REGACK",
+        PUBLISH      : "PUBLISH",
+        PUBACK       : "PUBACK",
+        PUBCOMP      : "PUBCOMP",
+        PUBREC       : "PUBREC",
+        PUBREL       : "PUBREL",
+        SUBSCRIBE    : "SUBSCRIBE",
+        SUBACK       : "SUBACK",
+        UNSUBSCRIBE  : "UNSUBSCRIBE",
+        UNSUBACK     : "UNSUBACK",
+        PINGREQ      : "PINGREQ",
+        PINGRESP     : "PINGRESP",
+        DISCONNECT   : "DISCONNECT",
+    }
+
+    @staticmethod
+    def to_string(mtype):
+        return SNMessageType.__STRINGS.get(mtype, "Unknown? ({0})".format(mtype))
+
+
+class SNReturnCode:
+    ACCEPTED          = 0x00
+    CONGESTION        = 0x01
+    INVALID_TOPIC_ID  = 0x02
+    NOT_SUPPORTED     = 0x03
+
+
+class SNTopicIdType:
+    """Bits 1-0 of the MQTT-SN flags."""
+    NORMAL     = 0x00  # Topic id (REGISTER/SUBACK), or topic name in SUBSCRIBE
+    PREDEFINED = 0x01  # Topic id known to both sides in advance
+    SHORT_NAME = 0x02  # Two character topic name
+
+    CHECK_VALID = (NORMAL, PREDEFINED, SHORT_NAME)
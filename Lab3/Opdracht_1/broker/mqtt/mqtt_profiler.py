@@ -0,0 +1,201 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+from mqtt.mqtt_threading import Threading
+
+class BrokerProfiler:
+    """
+    Profiles a running broker for a time window, without external tools.
+
+    - A sampling thread walks the stacks of all threads (sys._current_frames())
+      at `rate_hz` and counts them as collapsed stacks, one line per stack:
+          thread;outer_func (file:line);...;inner_func (file:line) count
+      which flamegraph.pl, speedscope, ... read directly.
+    - The packet handlers of the client threads are run under a cProfile per
+      thread (see run()), merged into one pstats summary when the window ends.
+
+    Overhead is bounded: the sample rate is capped at MAX_RATE_HZ, stacks at
+    MAX_DEPTH frames, cProfile only runs while a packet is handled, and
+    everything stops by itself after `duration_s`.
+    """
+    MAX_RATE_HZ = 1000
+    MAX_DEPTH   = 64
+    DRAIN_S     = 1.0  # Wait at most this long for handlers still being profiled
+
+    def __init__(self, output_dir, rate_hz=100, duration_s=30, use_cprofile=True, on_done=None):
+        super().__init__()
+        self.output_dir   = output_dir
+        self.interval_s   = 1.0 / min(max(1, rate_hz), self.MAX_RATE_HZ)
+        self.duration_s   = duration_s
+        self.use_cprofile = use_cprofile
+        self.on_done      = on_done  # on_done(profiler), when the results are written
+
+        self.lock       = Threading.new_lock()
+        self.is_active  = False
+        self.is_writing = False  # Last window's results are still being written
+        self.stacks     = {}  # { collapsed stack: samples }
+        self.samples    = 0
+        self.sample_s   = 0.0  # Time spent sampling, to report the overhead
+        self.profiles   = {}  # { thread id: cProfile.Profile } of this session
+        self.busy       = 0   # Handlers being profiled right now
+        self.skipped    = 0   # Handlers not profiled (another profiler active)
+        self.started_at = None
+        self.stopped_at = None
+        self.files      = []  # Output files of the last window
+
+    def start(self, duration_s=None):
+        """Start a profiling window, returns False if one is already running."""
+        with self.lock:
+            if self.is_active or self.is_writing:
+                return False
+
+            self.is_active  = True
+            self.is_writing = True
+            self.stacks     = {}
+            self.samples    = 0
+            self.sample_s   = 0.0
+            self.profiles   = {}
+            self.skipped    = 0
+            self.started_at = time.time()
+            self.stopped_at = None
+
+        Threading.new_thread(self._sample, (duration_s or self.duration_s,))
+        return True
+
+    def stop(self):
+        """End the window early, the results are written by the sampling thread."""
+        with self.lock:
+            self.is_active = False
+
+    ###########################################################################
+    # cProfile of the handlers
+
+    def run(self, func, *args):
+        """Call func(*args), under this thread's cProfile while a window is active."""
+        with self.lock:
+            if not self.is_active or not self.use_cprofile:
+                profile = None
+            else:
+                profile = self.profiles.get(Threading.get_current_id())
+                if profile is None:
+                    profile = self.profiles[Threading.get_current_id()] = cProfile.Profile()
+                self.busy += 1
+
+        if profile is None:
+            return func(*args)
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active profiler, e.g. a debugger
+            with self.lock:
+                self.skipped += 1
+                self.busy    -= 1
+            return func(*args)
+
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                self.busy -= 1
+
+    ###########################################################################
+    # Sampling
+
+    def _frame_name(self, code, lineno):
+        return "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), lineno)
+
+    def _collapse(self, thread_name, frame):
+        names = []
+        while frame is not None and len(names) < self.MAX_DEPTH:
+            names.append(self._frame_name(frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        names.append(thread_name.replace(" ", "_"))
+        return ";".join(reversed(names))
+
+    def _sample(self, duration_s):
+        me  = Threading.get_current_id()
+        end = time.time() + duration_s
+
+        while self.is_active and time.time() < end:
+            start  = time.time()
+            names  = { t.ident: t.name for t in threading.enumerate() }
+            frames = sys._current_frames()
+
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = self._collapse(names.get(ident, str(ident)), frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+            del frames
+            self.samples  += 1
+            self.sample_s += time.time() - start
+            time.sleep(max(0, self.interval_s - (time.time() - start)))
+
+        self.stop()
+        self.stopped_at = time.time()
+        try:
+            self._write()
+        finally:
+            self.is_writing = False
+
+        if self.on_done:
+            self.on_done(self)
+
+    ###########################################################################
+    # Output
+
+    def _merged_stats(self):
+        # Profiles are only merged once no handler is running under them
+        deadline = time.time() + self.DRAIN_S
+        while self.busy and time.time() < deadline:
+            time.sleep(0.01)
+
+        stats = None
+        for profile in self.profiles.values():
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # Nothing was recorded by this thread
+                continue
+        return stats
+
+    def _write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, "profile-{0}".format(time.strftime("%Y%m%d-%H%M%S")))
+        self.files = []
+
+        with open(prefix + ".folded", "w") as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write("{0} {1}\n".format(stack, count))
+        self.files.append(prefix + ".folded")
+
+        stats = self._merged_stats() if self.use_cprofile else None
+        if stats:
+            stats.dump_stats(prefix + ".pstats")
+
+            text = io.StringIO()
+            stats.stream = text
+            stats.sort_stats("cumulative").print_stats(40)
+
+            with open(prefix + ".txt", "w") as fp:
+                fp.write(self.summary() + "\n\n")
+                fp.write(text.getvalue())
+            self.files += [prefix + ".pstats", prefix + ".txt"]
+
+    def summary(self):
+        wall_s = (self.stopped_at or time.time()) - self.started_at if self.started_at else 0
+        return "{0} samples in {1:.1f}s ({2} stacks), sampling took {3:.2%} of one core, " \
+               "{4} thread profile(s){5}".format(
+                   self.samples, wall_s, len(self.stacks), self.sample_s / wall_s if wall_s else 0,
+                   len(self.profiles), ", {0} handlers not profiled".format(self.skipped) if self.skipped else "")
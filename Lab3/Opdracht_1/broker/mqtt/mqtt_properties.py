@@ -0,0 +1,188 @@
+from mqtt.bits import Bits
+from mqtt.mqtt_packet_types import PropertyType, ReasonCode
+from mqtt.mqtt_exceptions import *
+
+class Properties:
+    """Parse and encode MQTT 5 property lists: { PropertyType: value }."""
+
+    @staticmethod
+    def encode_varint(value):
+        if value > 268435455:
+            raise MQTTPacketException("[Properties] Variable byte integer too large!")
+
+        data = bytearray()
+
+        while True:
+            enc, value = value % 128, value // 128
+
+            if value:
+                enc |= 128
+
+            data.append(enc)
+
+            if not value:
+                break
+
+        return bytes(data)
+
+    @staticmethod
+    def decode_varint(data, offset=0):
+        value, mult = 0, 1
+
+        while True:
+            if offset >= len(data):
+                raise MQTTDisconnectError("[Properties] Malformed variable byte integer!")
+
+            enc = data[offset]
+            offset += 1
+
+            value += (enc & 127) * mult
+            mult  *= 128
+
+            if mult > 2097152 * 128:
+                raise MQTTDisconnectError("[Properties] Malformed variable byte integer!")
+
+            if (enc & 128) == 0:
+                break
+
+        return value, offset
+
+    @staticmethod
+    def parse(data, offset=0):
+        """
+        Parse a property list (length prefixed) starting at offset.
+        Returns the properties and the offset right after the list.
+        """
+        length, offset = Properties.decode_varint(data, offset)
+        end = offset + length
+
+        if end > len(data):
+            raise MQTTDisconnectError("[Properties] Property length exceeds packet!")
+
+        props = {}
+
+        def field(start, size):
+            if start + size > end:
+                raise MQTTDisconnectError("[Properties] Malformed property!")
+            return bytes(data[start:start+size]), start + size
+
+        while offset < end:
+            ident, offset = Properties.decode_varint(data, offset)
+            fmt = PropertyType.FORMATS.get(ident)
+
+            if fmt == PropertyType.Format.BYTE:
+                raw, offset = field(offset, 1)
+                value = raw[0]
+            elif fmt == PropertyType.Format.TWO_BYTES:
+                raw, offset = field(offset, 2)
+                value = Bits.unpack(raw)
+            elif fmt == PropertyType.Format.FOUR_BYTES:
+                raw, offset = field(offset, 4)
+                value = Bits.unpack(raw)
+            elif fmt == PropertyType.Format.VARINT:
+                value, offset = Properties.decode_varint(data, offset)
+            elif fmt in (PropertyType.Format.STRING, PropertyType.Format.BINARY):
+                raw, offset   = field(offset, 2)
+                value, offset = field(offset, Bits.unpack(raw))
+            elif fmt == PropertyType.Format.STRING_PAIR:
+                raw, offset = field(offset, 2)
+                key, offset = field(offset, Bits.unpack(raw))
+                raw, offset = field(offset, 2)
+                val, offset = field(offset, Bits.unpack(raw))
+                value = (key, val)
+            else:
+                raise MQTTDisconnectError("[Properties] Unknown property identifier ({0})!".format(ident))
+
+            if ident in PropertyType.CHECK_REPEATABLE:
+                props.setdefault(ident, []).append(value)
+            elif ident in props:
+                # [MQTT-2.2.2-2] Only repeatable properties may be included more than once
+                raise MQTTDisconnectError("[Properties] Property {0} included more than once!".format(ident))
+            else:
+                props[ident] = value
+
+        return props, end
+
+    @staticmethod
+    def encode(props):
+        """Encode properties into a length prefixed property list."""
+        data = bytearray()
+
+        for ident, value in (props or {}).items():
+            fmt    = PropertyType.FORMATS.get(ident)
+            values = value if ident in PropertyType.CHECK_REPEATABLE else (value,)
+
+            for val in values:
+                data.extend(Properties.encode_varint(ident))
+
+                if fmt == PropertyType.Format.BYTE:
+                    data.append(val)
+                elif fmt == PropertyType.Format.TWO_BYTES:
+                    data.extend(Bits.pack(val, 2))
+                elif fmt == PropertyType.Format.FOUR_BYTES:
+                    data.extend(Bits.pack(val, 4))
+                elif fmt == PropertyType.Format.VARINT:
+                    data.extend(Properties.encode_varint(val))
+                elif fmt in (PropertyType.Format.STRING, PropertyType.Format.BINARY):
+                    val = Bits.str_to_bytes(val)
+                    data.extend(Bits.pack(len(val), 2))
+                    data.extend(val)
+                elif fmt == PropertyType.Format.STRING_PAIR:
+                    for part in map(Bits.str_to_bytes, val):
+                        data.extend(Bits.pack(len(part), 2))
+                        data.extend(part)
+                else:
+                    raise MQTTPacketException("[Properties] Unknown property identifier ({0})!".format(ident))
+
+        return Properties.encode_varint(len(data)) + bytes(data)
+
+
+class TopicAliases:
+    """
+    Topic alias mapping for one network connection (MQTT 5).
+    Inbound aliases are set by the client, outbound aliases by the broker.
+    """
+    def __init__(self, inbound_max=0, outbound_max=0):
+        super().__init__()
+        self.inbound_max  = inbound_max
+        self.outbound_max = outbound_max
+        self.inbound  = {}  # { alias: topic }
+        self.outbound = {}  # { topic: alias }
+
+    def resolve(self, topic, alias):
+        """Return the full topic for an incoming PUBLISH, registering the alias if a topic is given."""
+        if not alias:
+            return topic
+
+        if alias > self.inbound_max:
+            # [MQTT-3.3.2-9], [MQTT-3.3.2-10]
+            raise MQTTDisconnectError("[TopicAliases] Topic Alias {0} exceeds maximum of {1}!"
+                                            .format(alias, self.inbound_max),
+                                      code=ReasonCode.TOPIC_ALIAS_INVALID)
+        if topic:
+            self.inbound[alias] = topic
+            return topic
+        elif alias in self.inbound:
+            return self.inbound[alias]
+
+        raise MQTTDisconnectError("[TopicAliases] Unknown Topic Alias {0}!".format(alias),
+                                  code=ReasonCode.PROTOCOL_ERROR)
+
+    def lookup(self, topic):
+        """
+        Get the outbound alias for a topic: returns (alias, is_known).
+        An alias of 0 means no alias is available. A new alias only becomes
+        known after commit(), i.e. once the packet introducing it was sent.
+        """
+        alias = self.outbound.get(topic, 0)
+
+        if alias:
+            return alias, True
+        elif len(self.outbound) < self.outbound_max:
+            return len(self.outbound) + 1, False
+
+        return 0, False
+
+    def commit(self, topic, alias):
+        if alias and topic not in self.outbound:
+            self.outbound[topic] = alias
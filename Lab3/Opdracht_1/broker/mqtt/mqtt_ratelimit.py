@@ -0,0 +1,90 @@
+import time
+
+from mqtt.mqtt_threading import Threading
+
+class TokenBucket:
+    """
+    Token bucket that refills at `rate` tokens/s up to `burst` tokens.
+
+    Consuming never blocks and may put the bucket in debt, so a packet
+    that is already read is always accepted. The caller is expected to
+    stop reading until wait_time() is 0 again.
+    """
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.rate   = float(rate)
+        self.burst  = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.last   = time.time()
+        self.lock   = Threading.new_lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last   = now
+
+    def consume(self, amount=1):
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= amount
+
+    def wait_time(self):
+        """Seconds until the bucket is out of debt."""
+        with self.lock:
+            self._refill(time.time())
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class RateLimit:
+    """Combined messages/s and bytes/s limit, either may be None (unlimited)."""
+    def __init__(self, msgs_per_s=None, bytes_per_s=None):
+        super().__init__()
+        self.msgs  = TokenBucket(msgs_per_s)  if msgs_per_s  else None
+        self.bytes = TokenBucket(bytes_per_s) if bytes_per_s else None
+
+    def consume(self, size):
+        if self.msgs:
+            self.msgs.consume(1)
+        if self.bytes:
+            self.bytes.consume(size)
+
+    def wait_time(self):
+        return max(self.msgs.wait_time()  if self.msgs  else 0,
+                   self.bytes.wait_time() if self.bytes else 0)
+
+    def __str__(self):
+        return "{0} msgs/s, {1} bytes/s".format(self.msgs.rate  if self.msgs  else "unlimited",
+                                                self.bytes.rate if self.bytes else "unlimited")
+
+
+class Backpressure:
+    """
+    High/low water mark on the number of packets queued for all clients.
+    Once above the high water mark, publishers are not read from until
+    the queues drained below the low water mark again.
+    """
+    REFRESH_S = 0.1  # Recount queues at most this often
+
+    def __init__(self, high_water, low_water=None):
+        super().__init__()
+        self.high_water = high_water
+        self.low_water  = low_water if low_water is not None else high_water // 2
+        self.is_active  = False
+        self.queued     = 0
+        self.last_count = 0
+        self.lock       = Threading.new_lock()
+
+    def update(self, count_queued):
+        """Refresh the state with count_queued() (only if stale), returns whether publishers should pause."""
+        with self.lock:
+            now = time.time()
+
+            if now - self.last_count >= self.REFRESH_S:
+                self.queued     = count_queued()
+                self.last_count = now
+
+                if self.queued >= self.high_water:
+                    self.is_active = True
+                elif self.queued <= self.low_water:
+                    self.is_active = False
+
+            return self.is_active
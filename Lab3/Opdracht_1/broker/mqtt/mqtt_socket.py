@@ -53,6 +53,9 @@ def socket_recv(sock, poller=None, buff=4096):
     got_header = False
 
     def poll_sock():
+        if getattr(sock, "pending", None) and sock.pending():
+            # TLS: rest of the record was already read and decrypted
+            return True
         if poller:
             res = poller.poll(1000)
             if res and res[0][1] & select.POLLIN:
@@ -108,7 +111,31 @@ def socket_send(sock, data, poller=None):
         res = True
 
     if res:
-        sock.send(data)
+        if isinstance(data, (list, tuple)):
+            socket_send_parts(sock, data)
+        else:
+            sock.send(data)
         return True
 
     return False
+
+
+def socket_send_parts(sock, parts):
+    """
+    Send a list of buffers as one message (scatter/gather), so e.g. a shared
+    payload does not have to be copied into a new buffer for every send.
+    """
+    try:
+        sent = sock.sendmsg(parts)
+    except (AttributeError, NotImplementedError):
+        # No sendmsg (MicroPython, SSL sockets)
+        sock.sendall(b"".join(parts))
+        return
+
+    # Send whatever did not fit in the socket buffer
+    for part in parts:
+        if sent >= len(part):
+            sent -= len(part)
+        else:
+            sock.sendall(memoryview(part)[sent:])
+            sent = 0
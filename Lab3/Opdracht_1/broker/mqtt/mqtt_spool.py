@@ -0,0 +1,113 @@
+import os
+import shutil
+import struct
+
+from mqtt.mqtt_threading import Threading
+from mqtt.mqtt_exceptions import *
+from mqtt.mqtt_packet_types import ProtocolLevel
+from mqtt.mqtt_packet import MQTTPacket
+
+class SessionSpool:
+    """
+    On-disk FIFO of PUBLISH packets for one (offline) session.
+
+    Packets are appended to numbered segment files, each record is
+        RECORD(expiry deadline, 0 if none) + MQTT 5 PUBLISH frame
+    so properties survive the round trip. Reading streams the oldest
+    segment and deletes it once it is consumed, so the backlog is never
+    loaded into memory as a whole.
+    """
+    RECORD           = struct.Struct(">d")  # expiry deadline (s)
+    SEGMENT_RECORDS  = 1024                 # Records per segment file
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.lock = Threading.new_lock()
+
+        self.segments = []    # [ segment number ], oldest first
+        self.writer   = None  # (number, fp, records written)
+        self.reader   = None  # (number, fp)
+        self.count    = 0     # Records not read yet
+
+        # Sessions do not survive a broker restart, so neither do their spools
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+
+    def __len__(self):
+        return self.count
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, "{0:08d}.seg".format(number))
+
+    def _close_writer(self):
+        if self.writer:
+            self.writer[1].close()
+            self.writer = None
+
+    def append(self, packet):
+        """Spool a PUBLISH, its packet id is not kept (it gets a new one when read back)."""
+        frame = packet.to_bin(protocol_level=ProtocolLevel.MQTT_5)
+
+        with self.lock:
+            if not self.writer or self.writer[2] >= self.SEGMENT_RECORDS:
+                self._close_writer()
+                number = self.segments[-1] + 1 if self.segments else 0
+                self.segments.append(number)
+                self.writer = (number, open(self._segment_path(number), "wb"), 0)
+
+            number, fp, records = self.writer
+            fp.write(self.RECORD.pack(packet.expiry_deadline or 0))
+            fp.write(frame)
+            self.writer = (number, fp, records + 1)
+            self.count += 1
+
+    def read(self, max_packets):
+        """Read up to max_packets PUBLISH packets, oldest first (expiry_deadline restored)."""
+        packets = []
+
+        with self.lock:
+            while self.count and len(packets) < max_packets:
+                if not self.reader:
+                    number = self.segments[0]
+                    if self.writer and self.writer[0] == number:
+                        # Reading the segment being written, finish it first
+                        self._close_writer()
+                    self.reader = (number, open(self._segment_path(number), "rb"))
+
+                number, fp = self.reader
+                header = fp.read(self.RECORD.size)
+
+                if not header:
+                    # Segment consumed
+                    fp.close()
+                    os.remove(self._segment_path(number))
+                    self.segments.pop(0)
+                    self.reader = None
+                    continue
+
+                deadline, = self.RECORD.unpack(header)
+                packet = MQTTPacket.from_bytes(MQTTPacket.read_frame(fp), protocol_level=ProtocolLevel.MQTT_5)
+                packet.expiry_deadline = deadline or None
+                packets.append(packet)
+                self.count -= 1
+
+            if not self.count and self.reader:
+                # Drained, don't keep the last segment around
+                number, fp = self.reader
+                fp.close()
+                os.remove(self._segment_path(number))
+                self.segments.remove(number)
+                self.reader = None
+
+        return packets
+
+    def destroy(self):
+        with self.lock:
+            self._close_writer()
+            if self.reader:
+                self.reader[1].close()
+                self.reader = None
+            self.segments = []
+            self.count    = 0
+            shutil.rmtree(self.path, ignore_errors=True)
@@ -1,16 +1,26 @@
 from mqtt.bits import Bits
+from mqtt.mqtt_exceptions import MQTTTopicException
 from mqtt.mqtt_packet_types import WillQoS
 from mqtt.topic_matcher import TopicMatcher
 
 class TopicSubscription:
-    def __init__(self, order, topic, qos=0):
+    def __init__(self, order, topic, qos=0, conflate=False):
         super().__init__()
         self.order = order
         self.topic = topic
         self.qos   = qos
+        # Only keep the newest undelivered QoS 0 message per topic
+        self.conflate = conflate
+
+        try:
+            # Validated and split once, matching uses the levels
+            self.levels = TopicMatcher.compile(Bits.bytes_to_str(topic))
+        except MQTTTopicException:
+            # Invalid filter, refused in the SUBACK and never matched
+            self.levels = None
 
     def __str__(self):
-        return "'{0}' ({1})".format(self.topic, self.qos)
+        return "'{0}' ({1}{2})".format(self.topic, self.qos, ", conflate" if self.conflate else "")
 
     __repr__ = __str__
 
@@ -29,18 +39,15 @@ class TopicSubscription:
     def __ge__(self, other):
         return self.order >= other.order
 
+    def is_valid(self):
+        return self.levels is not None
+
     def matches(self, topic):
-        topic = Bits.bytes_to_str(topic)
-        # print("Subscribed topic: " + self.topic)
-        # print("Check topic     : " + topic)
-        return TopicMatcher(self.topic).matches(topic)
+        return self.levels is not None and TopicMatcher.match_levels(self.levels, TopicMatcher.split(topic))
 
     def update_qos(self, qos):
         self.qos = qos if qos in WillQoS.CHECK_VALID else 0
 
     @staticmethod
     def filter_wildcards(sub_topic, pub_topic=b""):
-        tm = TopicMatcher(sub_topic)
-        if pub_topic:
-            tm.matches(Bits.bytes_to_str(pub_topic))
-        return tm.filtered()
+        return TopicMatcher.filter_wildcards(sub_topic, pub_topic)
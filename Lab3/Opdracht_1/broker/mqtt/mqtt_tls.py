@@ -0,0 +1,102 @@
+import ssl
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mqtt.mqtt_threading import Threading
+
+class HandshakeMetrics:
+    """Counters and timings (in seconds) of the TLS handshakes done by the broker."""
+    def __init__(self):
+        super().__init__()
+        self.lock     = Threading.new_lock()
+        self.count    = 0
+        self.resumed  = 0
+        self.failed   = 0
+        self.total_s  = 0.0
+        self.min_s    = None
+        self.max_s    = 0.0
+        self.pending  = 0  # Accepted, waiting for a handshake worker
+
+    def record(self, duration, resumed):
+        with self.lock:
+            self.count   += 1
+            self.resumed += 1 if resumed else 0
+            self.total_s += duration
+            self.min_s    = duration if self.min_s is None else min(self.min_s, duration)
+            self.max_s    = max(self.max_s, duration)
+
+    def record_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "handshakes" : self.count,
+                "resumed"    : self.resumed,
+                "failed"     : self.failed,
+                "pending"    : self.pending,
+                "avg_ms"     : self.total_s / self.count * 1000 if self.count else 0,
+                "min_ms"     : (self.min_s or 0) * 1000,
+                "max_ms"     : self.max_s * 1000,
+            }
+
+    def __str__(self):
+        return "{handshakes} TLS handshakes ({resumed} resumed, {failed} failed, {pending} pending), " \
+               "avg {avg_ms:.1f}ms, min {min_ms:.1f}ms, max {max_ms:.1f}ms".format(**self.snapshot())
+
+
+class TLSAcceptor:
+    """
+    Wraps accepted sockets in TLS. The handshakes are done by a bounded pool of
+    workers, so a reconnect storm neither blocks accepting new connections nor
+    starves the threads that route messages.
+
+    Resumption: the server context keeps OpenSSL's session-ID cache (enabled by
+    default for servers) and issues session tickets (OP_NO_TICKET cleared,
+    `num_tickets` for TLS 1.3), so waking devices can skip the full handshake.
+    """
+    HANDSHAKE_TIMEOUT_S = 10
+    TICKETS             = 2  # TLS 1.3 tickets sent after a full handshake
+
+    def __init__(self, certfile, keyfile=None, workers=4):
+        super().__init__()
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.context.options &= ~ssl.OP_NO_TICKET
+
+        if hasattr(self.context, "num_tickets"):
+            self.context.num_tickets = self.TICKETS
+
+        self.metrics = HandshakeMetrics()
+        self.pool    = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tls-handshake")
+
+    def submit(self, sock, address, on_done, on_error):
+        """Handshake in the pool, then call on_done(tls_sock, address) or on_error(address, exception)."""
+        with self.metrics.lock:
+            self.metrics.pending += 1
+
+        self.pool.submit(self._handshake, sock, address, on_done, on_error)
+
+    def _handshake(self, sock, address, on_done, on_error):
+        with self.metrics.lock:
+            self.metrics.pending -= 1
+
+        start = time.time()
+        try:
+            sock.settimeout(self.HANDSHAKE_TIMEOUT_S)
+            tls_sock = self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+            tls_sock.do_handshake()
+            tls_sock.settimeout(None)
+        except Exception as e:
+            self.metrics.record_failure()
+            sock.close()
+            on_error(address, e)
+            return
+
+        self.metrics.record(time.time() - start, tls_sock.session_reused)
+        on_done(tls_sock, address)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,578 @@
+import socket
+import time
+
+from mqtt.bits import Bits
+from mqtt.colours import *
+from mqtt.mqtt_threading import Threading
+from mqtt.mqtt_exceptions import *
+from mqtt.mqtt_packet_types import *
+from mqtt.mqtt_packet import MQTTPacket, Connect
+from mqtt.mqtt_subscription import TopicSubscription
+from mqtt.mqtt_expiry import ExpiryQueue
+from mqtt.topic_matcher import TopicMatcher
+from mqtt.mqtt_broker import ConnectedClient
+
+DEBUG = True
+
+
+class SNPacket:
+    """MQTT-SN v1.2 framing: Length (1 or 3 bytes), MsgType, message body."""
+
+    @staticmethod
+    def parse(data):
+        """Returns (message type, body) of a datagram."""
+        if len(data) < 2:
+            raise MQTTPacketException("[SNPacket] Datagram too short!")
+
+        if data[0] == 0x01:
+            # 3 byte length
+            length, offset = Bits.unpack(data[1:3]), 3
+        else:
+            length, offset = data[0], 1
+
+        if length != len(data) or length <= offset:
+            raise MQTTPacketException("[SNPacket] Length {0} does not match datagram ({1} bytes)!".format(length, len(data)))
+
+        return data[offset], data[offset+1:]
+
+    @staticmethod
+    def encode(mtype, body=b""):
+        length = len(body) + 2
+
+        if length > 255:
+            return b"\x01" + Bits.pack(length + 2, 2) + bytes([mtype]) + body
+        return bytes([length, mtype]) + body
+
+    @staticmethod
+    def flags(dup=0, qos=0, retain=0, will=0, clean=0, topic_id_type=SNTopicIdType.NORMAL):
+        return (dup << 7) | ((0b11 if qos == -1 else qos) << 5) | (retain << 4) \
+             | (will << 3) | (clean << 2) | topic_id_type
+
+    @staticmethod
+    def parse_flags(flags):
+        """Returns (dup, qos, retain, will, clean, topic id type), QoS -1 is publish without connection."""
+        qos = Bits.get(flags, 5, 2)
+        return (Bits.get(flags, 7), -1 if qos == 0b11 else qos, Bits.get(flags, 4),
+                Bits.get(flags, 3), Bits.get(flags, 2), Bits.get(flags, 0, 2))
+
+
+class SNClient(ConnectedClient):
+    """
+    Client connected over UDP through the MQTT-SN gateway. It lives in the broker's
+    client table like any other client, so routing queues messages for it as usual.
+    The gateway delivers them, or keeps them queued while the client sleeps.
+    """
+    ACTIVE = "active"
+    ASLEEP = "asleep"
+
+    RETRY_S = 10  # Resend an unacknowledged PUBLISH after
+    RETRIES = 3
+
+    def __init__(self, udp_addr):
+        super().__init__(None, udp_addr)
+        self.udp_addr = udp_addr
+        self.state    = SNClient.ACTIVE
+        self.sleep_s  = 0
+
+        self.topic_ids     = {}  # { topic id: topic }, registered by either side
+        self.topic_names   = {}  # { topic: topic id }
+        self.next_topic_id = 1
+
+        self.inflight      = {}     # { msg id: [PUBLISH, last sent, tries] } awaiting PUBACK
+        self.registering   = {}     # { topic id: [msg id, last sent, tries, [(PUBLISH, dup)]] } awaiting REGACK
+        self.incoming_qos2 = set()  # msg ids of QoS 2 PUBLISH awaiting PUBREL
+        self.will_stage    = None   # Set while asking for the will topic/message
+
+    def address(self):
+        # Keep UDP and TCP clients apart in the broker's client table
+        return ("udp", self.addr, self.port)
+
+    def register_topic(self, topic):
+        if topic not in self.topic_names:
+            topic_id = self.next_topic_id
+            self.next_topic_id = self.next_topic_id % 0xFFFF + 1
+            self.topic_ids.pop(self.topic_ids.get(topic_id), None)
+            self.topic_ids[topic_id]  = topic
+            self.topic_names[topic]   = topic_id
+        return self.topic_names[topic]
+
+    def forget_topic(self, topic_id):
+        topic = self.topic_ids.pop(topic_id, None)
+        self.topic_names.pop(topic, None)
+
+    def timeout_s(self):
+        """Seconds without messages before the client is considered lost, 0 is never."""
+        duration = self.sleep_s if self.state == SNClient.ASLEEP else self.keep_alive_s
+        return duration * self.LIFETIME_MOD if duration else 0
+
+    def __str__(self, more=False):
+        text = super().__str__(more)
+        return text + (style(" (SN, asleep)", Colours.FG.YELLOW) if self.state == SNClient.ASLEEP else \
+                       style(" (SN)", Colours.FG.YELLOW))
+
+
+class MQTTSNGateway:
+    """
+    MQTT-SN v1.2 gateway (transparent, built into the broker) on UDP.
+
+    - Topic names are mapped to 2 byte topic ids per client (REGISTER/SUBACK),
+      predefined topic ids are shared by all clients, two character topics can
+      be used as short names. Messages on a topic the gateway registers wait
+      for the REGACK, the REGISTER is retried like a PUBLISH.
+    - Publish without connection (QoS -1) with predefined or short topics, so a
+      sensor reading is a single datagram.
+    - Sleeping clients: messages are kept queued (and spooled/expired like any
+      offline session) until the client wakes up with a PINGREQ.
+    - QoS 2 is accepted from clients, deliveries to clients are QoS 0 or 1.
+    """
+    PORT  = 1884
+    GW_ID = 1
+
+    POLL_S = 0.1
+
+    def __init__(self, broker, host="", port=PORT, predefined_topics=None):
+        super().__init__()
+        self.broker = broker
+        self.host   = host
+        self.port   = port
+
+        # { topic id: topic }, known by the clients in advance
+        self.predefined     = { int(tid): Bits.str_to_bytes(topic) for tid, topic in (predefined_topics or {}).items() }
+        self.predefined_ids = { topic: tid for tid, topic in self.predefined.items() }
+
+        self.clients    = {}  # { udp address: SNClient }
+        self.is_running = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+        self.sock.settimeout(self.POLL_S)
+
+    def _log(self, msg):
+        if DEBUG:
+            print(style("[MQTT-SN]", Colours.FG.BRIGHT_BLACK) + " {0}".format(msg))
+
+    def _info(self, msg):
+        print(style("[MQTT-SN]", Colours.FG.BRIGHT_WHITE) + " {0}".format(msg))
+
+    def start(self):
+        self._info("Gateway listening on UDP {0}:{1}".format(self.host if self.host else "0.0.0.0", self.port))
+        self.is_running = True
+        Threading.new_thread(self._serve, ())
+
+    def stop(self):
+        self.is_running = False
+
+    def send(self, addr, mtype, body=b""):
+        self.sock.sendto(SNPacket.encode(mtype, body), addr)
+
+    ###########################################################################
+    # Main loop
+
+    def _serve(self):
+        while self.is_running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                data, addr = None, None
+            except OSError as e:
+                self._info(style("Socket error", Colours.FG.RED) + ": {0}".format(e))
+                break
+
+            if data:
+                try:
+                    self.broker.profiler.run(self._handle, addr, data)
+                except (MQTTPacketException, MQTTTopicException) as e:
+                    self._info(style("Packet error", Colours.FG.RED) + " from {0}:{1}: {2}".format(*addr, e))
+                except MQTTDisconnectError as e:
+                    self._info(style("Disconnecting", Colours.FG.BRIGHT_RED) + " {0}:{1}: {2}".format(*addr, e))
+                    self._drop(addr)
+
+            self._service_clients()
+
+        self.sock.close()
+
+    def _service_clients(self):
+        now = time.time()
+
+        for addr, client in list(self.clients.items()):
+            if client.state == SNClient.ACTIVE and not client.will_stage:
+                self._deliver(client)
+                self._retry_inflight(client, now)
+
+            timeout = client.timeout_s()
+            if timeout and now - client.start_timestamp > timeout:
+                self._info("{0} lost (no message for {1:.0f}s)".format(client, timeout))
+                self._drop(addr)
+
+    def _drop(self, addr):
+        """Client disconnected or lost, the broker publishes the will and keeps the session if needed."""
+        client = self.clients.pop(addr, None)
+        if client:
+            self.broker._destroy_client(client.address())
+
+    ###########################################################################
+    # Delivery to clients
+
+    def _topic_id(self, client, topic):
+        """
+        Returns (topic id type, topic id), registering the topic with the client first if needed.
+        Returns None while the registration is not acknowledged yet.
+        """
+        if topic in self.predefined_ids:
+            return SNTopicIdType.PREDEFINED, self.predefined_ids[topic]
+        elif len(topic) == 2:
+            return SNTopicIdType.SHORT_NAME, Bits.unpack(topic)
+        elif topic not in client.topic_names:
+            topic_id = client.register_topic(topic)
+            client.registering[topic_id] = [client.next_id(), 0, 0, []]
+            self._send_register(client, topic_id)
+
+        topic_id = client.topic_names[topic]
+        if topic_id in client.registering:
+            return None
+        return SNTopicIdType.NORMAL, topic_id
+
+    def _send_register(self, client, topic_id):
+        entry = client.registering[topic_id]
+        entry[1], entry[2] = time.time(), entry[2] + 1
+
+        self.send(client.udp_addr, SNMessageType.REGISTER, Bits.pack(topic_id, 2) + entry[0] + client.topic_ids[topic_id])
+
+    def _abandon_registration(self, client, topic_id, reason):
+        """The client did not accept the topic id, drop the messages waiting for it."""
+        msg_id, _, _, waiting = client.registering.pop(topic_id)
+        client.release_id(msg_id)
+
+        client._log("Registering '{0}' {1}, dropping {2} message(s)".format(
+                        Bits.bytes_to_str(client.topic_ids.get(topic_id, b"")), reason, len(waiting)))
+        client.forget_topic(topic_id)
+
+        for pack, _ in waiting:
+            client.release_id(pack.packet_id)
+
+    def _send_publish(self, client, pack, dup=0):
+        qos = min(pack.pflag.qos, WillQoS.QoS_1)
+        msg_id = Bits.pad_bytes(pack.packet_id, 2) if qos else b"\x00\x00"
+
+        topic = self._topic_id(client, pack.topic)
+        if topic is None:
+            # Published once the client acknowledged the topic id (REGACK)
+            client.registering[client.topic_names[pack.topic]][3].append((pack, dup))
+            client.inflight.pop(Bits.unpack(msg_id), None)
+            return
+
+        id_type, topic_id = topic
+
+        self.send(client.udp_addr, SNMessageType.PUBLISH,
+                  bytes([SNPacket.flags(dup=dup, qos=qos, retain=pack.pflag.retain, topic_id_type=id_type)]) \
+                + Bits.pack(topic_id, 2) + msg_id + pack.payload)
+        client._log("Sent SN PUBLISH to '{0}' ({1} bytes)".format(Bits.bytes_to_str(pack.topic), len(pack.payload)))
+
+        if qos:
+            client.inflight[Bits.unpack(msg_id)] = [pack, time.time(), 1]
+        else:
+            client.release_id(pack.packet_id)
+
+    def _deliver(self, client):
+        """Send everything queued for an awake client."""
+        with client.queued_packets_lock:
+            while client.queued_packets or client._refill_from_spool():
+                if not client.queued_packets:
+                    continue
+
+                pack = client._pop_queued(0)
+
+                if pack.ptype != ControlPacketType.PUBLISH:
+                    continue
+                elif ExpiryQueue.is_expired(pack):
+                    client.release_id(pack.packet_id)
+                    continue
+
+                self._send_publish(client, pack)
+
+    def _retry_inflight(self, client, now):
+        for topic_id, entry in list(client.registering.items()):
+            if now - entry[1] < SNClient.RETRY_S:
+                continue
+            elif entry[2] > SNClient.RETRIES:
+                self._abandon_registration(client, topic_id, "not acknowledged")
+            else:
+                self._send_register(client, topic_id)
+
+        for msg_id, entry in list(client.inflight.items()):
+            pack, sent, tries = entry
+
+            if now - sent < SNClient.RETRY_S:
+                continue
+            elif tries > SNClient.RETRIES:
+                client._log("Giving up on {0}".format(pack))
+                del client.inflight[msg_id]
+                client.release_id(pack.packet_id)
+            else:
+                self._send_publish(client, pack, dup=1)
+                client.inflight[msg_id][2] = tries + 1
+
+    ###########################################################################
+    # Incoming messages
+
+    def _handle(self, addr, data):
+        mtype, body = SNPacket.parse(data)
+        client = self.clients.get(addr)
+
+        self._log("{0} from {1}:{2} ({3} bytes)".format(SNMessageType.to_string(mtype), *addr, len(data)))
+
+        if client:
+            client.reset_lifetime()
+
+        if mtype == SNMessageType.SEARCHGW:
+            self.send(addr, SNMessageType.GWINFO, bytes([self.GW_ID]))
+        elif mtype == SNMessageType.CONNECT:
+            self._handle_connect(addr, body)
+        elif mtype == SNMessageType.PUBLISH:
+            self._handle_publish(client, addr, body)
+        elif not client:
+            # Everything else needs a connection
+            raise MQTTPacketException("{0} without CONNECT!".format(SNMessageType.to_string(mtype)))
+        elif mtype == SNMessageType.WILLTOPIC:
+            self._handle_will_topic(client, body)
+        elif mtype == SNMessageType.WILLMSG:
+            client.will_msg   = body
+            client.will_stage = None
+            self.send(addr, SNMessageType.CONNACK, bytes([SNReturnCode.ACCEPTED]))
+        elif mtype == SNMessageType.REGISTER:
+            topic_id = client.register_topic(body[4:])
+            self.send(addr, SNMessageType.REGACK, Bits.pack(topic_id, 2) + body[2:4] + bytes([SNReturnCode.ACCEPTED]))
+        elif mtype == SNMessageType.REGACK:
+            self._handle_regack(client, body)
+        elif mtype == SNMessageType.PUBACK:
+            entry = client.inflight.pop(Bits.unpack(body[2:4]), None)
+            if entry:
+                client.release_id(entry[0].packet_id)
+            if body[4] == SNReturnCode.INVALID_TOPIC_ID and Bits.unpack(body[0:2]) not in client.registering:
+                # Client lost its registrations (e.g. rebooted), register again on next PUBLISH
+                client.forget_topic(Bits.unpack(body[0:2]))
+        elif mtype == SNMessageType.PUBREL:
+            client.incoming_qos2.discard(Bits.unpack(body[0:2]))
+            self.send(addr, SNMessageType.PUBCOMP, body[0:2])
+        elif mtype == SNMessageType.SUBSCRIBE:
+            self._handle_subscribe(client, body)
+        elif mtype == SNMessageType.UNSUBSCRIBE:
+            topic = self._subscription_topic(Bits.get(body[0], 0, 2), body[3:])
+            client.unsubscribe_from(Bits.bytes_to_str(topic))
+            self.send(addr, SNMessageType.UNSUBACK, body[1:3])
+        elif mtype == SNMessageType.PINGREQ:
+            if client.state == SNClient.ASLEEP:
+                # Awake: deliver what was buffered while sleeping, then PINGRESP puts it back to sleep
+                self._deliver(client)
+            self.send(addr, SNMessageType.PINGRESP)
+        elif mtype == SNMessageType.DISCONNECT:
+            self._handle_disconnect(client, body)
+        else:
+            self._log("No handler for {0}".format(SNMessageType.to_string(mtype)))
+
+    def _handle_connect(self, addr, body):
+        if len(body) < 4 or body[1] != 0x01:
+            raise MQTTPacketException("Malformed CONNECT (protocol id {0})!".format(body[1] if len(body) > 1 else "?"))
+
+        _, _, _, will, clean, _ = SNPacket.parse_flags(body[0])
+        duration  = Bits.unpack(body[2:4])
+        client_id = body[4:]
+
+        if not 1 <= len(client_id) <= 23:
+            self.send(addr, SNMessageType.CONNACK, bytes([SNReturnCode.NOT_SUPPORTED]))
+            raise MQTTPacketException("Invalid client id length ({0})!".format(len(client_id)))
+
+        client = self._take_over_session(addr, client_id, clean)
+
+        client.connect_flags = Connect.ConnectFlags(reserved=0, clean=clean, will=will)
+        client.keep_alive_s  = duration
+        client.will_topic    = b""
+        client.will_msg      = b""
+        client.state         = SNClient.ACTIVE
+        client.sleep_s       = 0
+        client.is_active     = True
+        client.reset_lifetime()
+
+        self._info("{0} connected from {1}:{2}".format(client, *addr))
+
+        if will:
+            client.will_stage = SNMessageType.WILLTOPIC
+            self.send(addr, SNMessageType.WILLTOPICREQ)
+        else:
+            self.send(addr, SNMessageType.CONNACK, bytes([SNReturnCode.ACCEPTED]))
+
+    def _take_over_session(self, addr, client_id, clean):
+        """Find the session of this client id (restore it, unless clean) or create a new one."""
+        existing = None
+
+        with self.broker.client_lock:
+            for cl in self.broker.clients.values():
+                if cl.id == client_id:
+                    existing = cl
+                    break
+
+        if existing and existing.is_active and not isinstance(existing, SNClient):
+            # Same id connected over TCP, close that connection
+            self.broker._destroy_client(existing.address())
+        elif isinstance(existing, SNClient) and not clean:
+            # Restore, possibly from another address
+            self.clients.pop(existing.udp_addr, None)
+            with self.broker.client_lock:
+                self.broker.clients.pop(existing.address(), None)
+                existing.udp_addr = addr
+                existing.addr, existing.port = addr
+                self.broker.clients[existing.address()] = existing
+            self.clients[addr] = existing
+            return existing
+
+        if existing:
+            with self.broker.client_lock:
+                if self.broker.clients.get(existing.address()) is existing:
+                    existing.discard_session()
+                    del self.broker.clients[existing.address()]
+
+        client = SNClient(addr)
+        client.id              = client_id
+        client.recorder        = None
+        client.spool_dir       = self.broker.spool_dir
+        client.spool_threshold = self.broker.spool_threshold
+        client.expiry          = self.broker.expiry
+
+        with self.broker.client_lock:
+            self.broker.clients[client.address()] = client
+        self.clients[addr] = client
+        return client
+
+    def _handle_will_topic(self, client, body):
+        if body:
+            _, qos, retain, _, _, _ = SNPacket.parse_flags(body[0])
+            client.connect_flags.will_qos = max(0, qos)
+            client.connect_flags.will_ret = retain
+            client.will_topic = body[1:]
+        else:
+            # Empty WILLTOPIC: no will after all
+            client.connect_flags.will = 0
+
+        client.will_stage = SNMessageType.WILLMSG
+        self.send(client.udp_addr, SNMessageType.WILLMSGREQ)
+
+    def _resolve_topic(self, client, id_type, topic_id):
+        if id_type == SNTopicIdType.PREDEFINED:
+            return self.predefined.get(topic_id)
+        elif id_type == SNTopicIdType.SHORT_NAME:
+            return Bits.pack(topic_id, 2)
+        elif client:
+            return client.topic_ids.get(topic_id)
+        return None
+
+    def _handle_publish(self, client, addr, body):
+        if len(body) < 5:
+            raise MQTTPacketException("Malformed PUBLISH!")
+
+        dup, qos, retain, _, _, id_type = SNPacket.parse_flags(body[0])
+        topic_id, msg_id, data = Bits.unpack(body[1:3]), body[3:5], body[5:]
+
+        if qos != -1 and not client:
+            raise MQTTPacketException("PUBLISH QoS {0} without CONNECT!".format(qos))
+
+        topic = self._resolve_topic(client, id_type, topic_id)
+
+        if not topic or (qos == -1 and id_type == SNTopicIdType.NORMAL):
+            self.send(addr, SNMessageType.PUBACK, body[1:3] + msg_id + bytes([SNReturnCode.INVALID_TOPIC_ID]))
+            return
+
+        if qos == WillQoS.QoS_2:
+            if dup and Bits.unpack(msg_id) in client.incoming_qos2:
+                # Already forwarded, PUBREC got lost
+                self.send(addr, SNMessageType.PUBREC, msg_id)
+                return
+            client.incoming_qos2.add(Bits.unpack(msg_id))
+
+        # Inject into the same routing as TCP clients
+        packet = MQTTPacket.create_publish(ControlPacketType.PublishFlags(DUP=0, QoS=max(0, qos), RETAIN=retain),
+                                           b"", topic, data)
+
+        self.broker._info("SN PUBLISH to topic '{0}': {1}".format(Bits.bytes_to_str(topic),
+                          "'{0}'".format(Bits.bytes_to_str(data)) if data else "(no payload)"))
+
+        if retain:
+            self.broker.queue_published_retained(topic, packet)
+        self.broker._publish_to_clients(topic, packet)
+
+        if qos == WillQoS.QoS_1:
+            self.send(addr, SNMessageType.PUBACK, body[1:3] + msg_id + bytes([SNReturnCode.ACCEPTED]))
+        elif qos == WillQoS.QoS_2:
+            self.send(addr, SNMessageType.PUBREC, msg_id)
+
+    def _subscription_topic(self, id_type, raw):
+        if id_type == SNTopicIdType.PREDEFINED:
+            topic = self.predefined.get(Bits.unpack(raw[0:2]))
+            if not topic:
+                raise MQTTPacketException("Unknown predefined topic id {0}!".format(Bits.unpack(raw[0:2])))
+            return topic
+        return raw
+
+    def _handle_regack(self, client, body):
+        topic_id = Bits.unpack(body[0:2])
+        entry    = client.registering.get(topic_id)
+
+        if not entry or entry[0] != body[2:4]:
+            # Already acknowledged (a retried REGISTER), or given up
+            return
+        elif body[4] == SNReturnCode.CONGESTION:
+            # Try again later, the retry timer resends the REGISTER
+            return
+        elif body[4] != SNReturnCode.ACCEPTED:
+            self._abandon_registration(client, topic_id, "rejected ({0})".format(body[4]))
+            return
+
+        del client.registering[topic_id]
+        client.release_id(entry[0])
+
+        for pack, dup in entry[3]:
+            self._send_publish(client, pack, dup)
+
+    def _handle_subscribe(self, client, body):
+        _, qos, _, _, _, id_type = SNPacket.parse_flags(body[0])
+        msg_id = body[1:3]
+        topic  = self._subscription_topic(id_type, body[3:])
+        qos    = min(max(0, qos), WillQoS.QoS_1)
+
+        topic_str = Bits.bytes_to_str(topic)
+        has_wildcards = TopicMatcher.HASH in topic_str or TopicMatcher.PLUS in topic_str
+        sub = TopicSubscription(len(client.subscribed_topics), topic_str, qos)
+
+        if not sub.is_valid():
+            self.send(client.udp_addr, SNMessageType.SUBACK,
+                      bytes([SNPacket.flags(qos=qos)]) + b"\x00\x00" + msg_id + bytes([SNReturnCode.NOT_SUPPORTED]))
+            return
+
+        if id_type == SNTopicIdType.PREDEFINED:
+            topic_id = Bits.unpack(body[3:5])
+        elif id_type == SNTopicIdType.NORMAL and not has_wildcards and len(topic) != 2:
+            topic_id = client.register_topic(topic)
+        else:
+            topic_id = 0
+
+        client.subscribe_to(sub)
+        client.show_subscriptions()
+
+        self.send(client.udp_addr, SNMessageType.SUBACK,
+                  bytes([SNPacket.flags(qos=qos)]) + Bits.pack(topic_id, 2) + msg_id + bytes([SNReturnCode.ACCEPTED]))
+
+        self.broker._queue_retained_for(client)
+
+    def _handle_disconnect(self, client, body):
+        if len(body) >= 2 and Bits.unpack(body[0:2]) > 0:
+            # Going to sleep: keep everything queued until it wakes up
+            client.state     = SNClient.ASLEEP
+            client.sleep_s   = Bits.unpack(body[0:2])
+            client.is_active = False
+            client.reset_lifetime()
+            self._info("{0} sleeps for {1}s".format(client, client.sleep_s))
+            self.send(client.udp_addr, SNMessageType.DISCONNECT)
+        else:
+            # Regular disconnect, discards the will
+            client.requested_disconnect()
+            self.send(client.udp_addr, SNMessageType.DISCONNECT)
+            self._drop(client.udp_addr)
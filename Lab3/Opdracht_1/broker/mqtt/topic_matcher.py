@@ -1,5 +1,13 @@
+from mqtt.bits import Bits
 from mqtt.mqtt_exceptions import MQTTTopicException
 
+try:
+    from functools import lru_cache
+except ImportError:
+    # MicroPython: no memoization
+    def lru_cache(maxsize=128):
+        return lambda func: func
+
 class TopicMatcher:
     HASH = '#'  # Matches anything (multi level)
     PLUS = '+'  # Matches one thing (single level)
@@ -8,99 +16,83 @@ class TopicMatcher:
 
     def __init__(self, pattern):
         self.pattern = pattern
+        self.levels  = TopicMatcher.compile(pattern)
 
-    def matches(self, topic):
-        # print("Test: {} == {}".format(self.pattern, topic))
-
-        # check for complete match
-        if    TopicMatcher.HASH not in self.pattern \
-          and TopicMatcher.PLUS not in self.pattern:
-            # If no wildcards, match exactly
-            return self.pattern == topic
-        elif len(self.pattern) > 1:
-            # Test wildcard locations for conformity
-            # [MQTT-4.7.1-1], [MQTT-4.7.1-2], [MQTT-4.7.1-3]
-            length = len(self.pattern)
-
-            for i in range(length):
-                if self.pattern[i] == TopicMatcher.PLUS:
-                    if i < length - 1 and not self.pattern[i+1] == TopicMatcher.SEP:
-                        raise MQTTTopicException("Wildcard '{0}' not followed by a '{1}' in {2}!" \
-                                    .format(TopicMatcher.PLUS, TopicMatcher.SEP, self.pattern))
-                    elif i > 0 and not self.pattern[i-1] == TopicMatcher.SEP:
-                        raise MQTTTopicException("Wildcard '{0}' not preceded a '{1}' in {2}!" \
-                                    .format(TopicMatcher.PLUS, TopicMatcher.SEP, self.pattern))
-                elif self.pattern[i] == TopicMatcher.HASH:
-                    if i != length - 1:
-                        raise MQTTTopicException("Wildcard '{0}' not at end in '{1}'!" \
-                                    .format(TopicMatcher.HASH, self.pattern))
-                    elif not self.pattern[i-1] == TopicMatcher.SEP:
-                        raise MQTTTopicException("Wildcard '{0}' not preceded a '{1}' in {2}!" \
-                                    .format(TopicMatcher.HASH, TopicMatcher.SEP, self.pattern))
-
-        if self.pattern == topic:
-            # If exact match
-            return True
-        elif self.pattern == TopicMatcher.HASH:
-            # If subscription is #, match anything, except $
-            if topic[0] == TopicMatcher.DOLL:
-                # [MQTT-4.7.2-1] Don't match $ topics with wildcard
-                return False
-            else:
-                self.pattern = topic
-                return True
-        # elif self.pattern[0] == TopicMatcher.DOLL:
-        #     # [MQTT-4.7.2-1] Starts with $: match exactly (internal use only)
-        #     # return self.pattern == topic
-        elif  self.pattern[-1] == TopicMatcher.HASH \
-          and TopicMatcher.PLUS not in self.pattern \
-          and topic[0] != TopicMatcher.DOLL:
-            # Ends with # and no +: match anything before that
-            matches = topic.startswith(self.pattern[0:-1])
-            if matches: self.pattern = topic
-            return matches
-        elif  self.pattern[0] in (TopicMatcher.PLUS, TopicMatcher.HASH) \
-          and topic[0] == TopicMatcher.DOLL:
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def compile(pattern):
+        """
+        Validate a topic filter and split it into a tuple of levels, so
+        this is only done once per filter instead of on every match.
+        """
+        levels = tuple(pattern.split(TopicMatcher.SEP))
+        last   = len(levels) - 1
+
+        # [MQTT-4.7.1-1], [MQTT-4.7.1-2], [MQTT-4.7.1-3]
+        for i, level in enumerate(levels):
+            if TopicMatcher.PLUS in level and level != TopicMatcher.PLUS:
+                raise MQTTTopicException("Wildcard '{0}' not a complete level (between '{1}') in {2}!" \
+                            .format(TopicMatcher.PLUS, TopicMatcher.SEP, pattern))
+            elif TopicMatcher.HASH in level and level != TopicMatcher.HASH:
+                raise MQTTTopicException("Wildcard '{0}' not preceded a '{1}' in {2}!" \
+                            .format(TopicMatcher.HASH, TopicMatcher.SEP, pattern))
+            elif level == TopicMatcher.HASH and i != last:
+                raise MQTTTopicException("Wildcard '{0}' not at end in '{1}'!" \
+                            .format(TopicMatcher.HASH, pattern))
+
+        return levels
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def split(topic):
+        """Levels of a published topic (str or bytes), the same topics are published over and over."""
+        return tuple(Bits.bytes_to_str(topic).split(TopicMatcher.SEP))
+
+    @staticmethod
+    def match_levels(levels, topic_levels):
+        """Match compiled filter levels against split topic levels, without side effects."""
+        if levels[0] in (TopicMatcher.PLUS, TopicMatcher.HASH) and topic_levels[0].startswith(TopicMatcher.DOLL):
             # [MQTT-4.7.2-1] Don't match $ topics with wildcard
             return False
 
-        # Else go through hierarchy and fill in wildcards
-        expanded_pattern = []
-        sub_split = self.pattern.split(TopicMatcher.SEP)
-        top_split = topic.split(TopicMatcher.SEP)
-
-        for i, (sub_group, match_group) in enumerate(zip(sub_split, top_split)):
-            if sub_group == match_group:
-                expanded_pattern.append(sub_group)
-            elif sub_group == TopicMatcher.PLUS:
-                expanded_pattern.append(match_group)
-            elif sub_group == TopicMatcher.HASH:
-                expanded_pattern.append(TopicMatcher.SEP.join(top_split[i:]))
-                break
-            else:
+        count = len(topic_levels)
+
+        for i, level in enumerate(levels):
+            if level == TopicMatcher.HASH:
+                # Anything below, but at least one level
+                return count > i
+            elif i >= count or (level != TopicMatcher.PLUS and level != topic_levels[i]):
                 return False
 
-        expanded_pattern.extend(sub_split[i+1:])
-        expanded_pattern = TopicMatcher.SEP.join(expanded_pattern)
+        return len(levels) == count
 
-        # print("{} ==> {} vs {}".format(self.pattern, expanded_pattern, topic))
-        self.pattern = expanded_pattern
-        return self.matches(topic)
+    def matches(self, topic):
+        return TopicMatcher.match_levels(self.levels, TopicMatcher.split(topic))
 
     def filtered(self):
-        """
-        Filter wildcards: call matches() first to get rid of '+',
-        then this will remove trailing '/#'.
-        """
+        """Filter without trailing '/#'."""
         filtered_pattern = self.pattern
 
         if filtered_pattern[-1] == TopicMatcher.HASH:
              filtered_pattern = filtered_pattern[0:-1]
-        if filtered_pattern[-1] == TopicMatcher.SEP:
+        if filtered_pattern and filtered_pattern[-1] == TopicMatcher.SEP:
             filtered_pattern = filtered_pattern[0:-1]
 
         return filtered_pattern
 
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def filter_wildcards(pattern, topic=""):
+        """
+        The topic name a subscriber gets for topic (or the filter itself without
+        trailing '/#' if no topic or no match), memoized per (filter, topic).
+        """
+        matcher = TopicMatcher(pattern)
+
+        if topic and matcher.matches(topic):
+            matcher.pattern = Bits.bytes_to_str(topic)
+        return matcher.filtered()
+
 
 if __name__ == "__main__":
     from mqtt.colours import *
@@ -23,13 +23,17 @@ while not wlan.isconnected():
         print("Trying to connect to WiFi")
 print("Connected to WiFi\n")
 
-client = MQTTClient(CLIENT_ID, BROKER,user=USERNAME, password=PASSWORD, port=1883)
+# Reconnects by itself when the connection drops, publishes meanwhile are buffered (up to 32)
+# and replayed without waiting for an ack in between
+client = MQTTClient(CLIENT_ID, BROKER,user=USERNAME, password=PASSWORD, port=1883,
+                    auto_reconnect=True, buffer_slots=32, max_inflight=32)
 
 client.set_callback(sub_cb)
 connected = False
 while not connected:
     try:
-        client.connect()
+        # Keep the session (subscriptions, QoS 1 messages) on the broker while offline
+        client.connect(clean_session=False)
         print("Connected to broker")
         connected = True
     except:
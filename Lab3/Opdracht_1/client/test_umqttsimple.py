@@ -0,0 +1,27 @@
+# Runs on CPython against umqttsimple, no broker needed: python3 -m unittest test_umqttsimple
+import unittest
+
+from umqttsimple import MQTTClient
+
+class OfflineBufferTest(unittest.TestCase):
+
+    def offline_client(self, **kwargs):
+        # Nothing listens on port 1, so every (re)connect fails
+        return MQTTClient("x", "127.0.0.1", port=1, auto_reconnect=True, **kwargs)
+
+    def test_publish_without_slots_is_dropped(self):
+        client = self.offline_client()
+        self.assertIsNone(client.publish("t", "m", qos=1))
+        self.assertEqual(client.dropped, 1)
+        self.assertEqual(client.ring_count, 0)
+
+    def test_publish_is_buffered(self):
+        client = self.offline_client(buffer_slots=2)
+        for msg in ("m1", "m2", "m3"):
+            client.publish("t", msg, qos=1)
+        # Full, the oldest was dropped
+        self.assertEqual(client.ring_count, 2)
+        self.assertEqual(client.dropped, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,19 +2,69 @@ try:
     import usocket as socket
 except:
     import socket
-import ustruct as struct
-from ubinascii import hexlify
+import time
+try:
+    import ustruct as struct
+    from ubinascii import hexlify
+except:
+    # CPython, e.g. to test against the local broker
+    import struct
+    from binascii import hexlify
 
 class MQTTException(Exception):
     pass
 
+# Strings are sent UTF-8 encoded, their length prefix is the encoded length
+def _bytes(s):
+    return s.encode() if isinstance(s, str) else s
+
+# Gives a CPython socket the read/write interface of a MicroPython socket
+class _SocketAdapter:
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, n):
+        buf = b""
+        while len(buf) < n:
+            try:
+                data = self.sock.recv(n - len(buf))
+            except BlockingIOError:
+                # Non-blocking and nothing received yet
+                return None if not buf else buf
+            if not data:
+                break
+            buf += data
+        return buf
+
+    def write(self, buf, n=None):
+        buf = _bytes(buf)
+        self.sock.sendall(memoryview(buf)[:n] if n is not None else buf)
+        return len(buf) if n is None else n
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def close(self):
+        self.sock.close()
+
 class MQTTClient:
 
+    # max_inflight: QoS 1/2 publishes sent before publish() waits for an ack,
+    # 1 waits for every message. Acks are also handled by check_msg().
+    # auto_reconnect: reconnect when the connection drops, retrying after
+    # backoff_min, doubling up to backoff_max seconds. Meanwhile, publishes are
+    # kept in a ring of buffer_slots slots of slot_size bytes (topic + message),
+    # allocated once, the oldest is dropped when full. They are sent in one
+    # burst after reconnecting, so the radio only has to wake up once: QoS 1/2
+    # ones max_inflight per round trip, so set it to buffer_slots for that.
+    # With buffer_slots=0 (the default) publishes while offline are dropped.
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, max_inflight=1, auto_reconnect=False,
+                 backoff_min=1, backoff_max=60, buffer_slots=0, slot_size=128):
         if port == 0:
             port = 8883 if ssl else 1883
-        self.client_id = client_id
+        self.client_id = _bytes(client_id)
         self.sock = None
         self.server = server
         self.port = port
@@ -22,13 +72,31 @@ class MQTTClient:
         self.ssl_params = ssl_params
         self.pid = 0
         self.cb = None
-        self.user = user
-        self.pswd = password
+        self.user = _bytes(user)
+        self.pswd = _bytes(password)
         self.keepalive = keepalive
         self.lw_topic = None
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self.max_inflight = max_inflight
+        # pid: [state, topic, msg, retain], state 1 (awaiting PUBACK), 2 (PUBREC) or 3 (PUBCOMP)
+        self.inflight = {}
+        self.rcv_qos2 = set()  # pids of received QoS 2 messages, until PUBREL
+        self.ack_cb = None
+        self.clean_session = True
+        self.subs = {}  # topic: qos, subscribed again if the session is gone
+        self.auto_reconnect = auto_reconnect
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = backoff_min
+        self.next_attempt = 0
+        self.slot_size = slot_size
+        self.ring = bytearray(buffer_slots * slot_size)
+        self.ring_len = [0] * buffer_slots  # Bytes used per slot
+        self.ring_head = 0  # Oldest slot
+        self.ring_count = 0
+        self.dropped = 0  # Publishes lost because the buffer was full (or too small)
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
@@ -44,21 +112,35 @@ class MQTTClient:
                 return n
             sh += 7
 
+    def _next_pid(self):
+        # 1..65535, skipping pids still in flight
+        while 1:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self.inflight:
+                return self.pid
+
     def set_callback(self, f):
         self.cb = f
 
+    # f(pid) is called when a QoS 1/2 publish is completely acknowledged
+    def set_ack_callback(self, f):
+        self.ack_cb = f
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
         assert topic
-        self.lw_topic = topic
-        self.lw_msg = msg
+        self.lw_topic = _bytes(topic)
+        self.lw_msg = _bytes(msg)
         self.lw_qos = qos
         self.lw_retain = retain
 
     def connect(self, clean_session=True):
+        self.clean_session = clean_session
         self.sock = socket.socket()
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
+        if not hasattr(self.sock, "write"):
+            self.sock = _SocketAdapter(self.sock)
         if self.ssl:
             import ussl
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
@@ -103,15 +185,44 @@ class MQTTClient:
         return resp[2] & 1
 
     def disconnect(self):
+        if self.sock is None:
+            return
         self.sock.write(b"\xe0\0")
         self.sock.close()
+        self.sock = None
 
     def ping(self):
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
+        topic = _bytes(topic)
+        msg = _bytes(msg)
+        if not self.auto_reconnect:
+            return self._publish(topic, msg, retain, qos)
+        if self.sock is None and not self._try_reconnect():
+            self._buffer(topic, msg, retain, qos)
+            return None
+        try:
+            return self._publish(topic, msg, retain, qos)
+        except OSError:
+            self._lost()
+            self._buffer(topic, msg, retain, qos)
+            return None
+
+    def _publish(self, topic, msg, retain, qos):
+        assert qos < 3
+        pid = self._next_pid() if qos > 0 else 0
+        self._send_publish(topic, msg, retain, qos, pid)
+        if qos > 0:
+            # Completed by wait_msg/check_msg, only block when the window is full
+            self.inflight[pid] = [qos, topic, msg, retain]
+            while self.sock and len(self.inflight) >= self.max_inflight:
+                self.wait_msg()
+            return pid
+
+    def _send_publish(self, topic, msg, retain, qos, pid, dup=0):
         pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        pkt[0] |= dup << 3 | qos << 1 | retain
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
@@ -126,35 +237,128 @@ class MQTTClient:
         self.sock.write(pkt, i + 1)
         self._send_str(topic)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
             struct.pack_into("!H", pkt, 0, pid)
             self.sock.write(pkt, 2)
         self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+
+    # Block until every QoS 1/2 publish is acknowledged (or the connection is lost)
+    def wait_inflight(self):
+        while self.inflight and self.sock:
+            self.wait_msg()
+
+    def _buffer(self, topic, msg, retain, qos):
+        n = 3 + len(topic) + len(msg)
+        slots = len(self.ring_len)
+        if not slots or n > self.slot_size:
+            # No offline buffer (buffer_slots=0), or too large for a slot
+            self.dropped += 1
+            return
+        if self.ring_count == slots:
+            # Full, drop the oldest
+            self.ring_head = (self.ring_head + 1) % slots
+            self.ring_count -= 1
+            self.dropped += 1
+        i = (self.ring_head + self.ring_count) % slots
+        o = i * self.slot_size
+        struct.pack_into("!BH", self.ring, o, qos << 1 | retain, len(topic))
+        self.ring[o + 3:o + 3 + len(topic)] = topic
+        self.ring[o + 3 + len(topic):o + n] = msg
+        self.ring_len[i] = n
+        self.ring_count += 1
+
+    # Replays the buffered publishes, only waiting for acks when max_inflight
+    # of them are unacknowledged
+    def _flush(self):
+        mv = memoryview(self.ring)
+        while self.ring_count and self.sock:
+            i = self.ring_head
+            o = i * self.slot_size
+            flags, tlen = struct.unpack_from("!BH", self.ring, o)
+            topic = bytes(mv[o + 3:o + 3 + tlen])
+            msg = bytes(mv[o + 3 + tlen:o + self.ring_len[i]])
+            try:
+                self._publish(topic, msg, flags & 1, flags >> 1)
+            except OSError:
+                # Lost again, the message stays first in line
+                self._lost()
+                return
+            self.ring_head = (i + 1) % len(self.ring_len)
+            self.ring_count -= 1
+
+    def _lost(self):
+        try:
+            self.sock.close()
+        except:
+            pass
+        self.sock = None
+        self.next_attempt = time.time() + self.backoff
+
+    # Reconnect (not before the backoff expired), resume the session and
+    # send what was buffered. Returns whether the client is connected.
+    def _try_reconnect(self):
+        if time.time() < self.next_attempt:
+            return False
+        try:
+            present = self.connect(self.clean_session)
+            if not present:
+                for topic, qos in self.subs.items():
+                    self.subscribe(topic, qos)
+            # [MQTT-4.4.0-1] Resend unacknowledged publishes (and PUBREL) first
+            for pid, entry in self.inflight.items():
+                if entry[0] == 3:
+                    self._send_ack(0x62, pid)
+                else:
+                    self._send_publish(entry[1], entry[2], entry[3], entry[0], pid, dup=1)
+        except Exception:
+            if self.sock:
+                self._lost()
+            self.next_attempt = time.time() + self.backoff
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+            return False
+        self.backoff = self.backoff_min
+        self._flush()
+        return self.sock is not None
+
+    def _send_ack(self, op, pid):
+        pkt = bytearray(b"\x00\x02\0\0")
+        pkt[0] = op
+        struct.pack_into("!H", pkt, 2, pid)
+        self.sock.write(pkt)
+
+    def _handle_ack(self, op):
+        sz = self.sock.read(1)
+        assert sz == b"\x02"
+        pid = self.sock.read(2)
+        pid = pid[0] << 8 | pid[1]
+        if op == 0x62:  # PUBREL
+            self.rcv_qos2.discard(pid)
+            self._send_ack(0x70, pid)
+            return
+        entry = self.inflight.get(pid)
+        state = entry[0] if entry else None
+        if op == 0x50 and state in (2, 3):  # PUBREC
+            entry[0] = 3
+            self._send_ack(0x62, pid)
+            return
+        if (op == 0x40 and state == 1) or (op == 0x70 and state == 3):
+            del self.inflight[pid]
+            if self.ack_cb:
+                self.ack_cb(pid)
 
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
+        topic = _bytes(topic)
+        self.subs[topic] = qos
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self._next_pid())
         #print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
         self._send_str(topic)
         self.sock.write(qos.to_bytes(1, "little"))
         while 1:
             op = self.wait_msg()
+            if self.sock is None:
+                raise OSError(-1)
             if op == 0x90:
                 resp = self.sock.read(4)
                 #print(resp)
@@ -168,6 +372,17 @@ class MQTTClient:
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
+        if self.sock is None and self.auto_reconnect and not self._try_reconnect():
+            return None
+        try:
+            return self._wait_msg()
+        except OSError:
+            if not self.auto_reconnect:
+                raise
+            self._lost()
+            return None
+
+    def _wait_msg(self):
         res = self.sock.read(1)
         self.sock.setblocking(True)
         if res is None:
@@ -179,6 +394,10 @@ class MQTTClient:
             assert sz == 0
             return None
         op = res[0]
+        if op in (0x40, 0x50, 0x62, 0x70):
+            # PUBACK, PUBREC, PUBREL, PUBCOMP
+            self._handle_ack(op)
+            return op
         if op & 0xf0 != 0x30:
             return op
         sz = self._recv_len()
@@ -191,17 +410,22 @@ class MQTTClient:
             pid = pid[0] << 8 | pid[1]
             sz -= 2
         msg = self.sock.read(sz)
+        if op & 6 == 4:
+            # QoS 2: deliver once, a resent PUBLISH (before PUBREL) is only acknowledged
+            if pid not in self.rcv_qos2:
+                self.rcv_qos2.add(pid)
+                self.cb(topic, msg)
+            self._send_ack(0x50, pid)
+            return
         self.cb(topic, msg)
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
+            self._send_ack(0x40, pid)
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
+        if self.sock is None and not (self.auto_reconnect and self._try_reconnect()):
+            return None
         self.sock.setblocking(False)
         return self.wait_msg()
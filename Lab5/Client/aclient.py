@@ -0,0 +1,186 @@
+import sys
+import time
+import asyncio
+
+from colours import *
+from packet import IPacket
+from client import Client, parse_args
+from client_extra import CommunicationType
+
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    """Passes every datagram of an endpoint to handler(raw, addr_tuple)."""
+    def __init__(self, handler, on_error):
+        super().__init__()
+        self.handler  = handler
+        self.on_error = on_error
+
+    def datagram_received(self, data, addr):
+        try:
+            self.handler(data, addr)
+        except Exception as e:
+            self.on_error(e)
+
+    def error_received(self, exc):
+        self.on_error(exc)
+
+
+class TransportSocket:
+    """The sendto() and broadcast() of an OSocket, on an asyncio datagram transport."""
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+
+    def __str__(self):
+        addr, port = self.transport.get_extra_info("sockname")[:2]
+        return f"{style(f'{addr}:{port}', Colours.FG.BRIGHT_BLUE)}"
+
+    def sendto(self, msg, addr_tuple):
+        self.transport.sendto(msg.to_bin() if isinstance(msg, IPacket) else msg, addr_tuple)
+
+    def broadcast(self, msg, dst_port=10100):
+        self.sendto(msg, ("<broadcast>", dst_port))
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncClient(Client):
+    """
+    The mesh Client on a single asyncio event loop, instead of a thread per
+    port and a retransmit thread that wakes up every 2 seconds.
+
+    - The message and broadcast ports are DatagramProtocol endpoints, every
+      packet is handled on the loop (by the same handlers as the Client).
+    - A single loop timer is set to the first deadline of the retransmit
+      scheduler, so every packet is retransmitted at its own timeout.
+      Another one sends the ACKs that were held back (see _queue_ack()).
+    - The interactive prompt runs in an executor thread, the messages it
+      sends are handed to the loop.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop   = None
+        self.timer  = None  # At the first retransmission deadline
+        self.ack_timer = None  # At the first delayed ACK
+
+    ###########################################################################
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def send(self, address, data, comm_type=CommunicationType.DIRECT_ROUTE):
+        if self._on_loop():
+            super().send(address, data, comm_type)
+        else:
+            self.loop.call_soon_threadsafe(super().send, address, data, comm_type)
+
+    ###########################################################################
+    # Retransmit timers
+
+    def add_expected_ack_for(self, packet):
+        super().add_expected_ack_for(packet)
+        self._set_retransmit_timer()
+
+    def _set_retransmit_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        deadline = self.retransmits.next_deadline()
+        if deadline is not None:
+            self.timer = self.loop.call_later(max(0, deadline - time.time()), self._on_retransmit_timer)
+
+    def _on_retransmit_timer(self):
+        self.timer = None
+
+        for pid in self.retransmits.pop_due():
+            self._retransmit_due(pid)
+
+        self._set_retransmit_timer()
+
+    def _queue_ack(self, key, pid, flush=False):
+        super()._queue_ack(key, pid, flush)
+        if not self.ack_timer:
+            self._set_ack_timer()
+
+    def _set_ack_timer(self):
+        deadline = self.delayed_acks.next_deadline()
+        if deadline is not None:
+            self.ack_timer = self.loop.call_later(max(0, deadline - time.time()), self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        self.ack_timer = None
+
+        for key, pids in self.delayed_acks.pop_due():
+            self._send_acks(key, pids)
+
+        self._set_ack_timer()
+
+    def _housekeeping(self):
+        if self._request_contact_update():
+            self.loop.call_later(2, self._contact_update_done)
+
+        self._evict_history()
+        self.loop.call_later(Client.HOUSEKEEPING_S, self._housekeeping)
+
+    ###########################################################################
+
+    async def _open_endpoints(self):
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramHandler(self._handle_broadcast,
+                                    lambda e: self._error(e, prefix="BroadcastHandler: ")),
+            local_addr=("0.0.0.0", Client.PORT_BROADCAST_SEND), reuse_port=True, allow_broadcast=True)
+        self.broadcast_sock = TransportSocket(transport)
+
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramHandler(self._handle_message,
+                                    lambda e: self._error(e, prefix="MsgHandler: ")),
+            local_addr=("0.0.0.0", Client.PORT_MESSAGES), reuse_port=True)
+        self.serversock = TransportSocket(transport)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._log_settings()
+
+        # Broadcast / flood network to get IPs, and setup message server
+        await self._open_endpoints()
+        self._log("Joining network by broadcasting address info...")
+        self._broadcast_discover()
+
+        try:
+            # Wait a bit for broadcasts to complete
+            await asyncio.sleep(2)
+
+            self._housekeeping()
+            self._send_initial_message()
+
+            if self.interactive:
+                await self.loop.run_in_executor(None, self._interactive)
+            else:
+                await self.loop.create_future()  # Until cancelled
+        finally:
+            if self.timer:
+                self.timer.cancel()
+            if self.ack_timer:
+                self.ack_timer.cancel()
+            self.broadcast_sock.close()
+            self.serversock.close()
+
+
+if __name__ == "__main__":
+    address, interactive, msg, include_these_addresses_only, filter_type = parse_args(sys.argv)
+
+    print("Waiting for keypress... (set-up tcp dump now if wanted)")
+    input()
+
+    client = AsyncClient(address, interactive, msg,
+                         address_whitelist = include_these_addresses_only,
+                         filter_addresses  = filter_type)
+    try:
+        asyncio.run(client.run())
+    except KeyboardInterrupt:
+        pass
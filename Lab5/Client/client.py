@@ -6,11 +6,13 @@ import json
 
 from bits import Bits
 from colours import *
-from opposock import OSocket
-from packet import IPacket, PacketType, ContactRelay
+from opposock import OSocket, UDPSender
+from packet import IPacket, PacketType, PacketException, ContactRelay, Fragment, PredictabilityVector
 from threads import Threading
 
-from client_extra import ClientException, CommunicationType, AddressFilterType, ContactRelayMetadata, MeshMetadata
+from client_extra import ClientException, CommunicationType, AddressFilterType, ContactRelayMetadata, MeshMetadata, \
+                         RouteCache, RetransmitScheduler, SendWindow, SequenceWindow, Reassembler, DelayedAcks, \
+                         SeenCache, DeliveryPredictability
 
 try:
     import traceback
@@ -23,7 +25,13 @@ class Client:
     PORT_BROADCAST_SEND = 10100
     PORT_MESSAGES       = 5000
 
-    MAX_LENGTH = 254
+    MAX_LENGTH = 0xFFFF  # Messages longer than Fragment.SIZE are sent in fragments
+
+    EXTENDED_HEADER = True  # 2 byte packet ids and sequence numbers (1 byte ids if False)
+    SEND_WINDOW     = 16    # Unacknowledged data packets per destination
+    RECV_WINDOW     = 64    # Sequence numbers per source checked for duplicates
+    ACK_DELAY_S     = 0.1   # ACKs to a peer are held back this long, and sent as one packet
+    ACK_MAX_PENDING = 8     # ... or as soon as this many are held back
 
     ADDRESSES = [
         "499123456",
@@ -34,16 +42,31 @@ class Client:
         "499612345",
     ]
 
-    RETRANSMISSION_TIMEOUT_S = 10
+    RETRANSMISSION_TIMEOUT_S = 10   # Until an RTT was measured
+    MIN_RTO_S                = 1
+    MAX_RTO_S                = 60
+    MAX_RETRANSMISSIONS      = 6
+    RTO_JITTER               = 0.1
     OPPO_HISTORY_TTL         = 60
     CONTACTS_TTL             = 60
+    ROUTE_TTL                = 60
+    FLOOD_SEEN_TTL           = 0.5   # Below MIN_RTO_S, so a retransmitted route request is flooded again
+    FLOOD_SEEN_SIZE          = 1024
+    REASSEMBLY_TTL           = 120  # Time to receive every fragment of a message
+    HOUSEKEEPING_S           = 2    # Interval for the contact refresh and history TTLs
+
+    PREDICTABILITY_AGING_S = 10  # Time unit of the delivery predictability ageing
+    PREDICTABILITY_VECTOR  = 32  # Highest predictabilities sent with a discovery
 
 
-    def __init__(self, address, interactive=True, message=None, address_whitelist=None, filter_addresses=AddressFilterType.ALLOW_ALL):
+    def __init__(self, address, interactive=True, message=None, address_whitelist=None, filter_addresses=AddressFilterType.ALLOW_ALL,
+                 local_ip=None, sender=None):
         super().__init__()
         self.address     = Bits.unpack(IPacket.convert_address(Bits.bytes_to_str(address)))
         self.interactive = interactive
-        self.message     = msg
+        self.message     = message
+        self.verbose     = True  # Log every packet (errors are always shown)
+        self.on_message  = None  # on_message(src, data), for every message delivered to self
 
         self.serversock = None
         self.server_addr, self.server_port = 0, 0
@@ -51,7 +74,8 @@ class Client:
         self.broadcast_sock = None
         self.contacts_last_update = time.time() + Client.CONTACTS_TTL * 2
 
-        ipbytes = OSocket.get_local_address_bytes()
+        # The IP announced to contacts (and the sender below) are given on a simulated network, see simulator.py
+        ipbytes = OSocket.get_local_address_bytes() if local_ip is None else bytes(map(int, local_ip.split('.')))
         ipstr   = OSocket.ip_from_bytes(ipbytes)
         self.ipaddr = (ipstr, ipbytes)
 
@@ -61,13 +85,27 @@ class Client:
         }
 
         self.clientsock = None
+        self.sender     = sender or UDPSender()  # Shared by all outgoing messages
 
         self.id_lock      = Threading.new_lock()
+        self.id_bytes     = 2 if Client.EXTENDED_HEADER else 1
         self.ids_in_use   = set()
-        self.last_used_id = 1
+        self.last_used_id = 0
+
+        self.epoch        = random.randrange(1, 0x10000)  # Of this run, contacts reset their SequenceWindow for a new one
+        self.windows_lock = Threading.new_lock()
+        self.send_windows = {}  # { dst: SendWindow }
+        self.recv_windows = {}  # { src: SequenceWindow }
+
+        self.last_msg_id = 0  # Of fragmented messages
+        self.reassembler = Reassembler(Client.REASSEMBLY_TTL)
 
         self.expect_acks_lock = Threading.new_lock()
         self.expect_acks = {}   # { pid: packet }
+        self.retransmits = RetransmitScheduler(Client.RETRANSMISSION_TIMEOUT_S, Client.MIN_RTO_S, Client.MAX_RTO_S,
+                                               Client.MAX_RETRANSMISSIONS, Client.RTO_JITTER)
+
+        self.delayed_acks = DelayedAcks(Client.ACK_DELAY_S, Client.ACK_MAX_PENDING)
 
         self.input_newline = Threading.new_lock()
 
@@ -80,6 +118,11 @@ class Client:
         self.mesh_metadata_lock = Threading.new_lock()
         self.mesh_metadata = {}  # { (pid, src): MeshMetadata }
 
+        self.route_cache = RouteCache(Client.ROUTE_TTL)
+        self.seen_floods = SeenCache(Client.FLOOD_SEEN_SIZE, Client.FLOOD_SEEN_TTL)  # Of RouteRequests
+
+        self.predictability = DeliveryPredictability(self.address, Client.PREDICTABILITY_AGING_S)
+
 
     def __del__(self):
         pass
@@ -98,6 +141,10 @@ class Client:
         """Returns IP as 4 bytes."""
         return self.ipaddr[1]
 
+    def get_discovery_payload(self):
+        # IP address, and the delivery predictabilities for the contact's transitive update
+        return self.get_ipaddress_bytes() + PredictabilityVector.create(self.predictability.vector(Client.PREDICTABILITY_VECTOR))
+
     def get_ipaddress(self):
         """Return IP as dotted string."""
         return self.ipaddr[0]
@@ -107,42 +154,45 @@ class Client:
             print("")
             self.input_newline.release()
 
-    def _log(self, msg):
+    def _print(self, msg):
         self._printnl()
         print(style(f"[Client@{self.get_address()}]", Colours.FG.YELLOW), msg)
 
+    def _log(self, msg):
+        if self.verbose:
+            self._print(msg)
+
     def _error(self, e=None, prefix=""):
         self._printnl()
         if e:
-            self._log(prefix + style(type(e).__name__, Colours.FG.RED) + f": {e}")
+            self._print(prefix + style(type(e).__name__, Colours.FG.RED) + f": {e}")
             if HAS_TRACE:
-                self._log(style(traceback.format_exc(), Colours.FG.BRIGHT_MAGENTA))
+                self._print(style(traceback.format_exc(), Colours.FG.BRIGHT_MAGENTA))
         else:
-            self._log(prefix + style("Unknown error", Colours.FG.RED))
+            self._print(prefix + style("Unknown error", Colours.FG.RED))
 
     ###########################################################################
 
     def next_id(self):
         with self.id_lock:
-            if not self.ids_in_use:
-                self.last_used_id = 1
-                self.ids_in_use.add(1)
-                return Bits.pack(1, 1)
-            else:
-                # Go to next id first, and only reuse lower ones if wrapped back around.
-                next_id = self.last_used_id + 1
-                if next_id == 0xFF:
-                    next_id = 1
+            # Go to next id first, and only reuse lower ones if wrapped back around.
+            max_id  = (1 << (8 * self.id_bytes)) - 1
+            next_id = self.last_used_id
 
-                while next_id in self.ids_in_use:
-                    next_id += 1
+            for _ in range(max_id):
+                next_id = next_id + 1 if next_id + 1 < max_id else 1
 
-                if next_id > 0xFF:
-                    raise ClientException("Largest id reached!")
-                else:
+                if next_id not in self.ids_in_use:
                     self.last_used_id = next_id
                     self.ids_in_use.add(next_id)
-                    return Bits.pack(next_id, 1)
+                    return Bits.pack(next_id, self.id_bytes)
+
+            raise ClientException("No free ids left!")
+
+    def next_msg_id(self):
+        with self.id_lock:
+            self.last_msg_id = self.last_msg_id % 0xFFFF + 1
+            return self.last_msg_id
 
     def add_incoming_id(self, idx):
          with self.id_lock:
@@ -157,7 +207,7 @@ class Client:
             return
 
         with self.addr_book_lock:
-            addr, ip = packet.source_addr, OSocket.ip_from_bytes(packet.payload)
+            addr, ip = packet.source_addr, OSocket.ip_from_bytes(packet.payload[:4])
             self.addr_book[addr] = ip
 
             self._log(style("Address book: ", Colours.FG.GREEN) + \
@@ -174,15 +224,90 @@ class Client:
     def add_expected_ack_for(self, packet):
         with self.expect_acks_lock:
             self.expect_acks[packet.pid] = packet
+        self.retransmits.add(packet.pid, packet.dest_addr, packet.transmit_time)
 
     def check_expected_ack(self, pid):
+        return bool(self.check_expected_acks([pid]))
+
+    def check_expected_acks(self, pids):
+        """Remove every expected pid of an (aggregated) ACK, returns those that were expected."""
+        acked = {}  # { dst: [pid] }
+
         with self.expect_acks_lock:
-            if pid in self.expect_acks:  # and self.expect_acks[pid].dest_addr == source_addr
-                del self.expect_acks[pid]
-                return True
-            else:
+            for pid in pids:
+                packet = self.expect_acks.pop(pid, None)
+                if packet is not None:
+                    self.retransmits.ack(pid)
+                    acked.setdefault(packet.dest_addr, []).append(pid)
+
+        # The windows to the destinations move on
+        for dst, dst_pids in acked.items():
+            self._send_ready(dst, self._window_release(dst, *dst_pids))
+
+        return [pid for dst_pids in acked.values() for pid in dst_pids]
+
+    def _send_window(self, dst):
+        # With windows_lock held
+        window = self.send_windows.get(dst)
+        if window is None:
+            window = self.send_windows[dst] = SendWindow(Client.SEND_WINDOW)
+        return window
+
+    def _sequence(self, packet):
+        # Number a data packet, it is in flight in the window to its destination now.
+        with self.windows_lock:
+            packet.seq   = self._send_window(packet.dest_addr).add(packet.pid)
+            packet.epoch = self.epoch
+
+    def _window_release(self, dst, *pids):
+        with self.windows_lock:
+            window = self.send_windows.get(dst)
+            return window.release(*pids) if window else []
+
+    def _send_ready(self, dst, ready):
+        for data, comm_type in ready:
+            self._send_now(dst, data, comm_type)
+
+    def _deliver(self, packet):
+        # Show a message addressed to self, unless it is a retransmission of one that was already received.
+        with self.windows_lock:
+            window = self.recv_windows.get(packet.source_addr)
+            if window is None:
+                window = self.recv_windows[packet.source_addr] = SequenceWindow(Client.RECV_WINDOW)
+            is_new = window.check(packet.seq, packet.epoch)
+
+        if not is_new:
+            self._log(style(f"Duplicate message {packet.seq} from {packet.source_addr}, ACKing it again.", Colours.FG.BRIGHT_MAGENTA))
+            return False
+
+        data = packet.payload
+
+        if packet.is_fragment():
+            fragment = packet.get_fragment()
+
+            try:
+                data = self.reassembler.add(packet.source_addr, fragment, packet.epoch)
+            except ClientException as e:
+                self._error(e)
                 return False
 
+            if data is None and self.reassembler.is_done(packet.source_addr, fragment.get_msg_id(), packet.epoch):
+                self._log(style(f"Fragment {fragment.get_index() + 1}/{fragment.get_count()} of message {fragment.get_msg_id()} " + \
+                                f"from {packet.source_addr} arrived after it was complete, ignored.", Colours.FG.BRIGHT_MAGENTA))
+                return True
+            elif data is None:
+                received, total = self.reassembler.progress(packet.source_addr, fragment.get_msg_id(), packet.epoch)
+                self._log(style(f"Fragment {fragment.get_index() + 1}/{fragment.get_count()} of message {fragment.get_msg_id()} " + \
+                                f"from {packet.source_addr} ({received}/{total} received)", Colours.FG.BRIGHT_MAGENTA))
+                return True
+
+        self._log(style(f"Incoming message from {packet.source_addr}: ", Colours.FG.GREEN) + \
+                  style(f"{Bits.bytes_to_str(data)}", Colours.FG.BRIGHT_GREEN))
+
+        if self.on_message:
+            self.on_message(packet.source_addr, data)
+        return True
+
     def oppo_get_next_hop_for(self, packet):
         with self.addr_book_lock:
             contact_list = set(filter(lambda x: x != self.get_address(), self.addr_book.keys()))
@@ -222,7 +347,7 @@ class Client:
                      filtered_contacts -= set((old_meta.init_hop,))
 
                 if filtered_contacts:
-                    next_hop = tuple(sorted(filtered_contacts))[0]
+                    next_hop = self.predictability.best_hop(packet.dest_addr, filtered_contacts)
                     old_meta.add_sent_to(next_hop)
                 elif old_meta.init_hop > 0:
                     # If no contact left in list, sent back to initial
@@ -253,8 +378,8 @@ class Client:
                         self._log(style(f"oppo_get_next_hop_for inconsistency: prev hop ({meta.prev_hop}) not in contacts?", Colours.FG.BRIGHT_RED))
                     next_hop = contact_list.pop()
                 else:
-                    # Get next contact, except prev_hop
-                    next_hop = tuple(sorted(contact_list - set((meta.prev_hop,))))[0]
+                    # Get the contact most likely to reach the destination, except prev_hop
+                    next_hop = self.predictability.best_hop(packet.dest_addr, contact_list - set((meta.prev_hop,)))
 
                 meta.add_sent_to(next_hop)
                 self.oppo_metadata[key] = meta
@@ -316,208 +441,252 @@ class Client:
         self.serversock = OSocket.new_udpserver(("", Client.PORT_MESSAGES))
         Threading.new_thread(self._server_thread)
 
-    def _server_thread(self):
-        while True:
-            try:
-                (raw, addr_tuple) = self.serversock.recvfrom(4096)
+    def _handle_message(self, raw, addr_tuple):
+        """Handle a datagram received on the message port."""
+        addr, port = addr_tuple
+        self._log(f"Incoming connection from {addr}:{port}")
 
-                addr, port = addr_tuple
-                self._log(f"Incoming connection from {addr}:{port}")
+        response = IPacket.from_bytes(raw)
 
-                response = IPacket.from_bytes(raw)
+        if not response:
+            return
 
-                if not response:
-                    continue
+        # An ACK is an encounter with the contact it came from
+        if response.ptype == PacketType.MSGACK:
+            self.predictability.encounter(response.source_addr)
+        elif response.ptype == PacketType.CONTACT_RELAY_ACK:
+            self.predictability.encounter(response.prev_hop)
+
+        if response.dest_addr == self.get_address():
+            # Messages addressed to self => send ACK or release expected pid.
+            self._log(f"Received: {response}")
+
+            # Direct Message
+            if response.ptype == PacketType.MESSAGE:
+                is_new = self._deliver(response)
+
+                # ACKed straight back to the address it came from
+                self._queue_ack((PacketType.MSGACK, response.source_addr, addr), response.pid, flush=not is_new)
+            elif response.ptype == PacketType.MSGACK:
+                self._acknowledged(self._get_acked_pids(response), "Message")
+
+            # Contact Relay message (opportunistic)
+            elif response.ptype == PacketType.CONTACT_RELAY:
+                is_new = self._deliver(response)
+
+                self.oppo_remove_packet_from_history(response)
+
+                self._queue_ack((PacketType.CONTACT_RELAY_ACK, response.source_addr, None), response.pid, flush=not is_new)
+            elif response.ptype == PacketType.CONTACT_RELAY_ACK:
+                # Remove sent packets from history
+                pids = self._get_acked_pids(response)
+                for pid in pids:
+                    sent_packet = self.oppo_get_sent_packet(pid)
+                    if sent_packet:
+                        self.oppo_remove_packet_from_history(sent_packet)
+                    elif response.source_addr != self.get_address():
+                        self._log(style(f"Ack received for packet we never sent?", Colours.FG.BRIGHT_RED))
+
+                # Remove pids from expected
+                self._acknowledged(pids, "Message")
+
+            # Route Request message (mesh)
+            elif response.ptype == PacketType.ROUTE_REQUEST:
+                if self._is_flood_duplicate(response):
+                    return
 
-                if response.dest_addr == self.get_address():
-                    # Messages addressed to self => send ACK or release expected pid.
-                    self._log(f"Received: {response}")
-
-                    # Direct Message
-                    if response.ptype == PacketType.MESSAGE:
-                        self._log(style(f"Incoming message from {response.source_addr}: ", Colours.FG.GREEN) + \
-                                  style(f"{Bits.bytes_to_str(response.payload)}", Colours.FG.BRIGHT_GREEN))
-
-                        packet = IPacket.create_message_ack(response.pid,
-                                                            self.get_address(),
-                                                            response.source_addr)
-                        self._log(f"Responding with ACK: {packet}")
-                        self.serversock.sendto(packet, (addr, Client.PORT_MESSAGES))
-                    elif response.ptype == PacketType.MSGACK:
-                        if self.check_expected_ack(response.pid):
-                            self.release_id(response.pid)
-                            self._log(style("Message was acknowledged!", Colours.FG.GREEN))
-
-                    # Contact Relay message (opportunistic)
-                    elif response.ptype == PacketType.CONTACT_RELAY:
-                        self._log(style(f"Incoming message from {response.source_addr}: ", Colours.FG.GREEN) + \
-                                  style(f"{Bits.bytes_to_str(response.payload)}", Colours.FG.BRIGHT_GREEN))
-
-                        self.oppo_remove_packet_from_history(response)
-
-                        packet = IPacket.create_contact_relay_ack(response.pid,
-                                                                  self.get_address(),
-                                                                  response.source_addr,
-                                                                  -1)
-
-                        next_hop = self.oppo_get_next_hop_for(packet)
-                        if next_hop < 0:
-                            self._log(style(f"No valid addresses in address book for next hop (for ACK)!", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        packet.next_hop = next_hop
-
-                        dest_ip = self.address_lookup_ip(next_hop)
-                        if not dest_ip:
-                            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        self._log(f"Responding with ACK: {packet}")
-                        self.serversock.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
-                    elif response.ptype == PacketType.CONTACT_RELAY_ACK:
-                        # Remove sent packet from history
-                        sent_packet = self.oppo_get_sent_packet(response.pid)
-                        if sent_packet:
-                            self.oppo_remove_packet_from_history(sent_packet)
-                        elif response.source_addr != self.get_address():
-                            self._log(style(f"Ack received for packet we never sent?", Colours.FG.BRIGHT_RED))
-
-                        # Remove pid from expected
-                        if self.check_expected_ack(response.pid):
-                            self.release_id(response.pid)
-                            self._log(style("Message was acknowledged!", Colours.FG.GREEN))
-
-                    # Route Request message (mesh)
-                    elif response.ptype == PacketType.ROUTE_REQUEST:
-                        self._log(f"Incoming route request from {response.source_addr}")
-
-                        packet = IPacket.create_route_request_ack(response.pid,
-                                                                  self.get_address(),
-                                                                  response.source_addr,
-                                                                  [self.get_address()] + response.get_reverse_route())
-
-                        next_hop = packet.get_next_hop_from(self.get_address())
-
-                        dest_ip = self.address_lookup_ip(next_hop)
-                        if not dest_ip:
-                            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        self._log(f"Responding with ACK: {packet}")
-                        self.serversock.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
-                    elif response.ptype == PacketType.ROUTE_REQUEST_ACK:
-                        # Remove pid from expected
-                        if self.check_expected_ack(response.pid):
-                            self.release_id(response.pid)
-                            self._log(style(f"Route request was acknowledged to reach {response.source_addr}: ", Colours.FG.GREEN) + \
-                                      style(f"{response.get_reverse_route_string()}", Colours.FG.BRIGHT_GREEN))
-
-                            # Send original message on this route
-                            data = self.mesh_get_and_remove_data(response.pid, response.source_addr)
-
-                            if not data:
-                                self._log(style(f"The received RouteRequest has no related data to send?", Colours.FG.BRIGHT_RED))
-                                continue
-
-                            pid    = self.next_id()
-                            packet = IPacket.create_route_relay(pid,
-                                                                self.get_address(),
-                                                                response.source_addr,
-                                                                response.get_reverse_route(),
-                                                                data)
-
-                            next_hop = packet.get_next_hop_from(self.get_address())
-
-                            dest_ip = self.address_lookup_ip(next_hop)
-                            if not dest_ip:
-                                self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                                continue
-
-                            self._log(f"Sending: {packet}")
-                            self.serversock.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
-                            self.add_expected_ack_for(packet)
-
-                    # Route Relay message (mesh)
-                    elif response.ptype == PacketType.ROUTE_RELAY:
-                        self._log(style(f"Incoming message from {response.source_addr}: ", Colours.FG.GREEN) + \
-                                  style(f"{Bits.bytes_to_str(response.payload)}", Colours.FG.BRIGHT_GREEN))
-
-                        packet = IPacket.create_route_relay_ack(response.pid,
-                                                                self.get_address(),
-                                                                response.source_addr,
-                                                                response.get_reverse_route())
-
-                        next_hop = packet.get_next_hop_from(self.get_address())
-
-                        dest_ip = self.address_lookup_ip(next_hop)
-                        if not dest_ip:
-                            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        self._log(f"Responding with ACK: {packet}")
-                        self.serversock.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
-                    elif response.ptype == PacketType.ROUTE_RELAY_ACK:
-                        # Remove pid from expected
-                        if self.check_expected_ack(response.pid):
-                            self.release_id(response.pid)
-                            self._log(style("Route relay message was acknowledged!", Colours.FG.GREEN))
-                else:
-                    self._log(f"Received: {response}")
-
-                    # Relayed messages, not destined to self => relay further
-                    if response.ptype in (PacketType.CONTACT_RELAY, PacketType.CONTACT_RELAY_ACK):
-                        next_hop = self.oppo_get_next_hop_for(response)
-                        if next_hop < 0:
-                            if response.source_addr == self.get_address():
-                                self._log(style(f"No valid addresses in address book left for next hop, dropping packet!", Colours.FG.BRIGHT_RED))
-                                continue
-
-                            self._log(style(f"No valid addresses in address book for next hop, sending back!", Colours.FG.BRIGHT_RED))
-                            next_hop = response.prev_hop
-
-                        response.prev_hop   = self.get_address()
-                        response.next_hop   = next_hop
-                        response.hop_count += 1
-
-                        if response.hop_count > 255:
-                            self._log(style(f"Max hop count exceeded, dropping packet!", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        dest_ip = self.address_lookup_ip(next_hop)
-                        if not dest_ip:
-                            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                            continue
-
-                        self._log(style(f"Relaying packet to {next_hop}...", Colours.FG.BRIGHT_MAGENTA))
-                        self.serversock.sendto(response, (dest_ip, Client.PORT_MESSAGES))
-
-                    # Mesh Route Request
-                    elif response.ptype == PacketType.ROUTE_REQUEST:
-                        response.add_next_hop(self.get_address())
-                        used_hops = response.get_route()
-
-                        with self.addr_book_lock:
-                            for key in self.addr_book:
-                                if key not in used_hops:
-                                    dest_ip = self.addr_book[key]
-                                    self._log(style(f"Relaying route request to {key}...", Colours.FG.BRIGHT_MAGENTA))
-                                    self.serversock.sendto(response, (dest_ip, Client.PORT_MESSAGES))
-
-                    # Mesh Route Relay
-                    elif response.ptype in (PacketType.ROUTE_REQUEST_ACK, PacketType.ROUTE_RELAY, PacketType.ROUTE_RELAY_ACK):
-                        next_hop = response.get_next_hop_from(self.get_address())
-
-                        with self.addr_book_lock:
-                            if next_hop not in self.addr_book:
-                                self._log(style(f"Unknown address for route hop '{next_hop}'?", Colours.FG.BRIGHT_RED))
-                                continue
-                            dest_ip = self.addr_book[next_hop]
-                            self._log(style(f"Relaying packet to {next_hop}...", Colours.FG.BRIGHT_MAGENTA))
-                            self.serversock.sendto(response, (dest_ip, Client.PORT_MESSAGES))
-
-                    else:
-                        # Unhandled relay type?
-                        self._log(style(f"Unhandled Relay type {PacketType.to_string(response.ptype)}!", Colours.FG.BRIGHT_RED))
+                self._log(f"Incoming route request from {response.source_addr}")
+
+                packet = IPacket.create_route_request_ack(response.pid,
+                                                          self.get_address(),
+                                                          response.source_addr,
+                                                          [self.get_address()] + response.get_reverse_route())
+
+                # The reverse of the request's route leads back to its source
+                self.route_cache.learn(response.source_addr, packet.get_route())
+
+                next_hop = packet.get_next_hop_from(self.get_address())
+
+                dest_ip = self.address_lookup_ip(next_hop)
+                if not dest_ip:
+                    self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
+                    return
+
+                self._log(f"Responding with ACK: {packet}")
+                self.sender.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
+            elif response.ptype == PacketType.ROUTE_REQUEST_ACK:
+                # Remove pid from expected
+                if self.check_expected_ack(response.pid):
+                    self.release_id(response.pid)
+                    self._log(style(f"Route request was acknowledged to reach {response.source_addr}: ", Colours.FG.GREEN) + \
+                              style(f"{response.get_reverse_route_string()}", Colours.FG.BRIGHT_GREEN))
+
+                    # Cache the route, the original message (and any waiting for this route) is sent on it
+                    route   = response.get_reverse_route()
+                    waiting = self.route_cache.resolve(response.source_addr, route)
+                    data    = self.mesh_get_and_remove_data(response.pid, response.source_addr)
+
+                    if data:
+                        waiting.insert(0, data)
+
+                    if not waiting:
+                        self._log(style(f"The received RouteRequest has no related data to send?", Colours.FG.BRIGHT_RED))
+                        return
+
+                    # Through the send window, ahead of the messages that are waiting for it already
+                    with self.windows_lock:
+                        window = self._send_window(response.source_addr)
+                        window.waiting.extendleft(reversed([(data, CommunicationType.MESH) for data in waiting]))
+                        ready = window.release()
+
+                    self._send_ready(response.source_addr, ready)
+
+            # Route Relay message (mesh)
+            elif response.ptype == PacketType.ROUTE_RELAY:
+                is_new = self._deliver(response)
+
+                # ACKed back on the reverse route, which is cached as well
+                route = response.get_reverse_route()
+                self.route_cache.learn(response.source_addr, route)
+
+                self._queue_ack((PacketType.ROUTE_RELAY_ACK, response.source_addr, tuple(route)), response.pid, flush=not is_new)
+            elif response.ptype == PacketType.ROUTE_RELAY_ACK:
+                # Remove pids from expected
+                self._acknowledged(self._get_acked_pids(response), "Route relay message")
+        else:
+            self._log(f"Received: {response}")
+
+            # Relayed messages, not destined to self => relay further
+            if response.ptype in (PacketType.CONTACT_RELAY, PacketType.CONTACT_RELAY_ACK):
+                next_hop = self.oppo_get_next_hop_for(response)
+                if next_hop < 0:
+                    if response.source_addr == self.get_address():
+                        self._log(style(f"No valid addresses in address book left for next hop, dropping packet!", Colours.FG.BRIGHT_RED))
+                        return
+
+                    self._log(style(f"No valid addresses in address book for next hop, sending back!", Colours.FG.BRIGHT_RED))
+                    next_hop = response.prev_hop
+
+                response.prev_hop   = self.get_address()
+                response.next_hop   = next_hop
+                response.hop_count += 1
+
+                if response.hop_count > 255:
+                    self._log(style(f"Max hop count exceeded, dropping packet!", Colours.FG.BRIGHT_RED))
+                    return
+
+                dest_ip = self.address_lookup_ip(next_hop)
+                if not dest_ip:
+                    self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
+                    return
+
+                self._log(style(f"Relaying packet to {next_hop}...", Colours.FG.BRIGHT_MAGENTA))
+                self.sender.sendto(response, (dest_ip, Client.PORT_MESSAGES))
+
+            # Mesh Route Request
+            elif response.ptype == PacketType.ROUTE_REQUEST:
+                if self._is_flood_duplicate(response):
+                    return
+
+                response.add_next_hop(self.get_address())
+                used_hops = response.get_route()
+
+                with self.addr_book_lock:
+                    contacts = [(key, ip) for key, ip in self.addr_book.items() if key not in used_hops]
+
+                for key, dest_ip in contacts:
+                    self._log(style(f"Relaying route request to {key}...", Colours.FG.BRIGHT_MAGENTA))
+                self._transmit_packet_many([ip for key, ip in contacts], response)
+
+            # Mesh Route Relay
+            elif response.ptype in (PacketType.ROUTE_REQUEST_ACK, PacketType.ROUTE_RELAY, PacketType.ROUTE_RELAY_ACK):
+                next_hop = response.get_next_hop_from(self.get_address())
+
+                dest_ip = self.address_lookup_ip(next_hop)
+                if not dest_ip:
+                    self._log(style(f"Unknown address for route hop '{next_hop}'?", Colours.FG.BRIGHT_RED))
+                    return
+
+                self._log(style(f"Relaying packet to {next_hop}...", Colours.FG.BRIGHT_MAGENTA))
+                self.sender.sendto(response, (dest_ip, Client.PORT_MESSAGES))
+
+            else:
+                # Unhandled relay type?
+                self._log(style(f"Unhandled Relay type {PacketType.to_string(response.ptype)}!", Colours.FG.BRIGHT_RED))
+
+    def _queue_ack(self, key, pid, flush=False):
+        # The ACK for pid is sent after ACK_DELAY_S, together with the others for key = (ACK type, peer, way back).
+        if len(pid) != 2:
+            # A peer with 1 byte pids has the original header, which has no ACKS flag: one ACK per packet, right away
+            self._send_acks(key, [pid])
+            return
+
+        pids = self.delayed_acks.add(key, pid, flush)
+        if pids:
+            self._send_acks(key, pids)
+
+    def _send_acks(self, key, pids):
+        # One ACK packet for every pid held back for key
+        ptype, dst, path = key
+
+        if ptype == PacketType.MSGACK:
+            packet   = IPacket.create_message_ack(pids[0], self.get_address(), dst)
+            next_hop = dst
+            dest_ip  = path
+        elif ptype == PacketType.CONTACT_RELAY_ACK:
+            packet   = IPacket.create_contact_relay_ack(pids[0], self.get_address(), dst, -1)
+            next_hop = self.oppo_get_next_hop_for(packet)
+            if next_hop < 0:
+                self._log(style(f"No valid addresses in address book for next hop (for ACK)!", Colours.FG.BRIGHT_RED))
+                return
+
+            packet.next_hop = next_hop
+            dest_ip = self.address_lookup_ip(next_hop)
+        else:
+            packet   = IPacket.create_route_relay_ack(pids[0], self.get_address(), dst, list(path))
+            next_hop = packet.get_next_hop_from(self.get_address())
+            dest_ip  = self.address_lookup_ip(next_hop)
+
+        if not dest_ip:
+            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
+            return
+
+        packet.set_acked_pids(pids)
+        self._log(f"Responding with ACK: {packet}")
+        self.sender.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
+
+    def _get_acked_pids(self, response):
+        try:
+            return response.get_acked_pids()
+        except PacketException as e:
+            self._error(e)
+            return []
+
+    def _acknowledged(self, pids, what):
+        # Remove the pids of an (aggregated) ACK from expected, their ids can be reused.
+        acked = self.check_expected_acks(pids)
+        for pid in acked:
+            self.release_id(pid)
+
+        if len(acked) == 1:
+            self._log(style(f"{what} was acknowledged!", Colours.FG.GREEN))
+        elif acked:
+            self._log(style(f"{len(acked)} {what.lower()}s were acknowledged!", Colours.FG.GREEN))
+
+    def _handle_delayed_acks(self):
+        while True:
+            # Sleeps until the first held back ACK is due
+            for key, pids in self.delayed_acks.wait_due(Client.HOUSEKEEPING_S):
+                try:
+                    self._send_acks(key, pids)
+                except Exception as e:
+                    self._error(e, prefix="AckHandler: ")
+
+    def _server_thread(self):
+        while True:
+            try:
+                (raw, addr_tuple) = self.serversock.recvfrom(4096)
+                self._handle_message(raw, addr_tuple)
             except socket.timeout:
                 self._log(f"{self.serversock}: {style('Timeout!', Colours.FG.RED)}")
             except socket.error:
@@ -530,19 +699,22 @@ class Client:
         self._log("Joining network by broadcasting address info...")
 
         self.broadcast_sock = OSocket.new_broadcastserver(("", Client.PORT_BROADCAST_SEND))
+        self._broadcast_discover()
+
+        Threading.new_thread(self._server_handle_broadcast_incoming)
 
-        pack = IPacket.create_discover(self.next_id(), self.get_address(), self.get_ipaddress_bytes())
+    def _broadcast_discover(self):
+        pack = IPacket.create_discover(self.next_id(), self.get_address(), self.get_discovery_payload())
 
         self._log(f"Broadcasting {pack}")
         self.broadcast_sock.broadcast(pack, dst_port=Client.PORT_BROADCAST_SEND)
 
-        Threading.new_thread(self._server_handle_broadcast_incoming)
-
-    def _network_refresh_contacts(self):
+    def _request_contact_update(self):
+        """Ask the contacts to rediscover if the TTL is reached, returns True if it was sent."""
         if time.time() - self.contacts_last_update <= Client.CONTACTS_TTL:
-            return
+            return False
 
-        pack = IPacket.create_discover(self.next_id(), self.get_address(), self.get_ipaddress_bytes())
+        pack = IPacket.create_discover(self.next_id(), self.get_address(), self.get_discovery_payload())
 
         self._log(style("Requesting contact update...", Colours.FG.BRIGHT_MAGENTA))
 
@@ -554,59 +726,68 @@ class Client:
             if addr != self.get_address():
                 self.broadcast_sock.sendto(pack, (ip, Client.PORT_BROADCAST_SEND))
 
-        time.sleep(2)
+        self.release_id(pack.pid)
+        self.contacts_last_update = time.time()
+        return True
+
+    def _contact_update_done(self):
         self.contacts_last_update = time.time()
         self._log(style("Contact update complete!", Colours.FG.BRIGHT_MAGENTA))
 
-    def _server_handle_broadcast_incoming(self):
-        while True:
-            try:
-                (raw, addr_tuple) = self.broadcast_sock.recvfrom(4096)
-                ip, port = addr_tuple
+    def _handle_broadcast(self, raw, addr_tuple):
+        """Handle a datagram received on the broadcast port."""
+        ip, port = addr_tuple
 
-                if ip == self.get_ipaddress():
-                    # Don't answer self
-                    continue
+        if ip == self.get_ipaddress():
+            # Don't answer self
+            return
 
-                self._log(f"Incoming broadcast from {ip}:{port}...")
+        self._log(f"Incoming broadcast from {ip}:{port}...")
 
-                response = IPacket.from_bytes(raw)
-                if not response:
-                    continue
+        response = IPacket.from_bytes(raw)
+        if not response:
+            return
 
-                self._log(f"Received: {response}")
+        self._log(f"Received: {response}")
 
-                # Only parse contacts specified from cmdline param list
-                if self.address_whitelist and response.source_addr not in self.address_whitelist:
-                    self._log(style(f"Ignoring packet from {response.source_addr}, due to whitelist.", Colours.FG.BRIGHT_RED))
-                    continue
+        # Only parse contacts specified from cmdline param list
+        if self.address_whitelist and response.source_addr not in self.address_whitelist:
+            self._log(style(f"Ignoring packet from {response.source_addr}, due to whitelist.", Colours.FG.BRIGHT_RED))
+            return
 
-                # Apply address/contact filtering on Discovery Ack
-                if not AddressFilterType.check_allow_address_communication(self.filter_addresses, self.get_address(), response.source_addr):
-                    # Discard packet
-                    self._log(style(f"Ignoring knowledge of {response.source_addr}, due to address filter.", Colours.FG.BRIGHT_RED))
-                    continue
+        # Apply address/contact filtering on Discovery Ack
+        if not AddressFilterType.check_allow_address_communication(self.filter_addresses, self.get_address(), response.source_addr):
+            # Discard packet
+            self._log(style(f"Ignoring knowledge of {response.source_addr}, due to address filter.", Colours.FG.BRIGHT_RED))
+            return
 
-                ######################################################
-
-                if response.ptype == PacketType.DISCACK:
-                    # Quick test for consistency: ip in payload should be the same as socket ip
-                    if OSocket.ip_from_bytes(response.payload) != ip:
-                        self._log(style(f"Wrong IP address in {PacketType.to_string(response.ptype)} payload?", Colours.FG.BRIGHT_RED))
-
-                elif response.ptype == PacketType.DISCOVER:
-                    # Send DISCACK
-                    pid = self.next_id()
-                    packet = IPacket.create_discover_ack(pid,
-                                                            self.get_address(),
-                                                            response.source_addr,
-                                                            self.get_ipaddress_bytes())
-                    self._log(f"Responding with ACK: {packet}")
-                    self.broadcast_sock.sendto(packet, (ip, Client.PORT_BROADCAST_SEND))
-                    self.release_id(pid)
-
-                # Always add address for new broadcasts
-                self.add_new_address(response)
+        ######################################################
+
+        if response.ptype == PacketType.DISCACK:
+            # Quick test for consistency: ip in payload should be the same as socket ip
+            if OSocket.ip_from_bytes(response.payload[:4]) != ip:
+                self._log(style(f"Wrong IP address in {PacketType.to_string(response.ptype)} payload?", Colours.FG.BRIGHT_RED))
+
+        elif response.ptype == PacketType.DISCOVER:
+            # Send DISCACK
+            pid = self.next_id()
+            packet = IPacket.create_discover_ack(pid,
+                                                    self.get_address(),
+                                                    response.source_addr,
+                                                    self.get_discovery_payload())
+            self._log(f"Responding with ACK: {packet}")
+            self.broadcast_sock.sendto(packet, (ip, Client.PORT_BROADCAST_SEND))
+            self.release_id(pid)
+
+        # Always add address for new broadcasts
+        self.add_new_address(response)
+        self.predictability.encounter(response.source_addr, PredictabilityVector(response.payload[4:]).get_entries())
+
+    def _server_handle_broadcast_incoming(self):
+        while True:
+            try:
+                (raw, addr_tuple) = self.broadcast_sock.recvfrom(4096)
+                self._handle_broadcast(raw, addr_tuple)
             except (EOFError, KeyboardInterrupt) as e:
                 self._log(f"Requested exit from broadcast handler ({style(type(e).__name__, Colours.FG.RED)}).")
                 return
@@ -614,88 +795,181 @@ class Client:
                 self._error(e, prefix="BroadcastHandler")
 
     def _transmit_packet(self, dest_ip, packet):
-        # Create new UDP socket and send the packet to the destination.
-        sock = OSocket.new_upd()
-        sock.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
+        # Send the packet to the destination, over the shared UDP socket.
+        self.sender.sendto(packet, (dest_ip, Client.PORT_MESSAGES))
+        packet.transmit_time = time.time()
+
+    def _transmit_packet_many(self, dest_ips, packet):
+        # Send the same packet to every destination, it is only encoded once.
+        self.sender.send_many(packet, [(dest_ip, Client.PORT_MESSAGES) for dest_ip in dest_ips])
         packet.transmit_time = time.time()
 
+    def _contact_ips(self):
+        with self.addr_book_lock:
+            return [ip for key, ip in self.addr_book.items() if key != self.get_address()]
+
+    def _flood(self, packet):
+        # Send a RouteRequest of our own to every contact, the copies that come back are duplicates.
+        self.seen_floods.check(packet.source_addr, packet.pid)
+        self._transmit_packet_many(self._contact_ips(), packet)
+
+    def _is_flood_duplicate(self, packet):
+        # Only the first copy of a RouteRequest is answered or flooded further, the others came over slower paths.
+        if self.seen_floods.check(packet.source_addr, packet.pid):
+            return False
+
+        self._log(style(f"Dropping duplicate route request {Bits.unpack(packet.pid)} from {packet.source_addr}.", Colours.FG.BRIGHT_MAGENTA))
+        return True
+
+    def _retransmit(self, pid, packet):
+        """
+        Retransmit an unACKed packet (with expect_acks_lock held).
+        Returns False if the packet has to be dropped instead.
+        """
+        self._log(style(f"Retransmitting packet with id {Bits.unpack(packet.pid)}...", Colours.FG.BRIGHT_MAGENTA))
+
+        # Direct Delivery
+        if packet.ptype == PacketType.MESSAGE:
+            dest_ip = self.address_lookup_ip(packet.dest_addr)
+            if dest_ip:
+                self._transmit_packet(dest_ip, packet)
+            else:
+                self._log(style(f"Unknown address '{packet.dest_addr}' for retransmit?", Colours.FG.BRIGHT_RED))
+
+        # Opportunistic Contact Relay
+        elif packet.ptype == PacketType.CONTACT_RELAY:
+            next_hop = self.oppo_get_next_hop_for(packet)
+            if next_hop < 0:
+                # Reset history
+                self.oppo_remove_packet_from_history(packet)
+                next_hop = self.oppo_get_next_hop_for(packet)
+
+            if next_hop < 0:
+                self._log(style(f"No valid addresses in address book left for retramsmit, dropping packet!", Colours.FG.BRIGHT_RED))
+                return False
+
+            packet.next_hop = next_hop
+
+            dest_ip = self.address_lookup_ip(packet.next_hop)
+            if dest_ip:
+                self._transmit_packet(dest_ip, packet)
+            else:
+                self._log(style(f"Unknown address '{next_hop}' for retransmit?", Colours.FG.BRIGHT_RED))
+
+        # Mesh Route Request or Relay
+        elif packet.ptype in (PacketType.ROUTE_REQUEST, PacketType.ROUTE_RELAY):
+            if packet.ptype == PacketType.ROUTE_RELAY:
+                # If RouteRelay failed, its route is broken, so resend a RouteRequest
+                # to discover a new route if possible (unless one is already pending).
+                self.route_cache.invalidate(packet.dest_addr)
+
+                if not self.route_cache.request(packet.dest_addr, packet.payload):
+                    self._log(style(f"Route request to {packet.dest_addr} pending, message queued.", Colours.FG.BRIGHT_MAGENTA))
+                    return False
+
+                self.mesh_add_data(packet.pid, packet.dest_addr, packet.payload)
+                packet = IPacket.create_route_request(packet.pid, self.get_address(), packet.dest_addr, [self.get_address()])
+                self.expect_acks[pid] = packet
+
+                # A new route discovery: its own retransmissions, from attempt 0 at the base RTO
+                self.retransmits.forget(pid)
+                self.retransmits.add(pid, packet.dest_addr)
+
+            # Resend RouteRequest to every contact
+            self._flood(packet)
+
+        else:
+            self._log(style(f"Unknown packet type '{PacketType.to_string(packet.ptype)}' for retransmit?", Colours.FG.BRIGHT_RED))
+
+        return True
+
+    def _drop_unacked(self, pid, packet):
+        # Give up on an unACKed packet (with expect_acks_lock held).
+        del self.expect_acks[pid]
+        self.release_id(pid)
+        self.retransmits.forget(pid, dropped=True)
+
+        if packet.ptype == PacketType.ROUTE_REQUEST:
+            # Nothing can be sent without a route
+            dropped = len(self.route_cache.abandon(packet.dest_addr))
+            if self.mesh_get_and_remove_data(pid, packet.dest_addr):
+                dropped += 1
+            with self.windows_lock:
+                dropped += self._send_window(packet.dest_addr).discard(CommunicationType.MESH)
+            self._log(style(f"No route found to {packet.dest_addr}, dropped {dropped} message(s)!", Colours.FG.BRIGHT_RED))
+        elif packet.ptype == PacketType.CONTACT_RELAY:
+            self.oppo_remove_packet_from_history(packet)
+
+    def _retransmit_due(self, pid):
+        # Retransmit a packet of which the retransmission timeout passed.
+        ready = []
+
+        with self.expect_acks_lock:
+            packet = self.expect_acks.get(pid)
+            if packet is None:
+                self.retransmits.forget(pid)
+                return
+
+            if self.retransmits.exhausted(pid):
+                self._log(style(f"Packet with id {Bits.unpack(pid)} was not acknowledged after {Client.MAX_RETRANSMISSIONS} retransmissions, dropping it!",
+                                Colours.FG.BRIGHT_RED))
+                self._drop_unacked(pid, packet)
+                ready = self._window_release(packet.dest_addr, pid)
+            elif not self._retransmit(pid, packet):
+                del self.expect_acks[pid]
+                self.release_id(pid)
+                self.retransmits.forget(pid)
+                ready = self._window_release(packet.dest_addr, pid)
+            elif self.expect_acks.get(pid) is packet:
+                self.retransmits.backoff(pid)
+            # else the RouteRelay became a RouteRequest, which was scheduled anew
+
+        self._send_ready(packet.dest_addr, ready)
+
+    def _evict_history(self):
+        # Check OppoMetadata history and remove entries if TTL reached.
+        with self.oppo_metadata_lock:
+            current_time = time.time()
+
+            for key in tuple(self.oppo_metadata.keys()):
+                meta = self.oppo_metadata[key]
+
+                if current_time - meta.last_seen > Client.OPPO_HISTORY_TTL:
+                    self._log(style(f"Removed {meta} from history due to TTL reached!", Colours.FG.BRIGHT_MAGENTA))
+                    del self.oppo_metadata[key]
+
+        # Remove cached routes if TTL reached.
+        for entry in self.route_cache.evict_expired():
+            self._log(style(f"Removed {entry} from route cache due to TTL reached!", Colours.FG.BRIGHT_MAGENTA))
+
+        # Drop messages of which not every fragment arrived in time.
+        for src, msg_id, missing in self.reassembler.evict_expired():
+            self._log(style(f"Dropped message {msg_id} from {src}, {missing} fragment(s) missing after TTL!", Colours.FG.BRIGHT_RED))
+
     def _handle_retransmit(self):
+        next_housekeeping = 0
+        contact_update_done_at = 0
+
         while True:
-            self._network_refresh_contacts()
-
-            # Check for unACKed packets, and retransmit if timeout reached.
-            with self.expect_acks_lock:
-                current_time = time.time()
-                drop_permanently = []
-
-                for pid, packet in self.expect_acks.items():
-                    if current_time - packet.transmit_time > Client.RETRANSMISSION_TIMEOUT_S:
-                        # Too long ago, retransmit packet
-                        self._log(style(f"Retransmitting packet with id {Bits.unpack(packet.pid)}...", Colours.FG.BRIGHT_MAGENTA))
-
-                        # Direct Delivery
-                        if packet.ptype == PacketType.MESSAGE:
-                            dest_ip = self.address_lookup_ip(packet.dest_addr)
-                            if dest_ip:
-                                self._transmit_packet(dest_ip, packet)
-                            else:
-                                self._log(style(f"Unknown address '{packet.dest_addr}' for retransmit?", Colours.FG.BRIGHT_RED))
-
-                        # Opportunistic Contact Relay
-                        elif packet.ptype == PacketType.CONTACT_RELAY:
-                            next_hop = self.oppo_get_next_hop_for(packet)
-                            if next_hop < 0:
-                                # Reset history
-                                self.oppo_remove_packet_from_history(packet)
-                                next_hop = self.oppo_get_next_hop_for(packet)
-
-                            if next_hop < 0:
-                                self._log(style(f"No valid addresses in address book left for retramsmit, dropping packet!", Colours.FG.BRIGHT_RED))
-                                drop_permanently.append(pid)
-                                continue
-
-                            packet.next_hop = next_hop
-
-                            dest_ip = self.address_lookup_ip(packet.next_hop)
-                            if dest_ip:
-                                self._transmit_packet(dest_ip, packet)
-                            else:
-                                self._log(style(f"Unknown address '{next_hop}' for retransmit?", Colours.FG.BRIGHT_RED))
-
-                        # Mesh Route Request or Relay
-                        elif packet.ptype in (PacketType.ROUTE_REQUEST, PacketType.ROUTE_RELAY):
-                            if packet.ptype == PacketType.ROUTE_RELAY:
-                                # If RouteRelay failed, resend a RouteRequest to discover a new route if possible.
-                                self.mesh_add_data(packet.pid, packet.dest_addr, packet.payload)
-                                packet = IPacket.create_route_request(packet.pid, self.get_address(), packet.dest_addr, [self.get_address()])
-
-                            # Resend RouteRequest to every contact
-                            with self.addr_book_lock:
-                                for key in self.addr_book:
-                                    dest_ip = self.addr_book[key]
-                                    self._transmit_packet(dest_ip, packet)
-
-                        else:
-                            self._log(style(f"Unknown packet type '{PacketType.to_string(packet.ptype)}' for retransmit?", Colours.FG.BRIGHT_RED))
-
-                for pid in drop_permanently:
-                    del self.expect_acks[pid]
-
-            # Check OppoMetadata history and remove entries if TTL reached.
-            with self.oppo_metadata_lock:
-                current_time = time.time()
-
-                for key in tuple(self.oppo_metadata.keys()):
-                    meta = self.oppo_metadata[key]
-
-                    if current_time - meta.last_seen > Client.OPPO_HISTORY_TTL:
-                        self._log(style(f"Removed {meta} from history due to TTL reached!", Colours.FG.BRIGHT_MAGENTA))
-                        del self.oppo_metadata[key]
-
-            time.sleep(2)
+            # Sleeps until the first retransmission deadline
+            for pid in self.retransmits.wait_due(Client.HOUSEKEEPING_S):
+                self._retransmit_due(pid)
 
+            current_time = time.time()
 
-    def start(self):
+            if contact_update_done_at and current_time >= contact_update_done_at:
+                contact_update_done_at = 0
+                self._contact_update_done()
+
+            if current_time >= next_housekeeping:
+                next_housekeeping = current_time + Client.HOUSEKEEPING_S
+
+                if self._request_contact_update():
+                    contact_update_done_at = current_time + 2
+                self._evict_history()
+
+
+    def _log_settings(self):
         self._log(f"Setting up client at {self.get_ipaddress()}...")
 
         if self.address_whitelist:
@@ -707,18 +981,7 @@ class Client:
         self._log(style(f"Applying filter to broadcasts: {AddressFilterType.to_string(self.filter_addresses)}",
                         Colours.FG.BRIGHT_MAGENTA))
 
-        # Broadcast / flood network to get IPs
-        self._join_network()
-
-        # Setup message server
-        self._setup_message_server()
-
-        # Wait a bit for broadcasts to complete
-        time.sleep(2)
-
-        # Setup retransmit handler
-        Threading.new_thread(self._handle_retransmit)
-
+    def _send_initial_message(self):
         # Send first message from cmd line if set
         if self.message:
             self._log("Sending initial message from cmd...")
@@ -734,78 +997,129 @@ class Client:
 
             check, msg = self._check_msg(msg)
             if check:
-                self.send(adr, msg)
+                self.send(adr, msg, comm_type)
             else:
                 self._log(style(f"Invalid message! ('{msg}' to {adr})", Colours.FG.RED))
 
-        # If interactive, loop and ask for new messages
-        if self.interactive:
-            print(style("Enter an address in the form <number>@<communication_type>, " + \
-                        f"where communication_type is one of {CommunicationType.CHOICES} " + \
-                        f"\n(meaning: {', '.join(map(CommunicationType.to_string, CommunicationType.CHOICES))})",
-                        Colours.FG.BRIGHT_YELLOW))
+    def _interactive(self):
+        # Loop and ask for new messages
+        print(style("Enter an address in the form <number>@<communication_type>, " + \
+                    f"where communication_type is one of {CommunicationType.CHOICES} " + \
+                    f"\n(meaning: {', '.join(map(CommunicationType.to_string, CommunicationType.CHOICES))})",
+                    Colours.FG.BRIGHT_YELLOW))
+
+        while True:
+            try:
+                self.input_newline.acquire(False)
+                adr = input(style("Enter an address    >", Colours.BG.YELLOW, Colours.FG.BLACK) + " ")
+                if not adr:
+                    continue
+
+                # DEBUG COMMANDS
+                if adr in ("contacts", "book"):
+                    # Print address book
+                    if self.input_newline.locked():
+                        self.input_newline.release()
+                    self._log(style("Address book: ", Colours.FG.GREEN) + \
+                              style(", ".join(map(str, sorted(self.addr_book.keys()))), Colours.FG.BRIGHT_GREEN))
+                    continue
+                elif adr == "oppometa":
+                    # Print Opportunistic ContactRelay metadata
+                    with self.oppo_metadata_lock:
+                        for val in self.oppo_metadata.values():
+                            print(val)
+                    continue
+                elif adr == "meshmeta":
+                    # Print Mesh RouteRelay metadata
+                    with self.mesh_metadata_lock:
+                        for val in self.mesh_metadata.values():
+                            print(val)
+                    continue
+                elif adr == "traffic":
+                    # Print packets/bytes sent per neighbour
+                    print(self.sender)
+                    for ip, (packets, size) in sorted(self.sender.get_stats().items()):
+                        print(f"{ip}: {packets} packets, {size} bytes")
+                    continue
+                elif adr == "rtt":
+                    # Print retransmission timeouts per peer
+                    print(self.retransmits)
+                    for peer, rtt in sorted(self.retransmits.get_rtts().items()):
+                        print(f"{peer}: {rtt}")
+                    continue
+                elif adr == "acks":
+                    # Print ACKs held back, and how many were sent together
+                    print(self.delayed_acks)
+                    continue
+                elif adr == "prophet":
+                    # Print delivery predictabilities, own and of the contacts
+                    print(self.predictability)
+                    for x, p, via in self.predictability.entries():
+                        print(f"{x}: {p:.3f} " + ", ".join(f"{b}={p_bx:.3f}" for b, p_bx in sorted(via.items())))
+                    continue
+                elif adr == "routes":
+                    # Print Mesh route cache
+                    print(self.route_cache)
+                    print(self.seen_floods)
+                    for val in self.route_cache.entries():
+                        print(val)
+                    continue
 
-            while True:
                 try:
-                    self.input_newline.acquire(False)
-                    adr = input(style("Enter an address    >", Colours.BG.YELLOW, Colours.FG.BLACK) + " ")
-                    if not adr:
-                        continue
+                    adr, comm_type = adr.rsplit('@', 1)
+                    comm_type = int(comm_type)
+                except:
+                    comm_type = CommunicationType.DIRECT_ROUTE
 
-                    # DEBUG COMMANDS
-                    if adr in ("contacts", "book"):
-                        # Print address book
+                adr = Bits.unpack(IPacket.convert_address(Bits.bytes_to_str(adr)))
+
+                # DIRECT_ROUTE, OPPORTUNISTIC, MESH
+                if comm_type == CommunicationType.DIRECT_ROUTE:
+                    if not self.address_exists(adr):
                         if self.input_newline.locked():
                             self.input_newline.release()
-                        self._log(style("Address book: ", Colours.FG.GREEN) + \
-                                  style(", ".join(map(str, sorted(self.addr_book.keys()))), Colours.FG.BRIGHT_GREEN))
-                        continue
-                    elif adr == "oppometa":
-                        # Print Opportunistic ContactRelay metadata
-                        with self.oppo_metadata_lock:
-                            for val in self.oppo_metadata.values():
-                                print(val)
-                        continue
-                    elif adr == "meshmeta":
-                        # Print Mesh RouteRelay metadata
-                        with self.mesh_metadata_lock:
-                            for val in self.mesh_metadata.values():
-                                print(val)
+                        self._log(style(f"Unknown address '{adr}'?", Colours.FG.BRIGHT_RED))
                         continue
+                elif comm_type == CommunicationType.OPPORTUNISTIC:
+                    pass
+                elif comm_type == CommunicationType.MESH:
+                    pass
 
-                    try:
-                        adr, comm_type = adr.rsplit('@', 1)
-                        comm_type = int(comm_type)
-                    except:
-                        comm_type = CommunicationType.DIRECT_ROUTE
-
-                    adr = Bits.unpack(IPacket.convert_address(Bits.bytes_to_str(adr)))
-
-                    # DIRECT_ROUTE, OPPORTUNISTIC, MESH
-                    if comm_type == CommunicationType.DIRECT_ROUTE:
-                        if not self.address_exists(adr):
-                            if self.input_newline.locked():
-                                self.input_newline.release()
-                            self._log(style(f"Unknown address '{adr}'?", Colours.FG.BRIGHT_RED))
-                            continue
-                    elif comm_type == CommunicationType.OPPORTUNISTIC:
-                        pass
-                    elif comm_type == CommunicationType.MESH:
-                        pass
-
-                    self.input_newline.acquire(False)
-                    msg = input(style("Enter a new message >", Colours.BG.YELLOW, Colours.FG.BLACK) + " ")
-                    check, msg = self._check_msg(msg)
-
-                    if check:
-                        self.send(adr, msg, comm_type)
-                    else:
-                        self._log(style("Invalid message!", Colours.FG.RED))
-                except (EOFError, KeyboardInterrupt) as e:
-                    print("")
-                    self._log(f"Requested exit from interactive mode ({style(type(e).__name__, Colours.FG.RED)}).")
-                    sys.exit()
-                    return
+                self.input_newline.acquire(False)
+                msg = input(style("Enter a new message >", Colours.BG.YELLOW, Colours.FG.BLACK) + " ")
+                check, msg = self._check_msg(msg)
+
+                if check:
+                    self.send(adr, msg, comm_type)
+                else:
+                    self._log(style("Invalid message!", Colours.FG.RED))
+            except (EOFError, KeyboardInterrupt) as e:
+                print("")
+                self._log(f"Requested exit from interactive mode ({style(type(e).__name__, Colours.FG.RED)}).")
+                sys.exit()
+                return
+
+    def start(self):
+        self._log_settings()
+
+        # Broadcast / flood network to get IPs
+        self._join_network()
+
+        # Setup message server
+        self._setup_message_server()
+
+        # Wait a bit for broadcasts to complete
+        time.sleep(2)
+
+        # Setup retransmit and delayed ACK handlers
+        Threading.new_thread(self._handle_retransmit)
+        Threading.new_thread(self._handle_delayed_acks)
+
+        self._send_initial_message()
+
+        # If interactive, loop and ask for new messages
+        if self.interactive:
+            self._interactive()
 
     def _send_direct(self, address, data):
         dest_ip = self.address_lookup_ip(address)
@@ -819,6 +1133,7 @@ class Client:
 
         pid = self.next_id()
         packet = IPacket.create_message(pid, self.get_address(), address, data)
+        self._sequence(packet)
         self._log(f"Sending: {packet}")
         self._transmit_packet(dest_ip, packet)
         self.add_expected_ack_for(packet)
@@ -843,44 +1158,92 @@ class Client:
             self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
             return
 
+        self._sequence(packet)
         self._log(f"Sending: {packet}")
         self._log(style(f"Relaying packet to {next_hop}...", Colours.FG.BRIGHT_MAGENTA))
         self._transmit_packet(dest_ip, packet)
         self.add_expected_ack_for(packet)
 
+    def _send_route_relay(self, address, route, data):
+        pid    = self.next_id()
+        packet = IPacket.create_route_relay(pid, self.get_address(), address, route, data)
+
+        next_hop = packet.get_next_hop_from(self.get_address())
+
+        dest_ip = self.address_lookup_ip(next_hop)
+        if not dest_ip:
+            self._log(style(f"Unknown address '{next_hop}'?", Colours.FG.BRIGHT_RED))
+            self.release_id(pid)
+            self.route_cache.invalidate(address)
+            return False
+
+        self._sequence(packet)
+        self._log(f"Sending: {packet}")
+        self._transmit_packet(dest_ip, packet)
+        self.add_expected_ack_for(packet)
+        return True
+
     def _send_mesh(self, address, data):
         self._log(f"Sending to {address} with {CommunicationType.to_string(CommunicationType.MESH)}: {data}")
 
-        pid = self.next_id()
+        if self.address_exists(address):
+            # Send RouteRelay to contact in address book
+            self._send_route_relay(address, [self.get_address(), address], data)
+            return
 
-        with self.addr_book_lock:
-            if address in self.addr_book:
-                # Send RouteRelay to contact in address book
-                packet = IPacket.create_route_relay(pid,
-                                                    self.get_address(),
-                                                    address,
-                                                    [self.get_address(), address],
-                                                    data)
-                dest_ip = self.addr_book[address]
-                self._log(f"Sending: {packet}")
-                self._transmit_packet(dest_ip, packet)
-            else:
-                # Send RouteRequest to every contact
-                packet = IPacket.create_route_request(pid, self.get_address(), address, [self.get_address()])
+        route = self.route_cache.lookup(address)
+        if route:
+            # Send RouteRelay on the cached route
+            self._log(style(f"Using cached route to {address}: {'->'.join(map(str, route))}", Colours.FG.BRIGHT_MAGENTA))
+            if self._send_route_relay(address, route, data):
+                return
 
-                self._log(f"Sending: {packet}")
-                self.mesh_add_data(pid, address, data)
+        if not self.route_cache.request(address, data):
+            self._log(style(f"Route request to {address} pending, message queued.", Colours.FG.BRIGHT_MAGENTA))
+            return
 
-                for key in self.addr_book:
-                    if key == self.get_address():
-                        continue
-                    dest_ip = self.addr_book[key]
-                    self._log(f"Sending route request to {key}...")
-                    self._transmit_packet(dest_ip, packet)
+        # Send RouteRequest to every contact
+        pid    = self.next_id()
+        packet = IPacket.create_route_request(pid, self.get_address(), address, [self.get_address()])
 
-            self.add_expected_ack_for(packet)
+        self._log(f"Sending: {packet}")
+        self.mesh_add_data(pid, address, data)
+
+        self._log(f"Sending route request to every contact...")
+        self._flood(packet)
+        self.add_expected_ack_for(packet)
 
     def send(self, address, data, comm_type=CommunicationType.DIRECT_ROUTE):
+        if len(data) > Fragment.SIZE and not isinstance(data, Fragment):
+            # Every fragment is a packet of its own, so only lost fragments are retransmitted.
+            fragments = Fragment.split(self.next_msg_id(), data)
+            self._log(f"Sending {len(data)} bytes to {address} in {len(fragments)} fragments...")
+
+            for fragment in fragments:
+                self.send(address, fragment, comm_type)
+            return
+
+        # At most SEND_WINDOW data packets to a destination are unACKed, the rest waits for the window.
+        # Mesh messages also wait while a route request to the destination is pending, nothing is
+        # in flight then, so the window is filled once the route is found (see ROUTE_REQUEST_ACK).
+        pending = comm_type == CommunicationType.MESH and self.route_cache.is_pending(address)
+
+        with self.windows_lock:
+            window = self._send_window(address)
+            if pending or not window.has_room():
+                window.waiting.append((data, comm_type))
+                queued = len(window.waiting)
+            else:
+                queued = 0
+
+        if queued:
+            reason = f"Route request to {address} pending" if pending else f"Send window to {address} is full"
+            self._log(style(f"{reason}, message queued ({queued} waiting).", Colours.FG.BRIGHT_MAGENTA))
+            return
+
+        self._send_now(address, data, comm_type)
+
+    def _send_now(self, address, data, comm_type):
         # DIRECT_ROUTE, OPPORTUNISTIC, MESH
         send_handler = {
             CommunicationType.DIRECT_ROUTE  : self._send_direct,
@@ -891,51 +1254,57 @@ class Client:
         send_handler.get(comm_type, self._send_direct)(address, data)
 
 
-if __name__ == "__main__":
+def parse_args(argv):
     address, interactive, msg = 0, True, None
     include_these_addresses_only = []
     filter_type = AddressFilterType.ALLOW_ALL
 
     i = 1
-    while i < len(sys.argv):
-        if sys.argv[i] in ("-a", "--address"):
+    while i < len(argv):
+        if argv[i] in ("-a", "--address"):
             # Self address (as number in string)
-            address = Bits.bytes_to_str(sys.argv[i+1])
+            address = Bits.bytes_to_str(argv[i+1])
             i += 2
-        elif sys.argv[i] in ("-i", "--interactive"):
+        elif argv[i] in ("-i", "--interactive"):
             # Whether to go into interactive mode to send new messages
             interactive = True
             i += 1
-        elif sys.argv[i] in ("-m", "--message"):
+        elif argv[i] in ("-m", "--message"):
             # Send an initial message in format: `address[@<comm_type>]:msg`
-            msg = sys.argv[i+1]
+            msg = argv[i+1]
             i += 2
 
             if msg == "None":
                 msg = None
-        elif sys.argv[i] in ("-w", "--whitelist"):
+        elif argv[i] in ("-w", "--whitelist"):
             # A whitelist for incoming addresses (broadcasts)
-            json_array = sys.argv[i+1]
+            json_array = argv[i+1]
 
             if json_array == "None":
                 include_these_addresses_only = None
             else:
                 try:
-                    json_array = json.loads(sys.argv[i+1])
+                    json_array = json.loads(argv[i+1])
                 except:
                     json_array = []
                 finally:
                     include_these_addresses_only = json_array
             i += 2
-        elif sys.argv[i] in ("-f", "--filter"):
+        elif argv[i] in ("-f", "--filter"):
             # Filter incoming packets
             # == 1: Allow all (default)
             # == 2: Only opposite evenness (e.g. address 1 can only get/sent to even addresses)
-            filter_type = sys.argv[i+1]
+            filter_type = argv[i+1]
             i += 2
 
             filter_type = None if filter_type == "None" else int(filter_type)
 
+    return address, interactive, msg, include_these_addresses_only, filter_type
+
+
+if __name__ == "__main__":
+    address, interactive, msg, include_these_addresses_only, filter_type = parse_args(sys.argv)
+
     print("Waiting for keypress... (set-up tcp dump now if wanted)")
     input()
 
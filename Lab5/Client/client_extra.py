@@ -1,7 +1,12 @@
-from packet import ContactRelay
+from packet import ContactRelay, Fragment
 from bits import Bits
+from threads import Threading
 
 import time
+import heapq
+import random
+
+from collections import deque, OrderedDict
 
 
 class ClientException(Exception):
@@ -115,3 +120,685 @@ class MeshMetadata:
 
     def get_key(self):
         return (self.pid, self.src, self.dst)
+
+
+class DeliveryPredictability:
+    """
+    PRoPHET delivery predictabilities: P(x) that this client gets a message
+    to x, from encounters with its contacts, and the P_b(x) that each contact
+    b sent along with its discovery. Opportunistic messages are forwarded to
+    the contact most likely to reach their destination.
+
+    - Encounter with b: P(b) = P(b) + (1 - P(b)) * P_INIT
+    - Ageing:           P(x) = P(x) * GAMMA ^ (elapsed / aging_unit), since
+                        P(x) was last updated, computed when it is read
+    - Transitive via b: P(x) = max(P(x), P(b) * P_b(x) * BETA)
+    """
+    P_INIT = 0.75
+    BETA   = 0.25
+    GAMMA  = 0.98
+    P_MIN  = 0.01  # Forgotten below this
+
+    def __init__(self, address, aging_unit):
+        self.address    = address
+        self.aging_unit = aging_unit
+
+        self.lock     = Threading.new_lock()
+        self.table    = {}  # { x: (P(x), last updated) }
+        self.contacts = {}  # { b: (received, { x: P_b(x) }) }
+
+        self.encounters = 0
+
+    def __str__(self):
+        return f"<DeliveryPredictability destinations={len(self.table)}, contacts={len(self.contacts)}, encounters={self.encounters}>"
+
+    def _aged(self, p, since, current_time):
+        # Values are only aged when they are used, from the time they were last updated
+        return p * DeliveryPredictability.GAMMA ** ((current_time - since) / self.aging_unit)
+
+    def _get(self, x, current_time):
+        entry = self.table.get(x)
+        if entry is None:
+            return 0
+
+        p = self._aged(*entry, current_time)
+        if p < DeliveryPredictability.P_MIN:
+            del self.table[x]
+            return 0
+        return p
+
+    def _get_via(self, b, x, current_time):
+        received, vector = self.contacts.get(b, (current_time, {}))
+        p = self._aged(vector.get(x, 0), received, current_time)
+        return p if p >= DeliveryPredictability.P_MIN else 0
+
+    def encounter(self, b, vector=None):
+        """Met contact b (discovery or ACK), with its predictabilities { x: P_b(x) } if it sent them."""
+        if b == self.address:
+            return
+
+        with self.lock:
+            current_time = time.time()
+            self.encounters += 1
+
+            p_b = self._get(b, current_time)
+            p_b = p_b + (1 - p_b) * DeliveryPredictability.P_INIT
+            self.table[b] = (p_b, current_time)
+
+            if vector is None:
+                return
+
+            self.contacts[b] = (current_time, { x: p for x, p in vector.items() if x != b })
+            for x, p_bx in self.contacts[b][1].items():
+                if x != self.address:
+                    self.table[x] = (max(self._get(x, current_time), p_b * p_bx * DeliveryPredictability.BETA), current_time)
+
+    def get(self, x):
+        with self.lock:
+            return self._get(x, time.time())
+
+    def best_hop(self, dst, candidates):
+        """The candidate with the highest P_b(dst), the lowest address if none knows dst."""
+        with self.lock:
+            current_time = time.time()
+            return max(sorted(candidates), key=lambda b: self._get_via(b, dst, current_time))
+
+    def vector(self, limit):
+        """The `limit` highest predictabilities, [(x, P(x))], to send along with a discovery."""
+        with self.lock:
+            current_time = time.time()
+            table = { x: self._get(x, current_time) for x in tuple(self.table.keys()) }
+            return sorted(((x, p) for x, p in table.items() if p), key=lambda item: item[1], reverse=True)[:limit]
+
+    def entries(self):
+        with self.lock:
+            current_time = time.time()
+            table = { x: self._get(x, current_time) for x in tuple(self.table.keys()) }
+            via   = lambda x: { b: self._get_via(b, x, current_time) for b, (_, vector) in self.contacts.items() if x in vector }
+            return [(x, p, { b: p_bx for b, p_bx in via(x).items() if p_bx }) for x, p in sorted(table.items()) if p]
+
+
+class RouteEntry:
+    def __init__(self, dst, route, ttl):
+        self.dst     = dst
+        self.route   = route  # [self, hop, ..., dst]
+        self.created = time.time()
+        self.expires = self.created + ttl
+        self.hits    = 0
+
+    def __str__(self):
+        return f"<Route " \
+             + f"dst={self.dst}, " \
+             + f"route={'->'.join(map(str, self.route))}, " \
+             + f"hits={self.hits}, ttl={max(0, self.expires - time.time()):.0f}s>"
+
+    def is_expired(self, current_time=None):
+        return (current_time or time.time()) >= self.expires
+
+    def next_hop(self):
+        return self.route[1] if len(self.route) > 1 else None
+
+
+class RouteCache:
+    """
+    Routes found by ROUTE_REQUESTs, per destination. While a route is cached,
+    messages to that destination are sent as ROUTE_RELAY right away, and while
+    a route request is pending, new messages wait for it instead of flooding
+    another one. So there is at most one flood per destination per TTL.
+    """
+    def __init__(self, ttl):
+        self.ttl  = ttl
+        self.lock = Threading.new_lock()
+
+        self.routes  = {}  # { dst: RouteEntry }
+        self.pending = {}  # { dst: time the route request was flooded }
+        self.waiting = {}  # { dst: [data, ...] } to send when the pending request returns
+
+        self.hits          = 0
+        self.misses        = 0
+        self.discoveries   = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        return f"<RouteCache routes={len(self.routes)}, pending={len(self.pending)}, " \
+             + f"hits={self.hits}, misses={self.misses}, discoveries={self.discoveries}, " \
+             + f"invalidations={self.invalidations}>"
+
+    def lookup(self, dst):
+        """Returns the cached route to dst, or None if there is none (or it expired)."""
+        with self.lock:
+            entry = self.routes.get(dst)
+
+            if entry and entry.is_expired():
+                del self.routes[dst]
+                entry = None
+
+            if not entry:
+                self.misses += 1
+                return None
+
+            entry.hits += 1
+            self.hits  += 1
+            return entry.route
+
+    def learn(self, dst, route):
+        """Cache route (starting at self, ending at dst) to dst."""
+        if len(route) < 2 or route[-1] != dst:
+            return
+
+        with self.lock:
+            self.routes[dst] = RouteEntry(dst, list(route), self.ttl)
+
+    def invalidate(self, dst):
+        with self.lock:
+            if self.routes.pop(dst, None):
+                self.invalidations += 1
+
+    def request(self, dst, data):
+        """
+        Returns True if a route request has to be flooded for dst, or False
+        if one is already pending and data was queued to wait for it.
+        """
+        with self.lock:
+            if dst in self.pending:
+                self.waiting.setdefault(dst, []).append(data)
+                return False
+
+            self.pending[dst] = time.time()
+            self.discoveries += 1
+            return True
+
+    def is_pending(self, dst):
+        with self.lock:
+            return dst in self.pending
+
+    def abandon(self, dst):
+        """The pending route request for dst failed, returns the data that was waiting for it."""
+        with self.lock:
+            self.pending.pop(dst, None)
+            return self.waiting.pop(dst, [])
+
+    def resolve(self, dst, route):
+        """Cache the route found for dst, returns the data waiting for it."""
+        self.learn(dst, route)
+
+        with self.lock:
+            self.pending.pop(dst, None)
+            return self.waiting.pop(dst, [])
+
+    def evict_expired(self):
+        """Remove expired routes, returns them."""
+        with self.lock:
+            current_time = time.time()
+            expired = [entry for entry in self.routes.values() if entry.is_expired(current_time)]
+
+            for entry in expired:
+                del self.routes[entry.dst]
+
+            return expired
+
+    def entries(self):
+        with self.lock:
+            return list(self.routes.values())
+
+
+class SeenCache:
+    """
+    (source, pid) of the flooded packets seen in the last `ttl` seconds, at
+    most `size` of them (the oldest are forgotten first), so the copies of a
+    flood that arrive over other paths are recognised in O(1).
+
+    A key is not refreshed when it is seen again, so a packet that its
+    source retransmits after `ttl` is new again.
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl  = ttl
+
+        self.lock = Threading.new_lock()
+        self.seen = OrderedDict()  # { (src, pid): first seen }, oldest first
+
+        self.duplicates = 0
+
+    def __str__(self):
+        return f"<SeenCache seen={len(self.seen)}/{self.size}, ttl={self.ttl}, duplicates={self.duplicates}>"
+
+    def _evict_expired(self, current_time):
+        while self.seen and next(iter(self.seen.values())) + self.ttl <= current_time:
+            self.seen.popitem(last=False)
+
+    def check(self, src, pid):
+        """Returns True if (src, pid) is new (and records it), False for a duplicate."""
+        with self.lock:
+            current_time = time.time()
+            self._evict_expired(current_time)
+
+            key = (src, pid)
+            if key in self.seen:
+                self.duplicates += 1
+                return False
+
+            self.seen[key] = current_time
+            if len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+            return True
+
+
+class RTTEstimator:
+    """Smoothed round trip time and retransmission timeout (as in RFC 6298) of one peer."""
+    ALPHA = 1 / 8
+    BETA  = 1 / 4
+    K     = 4
+
+    def __init__(self, initial_rto, min_rto, max_rto):
+        self.srtt    = None
+        self.rttvar  = None
+        self.rto     = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.samples = 0
+
+    def __str__(self):
+        srtt = f"{self.srtt * 1000:.1f}ms" if self.srtt is not None else "?"
+        return f"<RTT srtt={srtt}, rto={self.rto:.2f}s, samples={self.samples}>"
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTTEstimator.BETA) * self.rttvar + RTTEstimator.BETA * abs(self.srtt - rtt)
+            self.srtt   = (1 - RTTEstimator.ALPHA) * self.srtt + RTTEstimator.ALPHA * rtt
+
+        self.rto      = min(max(self.srtt + RTTEstimator.K * self.rttvar, self.min_rto), self.max_rto)
+        self.samples += 1
+
+
+class RetransmitScheduler:
+    """
+    Deadlines of the packets waiting for an ACK, in a min-heap, so only the
+    packets that are due are looked at, each at its own time.
+
+    The timeout of a packet is the RTO of its peer (the address the ACK comes
+    from), measured from the time between sending and the ACK (Karn: only for
+    packets that were not retransmitted). Every retransmission doubles it (up
+    to max_rto), with some random jitter so packets sent together are not
+    retransmitted together. A packet is given up after max_retries.
+    """
+    def __init__(self, initial_rto, min_rto, max_rto, max_retries, jitter=0.1):
+        self.initial_rto = initial_rto
+        self.min_rto     = min_rto
+        self.max_rto     = max_rto
+        self.max_retries = max_retries
+        self.jitter      = jitter
+
+        self.cond    = Threading.new_condition()
+        self.heap    = []  # [(deadline, seq, pid)], outdated items are skipped
+        self.entries = {}  # { pid: [seq, peer, sent_at, retries] }
+        self.rtts    = {}  # { peer: RTTEstimator }
+        self.seq     = 0
+
+        self.retransmissions = 0
+        self.dropped         = 0
+
+    def __str__(self):
+        return f"<RetransmitScheduler waiting={len(self.entries)}, peers={len(self.rtts)}, " \
+             + f"retransmissions={self.retransmissions}, dropped={self.dropped}>"
+
+    def _rtt_for(self, peer):
+        rtt = self.rtts.get(peer)
+        if rtt is None:
+            rtt = self.rtts[peer] = RTTEstimator(self.initial_rto, self.min_rto, self.max_rto)
+        return rtt
+
+    def rto(self, peer):
+        with self.cond:
+            return self._rtt_for(peer).rto
+
+    def _push(self, pid, entry, now):
+        seq, peer, sent_at, retries = entry
+        timeout  = min(self._rtt_for(peer).rto * (2 ** retries), self.max_rto)
+        deadline = now + timeout * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        earliest = not self.heap or deadline < self.heap[0][0]
+        heapq.heappush(self.heap, (deadline, seq, pid))
+
+        if earliest:
+            self.cond.notify()
+
+    def add(self, pid, peer, sent_at=None):
+        """Schedule the first retransmission of a packet that was just sent."""
+        with self.cond:
+            now = time.time()
+            self.seq += 1
+            entry = self.entries[pid] = [self.seq, peer, sent_at or now, 0]
+            self._push(pid, entry, now)
+
+    def backoff(self, pid):
+        """Schedule the next retransmission of pid, after it was retransmitted now."""
+        with self.cond:
+            entry = self.entries.get(pid)
+            if entry is None:
+                return
+
+            self.seq += 1
+            entry[0]  = self.seq
+            entry[3] += 1
+            self.retransmissions += 1
+            self._push(pid, entry, time.time())
+
+    def exhausted(self, pid):
+        """Returns True if pid was retransmitted max_retries times."""
+        with self.cond:
+            entry = self.entries.get(pid)
+            return entry is not None and entry[3] >= self.max_retries
+
+    def ack(self, pid):
+        """pid was acknowledged, update the RTT of its peer."""
+        with self.cond:
+            entry = self.entries.pop(pid, None)
+            if entry is None:
+                return
+
+            seq, peer, sent_at, retries = entry
+            if retries == 0:
+                self._rtt_for(peer).sample(time.time() - sent_at)
+
+    def forget(self, pid, dropped=False):
+        with self.cond:
+            if self.entries.pop(pid, None) is not None and dropped:
+                self.dropped += 1
+
+    def next_deadline(self):
+        with self.cond:
+            self._skip_outdated()
+            return self.heap[0][0] if self.heap else None
+
+    def _skip_outdated(self):
+        while self.heap:
+            deadline, seq, pid = self.heap[0]
+            entry = self.entries.get(pid)
+            if entry is not None and entry[0] == seq:
+                return
+            heapq.heappop(self.heap)
+
+    def pop_due(self, current_time=None):
+        """Returns the pids of which the deadline passed, call backoff() or forget() for each."""
+        with self.cond:
+            current_time = current_time or time.time()
+            due = []
+
+            self._skip_outdated()
+            while self.heap and self.heap[0][0] <= current_time:
+                due.append(heapq.heappop(self.heap)[2])
+                self._skip_outdated()
+
+            return due
+
+    def wait_due(self, max_wait):
+        """Block until a deadline passes (or max_wait), returns the pids that are due."""
+        with self.cond:
+            self._skip_outdated()
+            timeout = max_wait
+            if self.heap:
+                timeout = min(max_wait, max(0, self.heap[0][0] - time.time()))
+
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+            return self.pop_due()
+
+    def get_rtts(self):
+        with self.cond:
+            return { peer: str(rtt) for peer, rtt in self.rtts.items() }
+
+
+class DelayedAcks:
+    """
+    ACKs that are held back for `delay` seconds, per key (ACK type, peer and
+    the way back to it), so every pid received from a peer in that time is
+    acknowledged by one ACK packet (with AckRanges) instead of one each.
+    Once `max_pending` pids wait for a key, they are acknowledged right away.
+    """
+    def __init__(self, delay, max_pending):
+        self.delay       = delay
+        self.max_pending = max_pending
+
+        self.cond    = Threading.new_condition()
+        self.pending = {}  # { key: (deadline, [pid]) }, in order of deadline
+
+        self.acks    = 0  # pids acknowledged
+        self.packets = 0  # ACK packets sent for them
+
+    def __str__(self):
+        return f"<DelayedAcks pending={len(self.pending)}, acks={self.acks}, packets={self.packets}>"
+
+    def _take(self, key):
+        deadline, pids = self.pending.pop(key)
+        self.acks    += len(pids)
+        self.packets += 1
+        return pids
+
+    def add(self, key, pid, flush=False):
+        """
+        Hold back the ACK for pid. Returns the pids to acknowledge now, if
+        the key is full (or flush is set), else an empty list.
+        """
+        with self.cond:
+            if key not in self.pending:
+                self.pending[key] = (time.time() + self.delay, [])
+                if len(self.pending) == 1:
+                    self.cond.notify()
+
+            pids = self.pending[key][1]
+            if pid not in pids:
+                pids.append(pid)
+
+            return self._take(key) if flush or len(pids) >= self.max_pending else []
+
+    def next_deadline(self):
+        with self.cond:
+            return next(iter(self.pending.values()))[0] if self.pending else None
+
+    def pop_due(self, current_time=None):
+        """Returns [(key, pids)] of which the delay passed."""
+        with self.cond:
+            current_time = current_time or time.time()
+            return [(key, self._take(key)) for key, (deadline, pids) in tuple(self.pending.items())
+                    if deadline <= current_time]
+
+    def wait_due(self, max_wait):
+        """Block until a delay passes (or max_wait), returns [(key, pids)] that are due."""
+        with self.cond:
+            deadline = self.next_deadline()
+            timeout  = max_wait if deadline is None else min(max_wait, max(0, deadline - time.time()))
+
+            if timeout > 0:
+                self.cond.wait(timeout)
+
+            return self.pop_due()
+
+
+class SendWindow:
+    """
+    Sequence numbers of the data packets to one destination, and a sliding
+    window of at most `size` of them in flight (unACKed). Messages that do
+    not fit wait in order until an ACK opens the window.
+    """
+    def __init__(self, size):
+        self.size      = size
+        self.next_seq  = 1
+        self.in_flight = {}       # { pid: seq }
+        self.waiting   = deque()  # (data, comm_type)
+
+    def __str__(self):
+        return f"<SendWindow next_seq={self.next_seq}, in_flight={len(self.in_flight)}/{self.size}, waiting={len(self.waiting)}>"
+
+    def has_room(self):
+        return len(self.in_flight) < self.size
+
+    def add(self, pid):
+        """Returns the sequence number of the data packet pid, which is now in flight."""
+        seq = self.next_seq
+        self.next_seq = self.next_seq % 0xFFFF + 1  # 16 bits, 0 means no seq
+        self.in_flight[pid] = seq
+        return seq
+
+    def release(self, *pids):
+        """pids were ACKed (or given up), returns the waiting messages that fit the window now."""
+        for pid in pids:
+            self.in_flight.pop(pid, None)
+
+        ready = []
+        while self.waiting and len(self.in_flight) + len(ready) < self.size:
+            ready.append(self.waiting.popleft())
+        return ready
+
+    def discard(self, comm_type):
+        """Drop the waiting messages of comm_type, returns how many there were."""
+        kept = deque(entry for entry in self.waiting if entry[1] != comm_type)
+        dropped = len(self.waiting) - len(kept)
+        self.waiting = kept
+        return dropped
+
+
+class SequenceWindow:
+    """
+    Sequence numbers received from one source: the highest one, and a bitmap
+    of the `size` before it, to recognise retransmissions of packets that
+    were already received (when the ACK got lost).
+
+    The sender never has more than its window in flight, so with a bitmap at
+    least that large, older sequence numbers can only be duplicates. A source
+    that restarts numbers from 1 again, with a new epoch, which resets the window.
+    """
+    def __init__(self, size=64):
+        self.size    = size
+        self.epoch   = 0
+        self.highest = 0
+        self.bitmap  = 0  # Bit i: highest - i was received
+
+    def check(self, seq, epoch=0):
+        """Returns True if seq is new (and records it), False for a duplicate."""
+        if not seq:
+            return True
+
+        if epoch != self.epoch:
+            self.epoch, self.highest, self.bitmap = epoch, 0, 0
+
+        if not self.highest:
+            self.highest, self.bitmap = seq, 1
+            return True
+
+        ahead = (seq - self.highest) & 0xFFFF
+        if ahead and ahead < 0x8000:
+            # Newer, slide the window
+            self.bitmap  = ((self.bitmap << ahead) | 1) & ((1 << self.size) - 1)
+            self.highest = seq
+            return True
+
+        behind = (self.highest - seq) & 0xFFFF
+        if behind >= self.size or self.bitmap & (1 << behind):
+            return False
+
+        self.bitmap |= 1 << behind
+        return True
+
+
+class ReassemblyBuffer:
+    """One message being reassembled, preallocated, with a bitmap of the fragments received."""
+    def __init__(self, total, ttl):
+        self.data     = bytearray(total)
+        self.count    = (total + Fragment.SIZE - 1) // Fragment.SIZE
+        self.received = 0  # Bit i: fragment i was received
+        self.missing  = self.count
+        self.expires  = time.time() + ttl
+
+    def add(self, fragment):
+        """Returns True once every fragment was received."""
+        index = fragment.get_index()
+
+        if not self.received & (1 << index):
+            offset = fragment.get_offset()
+            data   = fragment.get_data()
+
+            self.data[offset:offset+len(data)] = data
+            self.received |= 1 << index
+            self.missing  -= 1
+
+        return self.missing == 0
+
+
+class Reassembler:
+    """
+    Messages of which fragments were received, per (source, epoch, msg id).
+    A message that is not complete within the TTL is dropped.
+
+    Completed messages are remembered for the TTL as well: a fragment of one
+    can still arrive afterwards (resent as a new packet after a route broke),
+    and must not start a new buffer that would expire incomplete.
+    """
+    def __init__(self, ttl):
+        self.ttl     = ttl
+        self.lock    = Threading.new_lock()
+        self.buffers = {}             # { (src, epoch, msg_id): ReassemblyBuffer }
+        self.done    = OrderedDict()  # { (src, epoch, msg_id): time completed }, oldest first
+
+        self.completed = 0
+        self.expired   = 0
+        self.late      = 0  # Fragments of messages that were completed already
+
+    def __str__(self):
+        return f"<Reassembler incomplete={len(self.buffers)}, completed={self.completed}, expired={self.expired}, late={self.late}>"
+
+    def add(self, src, fragment, epoch=0):
+        """Returns the message once its last fragment was added, None until then (or if it was complete already)."""
+        if not fragment.is_valid():
+            raise ClientException(f"[Reassembler] Invalid fragment from {src}!")
+
+        key = (src, epoch, fragment.get_msg_id())
+
+        with self.lock:
+            if key in self.done:
+                self.late += 1
+                return None
+
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = self.buffers[key] = ReassemblyBuffer(fragment.get_total(), self.ttl)
+            elif len(buffer.data) != fragment.get_total():
+                raise ClientException(f"[Reassembler] Fragment length mismatch from {src}!")
+
+            if not buffer.add(fragment):
+                return None
+
+            del self.buffers[key]
+            self.done[key] = time.time()
+            self.completed += 1
+            return bytes(buffer.data)
+
+    def is_done(self, src, msg_id, epoch=0):
+        with self.lock:
+            return (src, epoch, msg_id) in self.done
+
+    def progress(self, src, msg_id, epoch=0):
+        """Returns (received, total) fragments of a message being reassembled."""
+        with self.lock:
+            buffer = self.buffers.get((src, epoch, msg_id))
+            return (buffer.count - buffer.missing, buffer.count) if buffer else (0, 0)
+
+    def evict_expired(self):
+        """Remove incomplete messages past their TTL, returns [(src, msg_id, missing fragments)]."""
+        with self.lock:
+            current_time = time.time()
+            expired = [key for key, buffer in self.buffers.items() if current_time >= buffer.expires]
+
+            evicted = []
+            for src, epoch, msg_id in expired:
+                evicted.append((src, msg_id, self.buffers.pop((src, epoch, msg_id)).missing))
+            self.expired += len(evicted)
+
+            while self.done and next(iter(self.done.values())) + self.ttl <= current_time:
+                self.done.popitem(last=False)
+
+            return evicted
@@ -3,6 +3,7 @@ import socket
 from bits import Bits
 from colours import *
 from packet import IPacket
+from threads import Threading
 
 
 class Constants:
@@ -137,3 +138,100 @@ class OSocket:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         sock.bind(server_tuple)
         return cls(sock, shutdwn=True)
+
+
+class UDPSender:
+    """
+    Sends all outgoing datagrams over one long-lived socket per address
+    family, bound once to an ephemeral port, instead of a new socket per
+    packet. Keeps counters of the packets and bytes sent per neighbour.
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock  = Threading.new_lock()
+        self.socks = {}  # { family: socket }
+        self.stats = {}  # { ip: [packets, bytes] }
+
+        self.packets = 0
+        self.bytes   = 0
+        self.errors  = 0
+
+    def __del__(self):
+        self.close()
+
+    def __str__(self):
+        return f"<UDPSender packets={self.packets}, bytes={self.bytes}, errors={self.errors}, neighbours={len(self.stats)}>"
+
+    def close(self):
+        with self.lock:
+            for sock in self.socks.values():
+                sock.close()
+            self.socks = {}
+
+    def _sock_for(self, addr):
+        family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+
+        with self.lock:
+            sock = self.socks.get(family)
+            if sock is None:
+                sock = socket.socket(family=family, type=socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
+                sock.bind(("", 0))
+                self.socks[family] = sock
+            return sock
+
+    @staticmethod
+    def _data(msg):
+        if isinstance(msg, IPacket):
+            return msg.to_bin()
+        elif isinstance(msg, (bytes, bytearray)):
+            return msg
+        raise OSocketException("[UDPSender] Invalid data?")
+
+    def _count(self, addr, size):
+        with self.lock:
+            counters = self.stats.get(addr)
+            if counters is None:
+                counters = self.stats[addr] = [0, 0]
+            counters[0]  += 1
+            counters[1]  += size
+            self.packets += 1
+            self.bytes   += size
+
+    def _transmit(self, data, addr_tuple):
+        # The only part that touches a socket (a simulated network replaces it, see simulator.py)
+        return self._sock_for(addr_tuple[0]).sendto(data, addr_tuple)
+
+    def _send(self, data, addr_tuple):
+        try:
+            sent = self._transmit(data, addr_tuple)
+        except OSError:
+            with self.lock:
+                self.errors += 1
+            raise
+        self._count(addr_tuple[0], sent)
+        return sent
+
+    def sendto(self, msg, addr_tuple):
+        return self._send(self._data(msg), addr_tuple)
+
+    def send_many(self, msg, addr_tuples):
+        """
+        Send the same packet to several destinations. The packet is encoded
+        once, a failing destination does not stop the others.
+        Returns the number of destinations it was sent to.
+        """
+        data  = self._data(msg)
+        count = 0
+
+        for addr_tuple in addr_tuples:
+            try:
+                self._send(data, addr_tuple)
+                count += 1
+            except OSError:
+                continue
+        return count
+
+    def get_stats(self):
+        """Returns { ip: (packets, bytes) } sent per neighbour."""
+        with self.lock:
+            return { addr: tuple(counters) for addr, counters in self.stats.items() }
@@ -49,12 +49,118 @@ class PacketType:
         return PacketType.__STRINGS.get(ptype, f"Unknown? ({ptype})")
 
 
+class Fragment(bytes):
+    """
+    Payload that carries one fragment of a message that is too large for a
+    single packet: msg id (2), offset (2), total length (2), data.
+    Every fragment but the last has SIZE bytes of data.
+    """
+    SIZE        = 128
+    HEADER_SIZE = 6
+
+    @classmethod
+    def create(cls, msg_id, offset, total, data):
+        return cls(Bits.pack(msg_id, 2) + Bits.pack(offset, 2) + Bits.pack(total, 2) + data)
+
+    @staticmethod
+    def split(msg_id, data):
+        return [Fragment.create(msg_id, offset, len(data), data[offset:offset+Fragment.SIZE])
+                for offset in range(0, len(data), Fragment.SIZE)]
+
+    def is_valid(self):
+        total, offset = self.get_total(), self.get_offset()
+        return len(self) > Fragment.HEADER_SIZE and offset < total and offset % Fragment.SIZE == 0 \
+           and len(self.get_data()) == min(Fragment.SIZE, total - offset)
+
+    def get_msg_id(self):
+        return Bits.unpack(self[0:2])
+
+    def get_offset(self):
+        return Bits.unpack(self[2:4])
+
+    def get_total(self):
+        return Bits.unpack(self[4:6])
+
+    def get_data(self):
+        return bytes(self[Fragment.HEADER_SIZE:])
+
+    def get_index(self):
+        return self.get_offset() // Fragment.SIZE
+
+    def get_count(self):
+        return (self.get_total() + Fragment.SIZE - 1) // Fragment.SIZE
+
+
+class AckRanges(bytes):
+    """
+    Payload of an ACK that acknowledges several pids of one peer at once:
+    ranges of consecutive pids, each as first pid (2) and count (1).
+    """
+    RANGE_SIZE = 3
+
+    @classmethod
+    def create(cls, pids):
+        ranges = []  # [[first, count]]
+        for pid in sorted(set(pids)):
+            if ranges and pid == sum(ranges[-1]) and ranges[-1][1] < 0xFF:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([pid, 1])
+
+        return cls(b"".join(Bits.pack(first, 2) + Bits.pack(count, 1) for first, count in ranges))
+
+    def __str__(self):
+        return ",".join(f"{first}" if count == 1 else f"{first}-{first + count - 1}" for first, count in self.get_ranges())
+
+    def is_valid(self):
+        return len(self) % AckRanges.RANGE_SIZE == 0
+
+    def get_ranges(self):
+        return [(Bits.unpack(self[offset:offset+2]), self[offset+2])
+                for offset in range(0, len(self) - AckRanges.RANGE_SIZE + 1, AckRanges.RANGE_SIZE)]
+
+    def get_pids(self):
+        return [first + i for first, count in self.get_ranges() for i in range(count)]
+
+
+class PredictabilityVector(bytes):
+    """
+    Delivery predictabilities that a DISCOVER or DISCACK carries after the
+    IP address: address (4) and P (1, 0-255 for 0.0-1.0) per destination.
+    """
+    ENTRY_SIZE = 5
+
+    @classmethod
+    def create(cls, entries):
+        return cls(b"".join(Bits.pack(addr, 4) + Bits.pack(round(p * 0xFF), 1) for addr, p in entries))
+
+    def get_entries(self):
+        """Returns { address: P }."""
+        return { Bits.unpack(self[offset:offset+4]): self[offset+4] / 0xFF
+                 for offset in range(0, len(self) - PredictabilityVector.ENTRY_SIZE + 1, PredictabilityVector.ENTRY_SIZE) }
+
+
 class IPacket:
+    # Header: type (1), length (1), pid (1), src (4), dst (4)
+    # Extended header (type | EXTENDED): type (1), length (1), pid (2), seq (2), epoch (2), src (4), dst (4)
+    # The FRAGMENT flag on the type marks a payload that is a Fragment,
+    # the ACKS flag an ACK with AckRanges as payload (extended header only).
+    EXTENDED        = 0x80
+    FRAGMENT        = 0x40
+    ACKS            = 0x20
+    HEADER_SIZE     = 11
+    EXT_HEADER_SIZE = 16
+
     def __init__(self, raw=b""):
         super().__init__()
 
         self.ptype = PacketType.INVALID
         self.pid   = 0
+        self.seq   = 0  # Per (src, dst), 0 if none (or not extended)
+        self.epoch = 0  # Of the source's run, its seqs start over in a new one
+
+        self.fragment = False  # Received with the FRAGMENT flag
+        self.acks     = False  # Received with the ACKS flag
 
         self.source_addr = 0
         self.dest_addr   = 0
@@ -94,7 +200,12 @@ class IPacket:
         attr.append(f"src={self.source_addr}")
         attr.append(f"dst={self.dest_addr}")
 
-        if self.payload:
+        if self.seq:
+            attr.append(f"seq={self.seq}")
+
+        if self.has_ack_ranges():
+            attr.append(f"acks={AckRanges(self.payload)}")
+        elif self.payload:
             attr.append("data={0}".format(self.payload if self.length < 50 else \
                                           f"({self.length} bytes)"))
 
@@ -108,19 +219,61 @@ class IPacket:
 
     @staticmethod
     def _parse_type_length(raw):
-        return (raw[0], raw[1]) if len(raw) >= 11 else (0, 0)
+        return (raw[0] & ~(IPacket.EXTENDED | IPacket.FRAGMENT | IPacket.ACKS), raw[1]) if len(raw) >= IPacket.HEADER_SIZE else (0, 0)
+
+    def is_extended(self):
+        return len(self.pid) == 2
+
+    def is_fragment(self):
+        return self.fragment or isinstance(self.payload, Fragment)
+
+    def get_fragment(self):
+        return Fragment(self.payload) if self.is_fragment() else None
+
+    def has_ack_ranges(self):
+        return self.acks or isinstance(self.payload, AckRanges)
+
+    def get_acked_pids(self):
+        """The pids an ACK acknowledges: its own, or those of its AckRanges."""
+        if not self.has_ack_ranges():
+            return [self.pid]
+
+        ranges = AckRanges(self.payload)
+        if not ranges.is_valid():
+            raise PacketException(f"[IPacket::get_acked_pids] Malformed ACK ranges ({len(ranges)} bytes)")
+
+        return [Bits.pack(pid, len(self.pid)) for pid in ranges.get_pids()]
+
+    def set_acked_pids(self, pids):
+        # An ACK for more than one pid carries their ranges
+        if len(pids) > 1 and not self.is_extended():
+            raise PacketException(f"[IPacket::set_acked_pids] Only extended ACKs can acknowledge more than one pid!")
+
+        self.payload = AckRanges.create(map(Bits.unpack, pids)) if len(pids) > 1 else b""
+        self.length  = len(self.payload)
 
     def _parse(self, raw):
         total_length = len(raw)
+        extended     = total_length > 0 and bool(raw[0] & IPacket.EXTENDED)
+        header_size  = IPacket.EXT_HEADER_SIZE if extended else IPacket.HEADER_SIZE
 
-        if total_length < 11:
-            raise PacketException(f"[IPacket::parse] Invalid packet length (too small): {total_length} < 11")
+        if total_length < header_size:
+            raise PacketException(f"[IPacket::parse] Invalid packet length (too small): {total_length} < {header_size}")
 
         self.ptype, self.length = IPacket._parse_type_length(raw)
-        self.pid                = bytes((raw[2],))
-        self.source_addr        = Bits.unpack(raw[3:7])
-        self.dest_addr          = Bits.unpack(raw[7:11])
-        self.payload            = raw[11:]
+        self.fragment           = bool(raw[0] & IPacket.FRAGMENT)
+        self.acks               = bool(raw[0] & IPacket.ACKS)
+
+        if extended:
+            self.pid = bytes(raw[2:4])
+            self.seq   = Bits.unpack(raw[4:6])
+            self.epoch = Bits.unpack(raw[6:8])
+        else:
+            self.pid = bytes((raw[2],))
+
+        self.source_addr = Bits.unpack(raw[header_size-8:header_size-4])
+        self.dest_addr   = Bits.unpack(raw[header_size-4:header_size])
+        self.payload     = raw[header_size:]
 
         if self.length != len(self.payload):
             raise PacketException(f"[IPacket::parse] Payload length mismatch (expected {self.length} vs {len(self.payload)})")
@@ -154,16 +307,27 @@ class IPacket:
 
         return packet_adaptor.get(packet_type, IPacket)(raw)
 
-    def to_bin(self):
-        if len(self.pid) != 1:
+    def _header(self, length):
+        # 1 byte pids give the original header, 2 byte pids the extended one (with seq)
+        if len(self.pid) not in (1, 2):
             raise PacketException(f"[IPacket::to_bin] Malformed packet, pid length mismatch!")
 
+        flags = (IPacket.EXTENDED if self.is_extended() else 0) | (IPacket.FRAGMENT if self.is_fragment() else 0) \
+              | (IPacket.ACKS if self.has_ack_ranges() else 0)
+
         data = bytearray()
-        data.append(self.ptype)
-        data.append(self.length)
+        data.append(self.ptype | flags)
+        data.append(length)
         data.extend(self.pid)
+        if self.is_extended():
+            data.extend(Bits.pack(self.seq, 2))
+            data.extend(Bits.pack(self.epoch, 2))
         data.extend(IPacket.convert_address(self.source_addr))
         data.extend(IPacket.convert_address(self.dest_addr))
+        return data
+
+    def to_bin(self):
+        data = self._header(self.length)
         data.extend(self.payload)
         return bytes(data)
 
@@ -331,15 +495,7 @@ class ContactRelay(IPacket):
         self.length  = len(self.payload)
 
     def to_bin(self):
-        if len(self.pid) != 1:
-            raise PacketException(f"[IPacket::to_bin] Malformed packet, pid length mismatch!")
-
-        data = bytearray()
-        data.append(self.ptype)
-        data.append(self.length + 4 + 4 + 1)   # Adjust for IPacket length (add hop info)
-        data.extend(self.pid)
-        data.extend(IPacket.convert_address(self.source_addr))
-        data.extend(IPacket.convert_address(self.dest_addr))
+        data = self._header(self.length + 4 + 4 + 1)   # Adjust for IPacket length (add hop info)
         data.extend(IPacket.convert_address(self.prev_hop))
         data.extend(IPacket.convert_address(self.next_hop))
         data.append(self.hop_count)
@@ -355,10 +511,15 @@ class ContactRelay(IPacket):
         attr.append(f"src={self.source_addr}")
         attr.append(f"dst={self.dest_addr}")
 
+        if self.seq:
+            attr.append(f"seq={self.seq}")
+
         attr.append(f"hop={self.prev_hop}->{self.next_hop}")
         attr.append(f"hops={self.hop_count}")
 
-        if self.payload:
+        if self.has_ack_ranges():
+            attr.append(f"acks={AckRanges(self.payload)}")
+        elif self.payload:
             attr.append("data={0}".format(self.payload if self.length < 50 else \
                                           f"({self.length} bytes)"))
 
@@ -417,17 +578,9 @@ class RouteRequest(IPacket):
         self.address_hops.append(addr)
 
     def to_bin(self):
-        if len(self.pid) != 1:
-            raise PacketException(f"[IPacket::to_bin] Malformed packet, pid length mismatch!")
-
         self.hop_count = self.get_hop_count()
 
-        data = bytearray()
-        data.append(self.ptype)
-        data.append(self.length + self.hop_count * 4 + 1)
-        data.extend(self.pid)
-        data.extend(IPacket.convert_address(self.source_addr))
-        data.extend(IPacket.convert_address(self.dest_addr))
+        data = self._header(self.length + self.hop_count * 4 + 1)
         data.append(self.hop_count)
 
         for a in self.address_hops:
@@ -446,10 +599,15 @@ class RouteRequest(IPacket):
         attr.append(f"src={self.source_addr}")
         attr.append(f"dst={self.dest_addr}")
 
+        if self.seq:
+            attr.append(f"seq={self.seq}")
+
         if self.address_hops:
             attr.append(f"route={self.get_route_string()}")
 
-        if self.payload:
+        if self.has_ack_ranges():
+            attr.append(f"acks={AckRanges(self.payload)}")
+        elif self.payload:
             attr.append("data={0}".format(self.payload if self.length < 50 else \
                                           f"({self.length} bytes)"))
 
@@ -0,0 +1,421 @@
+import sys
+import math
+import time
+import random
+import asyncio
+
+from colours import *
+from opposock import UDPSender
+from client import Client
+from aclient import AsyncClient, DatagramHandler, TransportSocket
+from client_extra import CommunicationType
+
+
+class Topology:
+    """Links between nodes 0..n-1, as { node: set(node) }."""
+    FULL   = "full"
+    LINE   = "line"
+    RING   = "ring"
+    GRID   = "grid"
+    RANDOM = "random"  # Random geometric graph in the unit square
+
+    CHOICES = (FULL, LINE, RING, GRID, RANDOM)
+
+    @staticmethod
+    def links(kind, n, rng, radius=None):
+        links = { i: set() for i in range(n) }
+
+        def link(a, b):
+            if a != b:
+                links[a].add(b)
+                links[b].add(a)
+
+        if kind == Topology.FULL:
+            for a in range(n):
+                for b in range(a + 1, n):
+                    link(a, b)
+        elif kind in (Topology.LINE, Topology.RING):
+            for a in range(n - 1):
+                link(a, a + 1)
+            if kind == Topology.RING and n > 2:
+                link(n - 1, 0)
+        elif kind == Topology.GRID:
+            side = math.ceil(math.sqrt(n))
+            for a in range(n):
+                if a % side < side - 1 and a + 1 < n:
+                    link(a, a + 1)
+                if a + side < n:
+                    link(a, a + side)
+        elif kind == Topology.RANDOM:
+            # Around the connectivity threshold, so most nodes are a few hops apart
+            radius = radius or 1.5 * math.sqrt(math.log(max(n, 2)) / (math.pi * n))
+            pos = [(rng.random(), rng.random()) for _ in range(n)]
+            for a in range(n):
+                for b in range(a + 1, n):
+                    if math.dist(pos[a], pos[b]) <= radius:
+                        link(a, b)
+        else:
+            raise ValueError(f"Unknown topology '{kind}'!")
+
+        return links
+
+
+class VirtualNetwork:
+    """
+    Datagrams between virtual IPs, on one asyncio event loop, instead of UDP.
+
+    - Only linked nodes hear each other, a broadcast reaches every neighbour.
+    - Every datagram (to every neighbour) is lost with `loss`.
+    - A datagram arrives after `latency` (plus up to `jitter`) seconds, once
+      the radio of its sender sent it: one at a time, at `bandwidth` bytes/s.
+    - Nodes that are down neither send nor receive.
+    """
+    EPHEMERAL_PORT = 49152  # Source port of the shared sender
+
+    def __init__(self, loop, links, loss=0.0, latency=0.005, jitter=0.0, bandwidth=None, rng=None):
+        self.loop      = loop
+        self.links     = links  # { ip: set(ip) }
+        self.loss      = loss
+        self.latency   = latency
+        self.jitter    = jitter
+        self.bandwidth = bandwidth
+        self.rng       = rng or random.Random()
+
+        self.endpoints  = {}     # { (ip, port): DatagramProtocol }
+        self.down       = set()  # ips
+        self.busy_until = {}     # { ip: loop time its radio is free }
+
+        self.reset_stats()
+
+    def __str__(self):
+        return f"<VirtualNetwork nodes={len(self.links)}, datagrams={self.datagrams}, bytes={self.bytes}, " \
+             + f"received={self.received}, lost={self.lost}, unreachable={self.unreachable}, down={self.dropped_down}>"
+
+    def reset_stats(self):
+        self.datagrams    = 0  # Sent
+        self.bytes        = 0
+        self.received     = 0
+        self.lost         = 0
+        self.unreachable  = 0  # Unicast to a node that is not a neighbour
+        self.dropped_down = 0  # From or to a node that is down
+
+    def bind(self, addr_tuple, protocol):
+        transport = VirtualTransport(self, addr_tuple)
+        self.endpoints[addr_tuple] = protocol
+        protocol.connection_made(transport)
+        return transport
+
+    def unbind(self, addr_tuple):
+        self.endpoints.pop(addr_tuple, None)
+
+    def send(self, src_tuple, data, addr_tuple):
+        src_ip, (dst_ip, port) = src_tuple[0], addr_tuple[:2]
+
+        self.datagrams += 1
+        self.bytes     += len(data)
+
+        if src_ip in self.down:
+            self.dropped_down += 1
+            return
+
+        neighbours = self.links.get(src_ip, ())
+        if dst_ip in ("<broadcast>", "255.255.255.255"):
+            dst_ips = tuple(neighbours)
+        elif dst_ip in neighbours:
+            dst_ips = (dst_ip,)
+        else:
+            self.unreachable += 1
+            return
+
+        # Serialised on the sender's radio
+        now   = self.loop.time()
+        start = max(now, self.busy_until.get(src_ip, now))
+        done  = start + (len(data) / self.bandwidth if self.bandwidth else 0)
+        self.busy_until[src_ip] = done
+
+        for dst_ip in dst_ips:
+            if self.rng.random() < self.loss:
+                self.lost += 1
+                continue
+
+            delay = done - now + self.latency + self.rng.uniform(0, self.jitter)
+            self.loop.call_later(delay, self._arrive, src_tuple, (dst_ip, port), data)
+
+    def _arrive(self, src_tuple, addr_tuple, data):
+        protocol = self.endpoints.get(addr_tuple)
+        if protocol is None or addr_tuple[0] in self.down:
+            self.dropped_down += 1
+            return
+
+        self.received += 1
+        protocol.datagram_received(data, src_tuple)
+
+
+class VirtualTransport(asyncio.DatagramTransport):
+    """An endpoint on a VirtualNetwork, as returned by create_datagram_endpoint()."""
+    def __init__(self, network, addr_tuple):
+        super().__init__()
+        self.network    = network
+        self.addr_tuple = addr_tuple
+        self.closed     = False
+
+    def get_extra_info(self, name, default=None):
+        return self.addr_tuple if name == "sockname" else default
+
+    def sendto(self, data, addr=None):
+        if not self.closed:
+            self.network.send(self.addr_tuple, data, addr)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+        self.network.unbind(self.addr_tuple)
+
+
+class VirtualSender(UDPSender):
+    """The shared sender of a Client, on a VirtualNetwork."""
+    def __init__(self, network, ip):
+        super().__init__()
+        self.network    = network
+        self.addr_tuple = (ip, VirtualNetwork.EPHEMERAL_PORT)
+
+    def _transmit(self, data, addr_tuple):
+        self.network.send(self.addr_tuple, data, addr_tuple)
+        return len(data)
+
+
+class SimClient(AsyncClient):
+    """An AsyncClient with its endpoints and sender on a VirtualNetwork."""
+    def __init__(self, network, address, ip, verbose=False):
+        super().__init__(str(address), interactive=False, local_ip=ip, sender=VirtualSender(network, ip))
+        self.network = network
+        self.verbose = verbose
+
+    async def _open_endpoints(self):
+        ip = self.get_ipaddress()
+
+        self.broadcast_sock = TransportSocket(self.network.bind(
+            (ip, Client.PORT_BROADCAST_SEND),
+            DatagramHandler(self._handle_broadcast, lambda e: self._error(e, prefix="BroadcastHandler: "))))
+
+        self.serversock = TransportSocket(self.network.bind(
+            (ip, Client.PORT_MESSAGES),
+            DatagramHandler(self._handle_message, lambda e: self._error(e, prefix="MsgHandler: "))))
+
+
+class Simulator:
+    """
+    Runs `nodes` SimClients in this process, sends `rate` random messages/s
+    for `duration` seconds with one communication type, and reports:
+
+    - delivery ratio: messages delivered to their destination / sent
+    - latency: from send() until the destination delivered it
+    - overhead: datagrams (and bytes) on the network per delivered message,
+      of every packet type (ACKs, floods, retransmissions, discoveries)
+
+    Every communication type runs on a new network with the same topology,
+    seed and workload, so the results can be compared.
+    """
+    WARMUP_S = 3  # Clients discover their neighbours for 3 seconds before they start
+
+    def __init__(self, nodes=20, topology=Topology.RANDOM, loss=0.0, latency=0.005, jitter=0.0, bandwidth=None,
+                 churn_interval=None, downtime=5, rate=10, duration=10, drain=5, size=16, seed=0, verbose=False):
+        super().__init__()
+        self.nodes          = nodes
+        self.topology       = topology
+        self.loss           = loss
+        self.latency        = latency
+        self.jitter         = jitter
+        self.bandwidth      = bandwidth
+        self.churn_interval = churn_interval  # Mean time between nodes going down (no churn if None)
+        self.downtime       = downtime
+        self.rate           = rate
+        self.duration       = duration
+        self.drain          = drain  # Time after the last message for retransmissions
+        self.size           = size
+        self.seed           = seed
+        self.verbose        = verbose
+
+    @staticmethod
+    def ip_of(address):
+        return f"10.0.{address >> 8}.{address & 0xFF}"
+
+    def _log(self, msg):
+        print(style("[Simulator]", Colours.FG.YELLOW), msg)
+
+    ###########################################################################
+
+    def run(self, comm_types=CommunicationType.CHOICES):
+        """Run every communication type, returns [results]."""
+        return [asyncio.run(self._run(comm_type)) for comm_type in comm_types]
+
+    async def _run(self, comm_type):
+        loop = asyncio.get_running_loop()
+        rng  = random.Random(self.seed)
+
+        addresses = list(range(1, self.nodes + 1))
+        links     = Topology.links(self.topology, self.nodes, rng)
+        network   = VirtualNetwork(loop,
+                                   { self.ip_of(addresses[a]): set(self.ip_of(addresses[b]) for b in bs) for a, bs in links.items() },
+                                   self.loss, self.latency, self.jitter, self.bandwidth, random.Random(self.seed + 1))
+
+        sent      = {}  # { (src, dst, data): send time }
+        delivered = {}  # { (src, dst, data): latency }
+
+        def on_message(dst):
+            def handler(src, data):
+                key = (src, dst, bytes(data))
+                if key in sent and key not in delivered:
+                    delivered[key] = time.time() - sent[key]
+            return handler
+
+        clients = {}
+        for address in addresses:
+            client = clients[address] = SimClient(network, address, self.ip_of(address), self.verbose)
+            client.on_message = on_message(address)
+
+        name = CommunicationType.to_string(comm_type)
+        self._log(f"{name}: {self.nodes} nodes, {self.topology} topology, " + \
+                  f"{sum(map(len, links.values())) // 2} links, {self.rate} messages/s for {self.duration}s...")
+
+        tasks = [loop.create_task(client.run()) for client in clients.values()]
+        if self.churn_interval:
+            tasks.append(loop.create_task(self._churn(network, clients, random.Random(self.seed + 2))))
+
+        try:
+            await asyncio.sleep(Simulator.WARMUP_S)
+            network.reset_stats()
+
+            # Same workload (seed) for every communication type
+            workload = random.Random(self.seed + 3)
+            for n in range(int(self.rate * self.duration)):
+                up = [a for a in addresses if self.ip_of(a) not in network.down]
+                if len(up) > 1:
+                    src = workload.choice(up)
+                    dst = workload.choice([a for a in addresses if a != src])
+                    data = (b"%d:%d:%d:" % (src, dst, n)).ljust(self.size, b".")
+
+                    sent[(src, dst, data)] = time.time()
+                    clients[src].send(dst, data, comm_type)
+
+                await asyncio.sleep(1 / self.rate)
+
+            await asyncio.sleep(self.drain)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        return self._results(name, network, sent, delivered)
+
+    async def _churn(self, network, clients, rng):
+        # Nodes go down for `downtime` seconds, and rejoin by broadcasting their address again
+        loop = asyncio.get_running_loop()
+
+        def revive(address):
+            network.down.discard(self.ip_of(address))
+            clients[address]._broadcast_discover()
+
+        while True:
+            await asyncio.sleep(rng.expovariate(1 / self.churn_interval))
+
+            up = [address for address in clients if self.ip_of(address) not in network.down]
+            if len(up) > 1:
+                address = rng.choice(up)
+                network.down.add(self.ip_of(address))
+                loop.call_later(self.downtime, revive, address)
+
+    ###########################################################################
+
+    def _results(self, name, network, sent, delivered):
+        latencies = sorted(delivered.values())
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0
+
+        count = len(delivered)
+        return {
+            "comm_type"    : name,
+            "sent"         : len(sent),
+            "delivered"    : count,
+            "ratio"        : count / len(sent) if sent else 0,
+            "latency_ms"   : sum(latencies) / count * 1000 if count else 0,
+            "p50_ms"       : percentile(0.5),
+            "p95_ms"       : percentile(0.95),
+            "datagrams"    : network.datagrams,
+            "bytes"        : network.bytes,
+            "datagrams_msg": network.datagrams / count if count else 0,
+            "bytes_msg"    : network.bytes / count if count else 0,
+            "lost"         : network.lost,
+            "unreachable"  : network.unreachable,
+            "dropped_down" : network.dropped_down,
+        }
+
+    @staticmethod
+    def report(results):
+        header = f"{'comm type':<15} {'sent':>6} {'deliv':>6} {'ratio':>6} {'lat ms':>8} {'p50 ms':>8} {'p95 ms':>8} " \
+               + f"{'dgrams':>8} {'dg/msg':>7} {'B/msg':>8} {'lost':>6} {'unreach':>7} {'down':>6}"
+        lines  = [style(header, Colours.FG.BRIGHT_YELLOW)]
+
+        for r in results:
+            lines.append(f"{r['comm_type']:<15} {r['sent']:>6} {r['delivered']:>6} {r['ratio']:>6.1%} {r['latency_ms']:>8.1f} " + \
+                         f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['datagrams']:>8} {r['datagrams_msg']:>7.1f} " + \
+                         f"{r['bytes_msg']:>8.0f} {r['lost']:>6} {r['unreachable']:>7} {r['dropped_down']:>6}")
+
+        return "\n".join(lines)
+
+
+def parse_args(argv):
+    options    = {}
+    comm_types = CommunicationType.CHOICES
+
+    flags = {
+        ("-n", "--nodes")     : ("nodes", int),
+        ("-t", "--topology")  : ("topology", str),
+        ("-l", "--loss")      : ("loss", float),
+        ("--latency",)        : ("latency", float),
+        ("--jitter",)         : ("jitter", float),
+        ("-b", "--bandwidth") : ("bandwidth", float),     # Bytes/s per node
+        ("--churn",)          : ("churn_interval", float),  # Mean seconds between nodes going down
+        ("--downtime",)       : ("downtime", float),
+        ("-r", "--rate")      : ("rate", float),          # Messages/s, over all nodes
+        ("-d", "--duration")  : ("duration", float),
+        ("--drain",)          : ("drain", float),
+        ("-s", "--size")      : ("size", int),            # Message bytes
+        ("--seed",)           : ("seed", int),
+    }
+
+    i = 1
+    while i < len(argv):
+        if argv[i] in ("-c", "--comm"):
+            # Communication types to run, e.g. `1,3`
+            comm_types = tuple(int(c) for c in argv[i+1].split(","))
+            i += 2
+        elif argv[i] in ("-v", "--verbose"):
+            # Log every packet of every client
+            options["verbose"] = True
+            i += 1
+        else:
+            for names, (key, convert) in flags.items():
+                if argv[i] in names:
+                    options[key] = convert(argv[i+1])
+                    i += 2
+                    break
+            else:
+                raise ValueError(f"Unknown option '{argv[i]}'!")
+
+    if options.get("topology", Topology.RANDOM) not in Topology.CHOICES:
+        raise ValueError(f"Topology must be one of {Topology.CHOICES}!")
+
+    return options, comm_types
+
+
+if __name__ == "__main__":
+    # e.g. python3 simulator.py -n 100 -t random -l 0.05 --churn 2 -r 20 -c 1,2,3
+    options, comm_types = parse_args(sys.argv)
+
+    simulator = Simulator(**options)
+    results   = simulator.run(comm_types)
+    print(Simulator.report(results))
@@ -1,5 +1,5 @@
 
-from threading import Thread, Lock, get_ident
+from threading import Thread, Lock, Condition, get_ident
 
 class Threading:
     @staticmethod
@@ -23,6 +23,18 @@ class Threading:
         """
         return Lock()
 
+    @staticmethod
+    def new_condition():
+        """
+        Return a Condition object, to wait until notified (or a timeout).
+
+        Example:
+            cond = Threading.new_condition()
+            with cond:
+                cond.wait(timeout)
+        """
+        return Condition()
+
     @staticmethod
     def get_current_id():
         """Get the current thread id"""